@@ -2,7 +2,6 @@ import asyncio
 import logging
 import os
 
-from aiocache import RedisCache
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
 from aiogram.filters import CommandStart
@@ -10,10 +9,10 @@ from aiogram.fsm.storage.base import DefaultKeyBuilder
 from aiogram.types import Message
 from aiogram.fsm.storage.redis import RedisStorage, Redis
 from aiogram_dialog import setup_dialogs
-from sqlalchemy.exc import SQLAlchemyError, IntegrityError
-from sqlalchemy.future import select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from db.models import AsyncSessionLocal, Users, user_referrals  # Импортируем вашу модель Users
+from db.db_functions import register_user, add_referral
 from config_data.config import Config, load_config
 from handlers import admin_handlers, user_handlers, game_handlers
 from handlers.user_handlers import exchange_router
@@ -21,8 +20,23 @@ from keyboards.set_menu import set_main_menu
 from lexicon.lexicon_ru import LEXICON_RU
 from keyboards.keyboards import admin_kb, main_kb
 from middleware.game_mdwr import DatabaseMiddleware
+from middleware.ordering import user_ordering
+from middleware.throttling import throttling
 from services import game, user_dialog
+from services.services import backfill_leaderboards, rating_cache
+from services.leaderboard import leaderboard, CATEGORY_REFERRALS
+from services.known_users import known_users
+from services.broadcast import broadcaster
+from services.ledger import ledger, LEDGER_REFERRAL
+from services.outbound import outbound, PRIORITY_NOTIFICATION
+from services.question_deck import question_deck
+from services.question_pool import question_pool
+from services.rating_rollover import rating_rollover
+from services.sponsor_channels import sponsor_registry
+from services.subscription_sweeper import subscription_sweeper
+from services.webhook import run_webhook
 from db.models import async_session_maker
+from db.migrations import run_migrations
 
 # Инициализируем логгер
 logger = logging.getLogger(__name__)
@@ -49,21 +63,52 @@ async def main():
                                      protect_content=False)
     )
 
-    redis = Redis(host='localhost')
-    storage = RedisStorage(redis=redis, key_builder=DefaultKeyBuilder(with_destiny=True))
+    # Все исходящие запросы проходят через планировщик с лимитами Telegram
+    bot.session.middleware(outbound)
 
     REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
     REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
 
-    # Инициализация кеша
-    cache = RedisCache(endpoint=REDIS_HOST, port=REDIS_PORT)
+    redis = Redis(host=REDIS_HOST, port=REDIS_PORT)
+    storage = RedisStorage(redis=redis, key_builder=DefaultKeyBuilder(with_destiny=True))
+
+    # Персональные колоды вопросов и недельные рейтинги хранятся в том же Redis
+    question_deck.setup(redis)
+    leaderboard.setup(redis)
+    # Снимок рейтинга общий для всех процессов бота
+    rating_cache.setup(redis)
+    # chat_id спонсорских каналов и кеш проверок подписки
+    sponsor_registry.setup(redis)
+    subscription_sweeper.setup(redis)
+    # Зарегистрированные пользователи: повторный /start без запросов к БД
+    known_users.setup(redis)
+    # Прогресс рассылок: после перезапуска они продолжаются с контрольной точки
+    broadcaster.setup(redis)
 
     dp = Dispatcher(storage=storage)
+    # Апдейты одного пользователя обрабатываются по очереди. В polling все апдейты
+    # получает один процесс, и хватает очереди в памяти; аренда в Redis нужна
+    # только репликам за вебхуком
+    if config.webhook.url:
+        user_ordering.setup(redis)
+    dp.update.outer_middleware(user_ordering)
+    # Ведра токенов ограничителя частоты общие для всех реплик
+    throttling.setup(redis)
 
     await set_main_menu(bot)
 
+    # Применяем новые миграции схемы БД
+    await run_migrations()
+
+    # Загружаем пул вопросов в память, чтобы старт игры не обращался к БД
+    async with async_session_maker() as session:
+        await question_pool.load(session)
+
+    # Если рейтинги текущей недели отсутствуют в Redis (например, после очистки) — заполняем из БД
+    await backfill_leaderboards()
+
     @dp.message(CommandStart())
-    async def process_start_command(message: Message):
+    async def process_start_command(message: Message, session: AsyncSession):
         """
         Обработчик команды /start. Добавляет нового пользователя в базу данных, если его там ещё нет.
         Также обрабатывает реферальную систему.
@@ -85,69 +130,51 @@ async def main():
             if referrer_id == user_id:  # Запрещаем приглашать самого себя
                 referrer_id = None
 
-        async with AsyncSessionLocal() as session:
-            try:
-                # Проверяем, есть ли пользователь в базе
-                result = await session.execute(select(Users).filter_by(user_id=user_id))
-                user = result.scalars().first()
-
-                if not user:
-                    # Добавляем нового пользователя
-                    new_user = Users(user_id=user_id, username=username)
-                    session.add(new_user)
-                    await session.commit()
-                    logger.info("Пользователь успешно добавлен: %s", username)
-
-                    # Обрабатываем реферальную систему
-                    if referrer_id:
-                        # Проверяем, не зарегистрирован ли пользователь уже как реферал
-                        existing_referral = await session.execute(
-                            select(user_referrals).where(user_referrals.c.referred_id == new_user.id)
-                        )
-
-                        if not existing_referral.scalars().first():
-                            # Получаем пригласившего пользователя
-                            referrer = await session.execute(select(Users).where(Users.user_id == referrer_id))
-                            referrer = referrer.scalars().first()
-
-                            if referrer:
-                                try:
-                                    # Добавляем запись в user_referrals
-                                    session.execute(user_referrals.insert().values(
-                                        referrer_id=referrer.id, referred_id=new_user.id
-                                    ))
-
-                                    # Начисляем бонусы
-                                    referrer.balance_silver += 500
-                                    new_user.balance_silver += 500
-
-                                    await session.commit()
-
-                                    # Уведомляем пригласившего
-                                    await message.bot.send_message(
-                                        referrer.user_id,
-                                        f"🎉 Ваш друг {message.from_user.full_name} присоединился к игре!\n"
-                                        f"Вы получили 500 серебряных монет! 💰"
-                                    )
-
-                                    await message.answer(
-                                        f"🎉 Вы зарегистрировались по ссылке друга!\n"
-                                        f"Вы и ваш друг получили 500 серебряных монет! 💰\n"
-                                        f"Проверьте свой баланс и присоединяйтесь к игре!"
-                                    )
-
-                                except IntegrityError:
-                                    await session.rollback()
-
-                else:
-                    logger.info("Пользователь уже существует: %s", username)
-                # Приветствие для обычных пользователей
-                await message.answer(text=LEXICON_RU['/start'], reply_markup=main_kb, parse_mode='HTML')
-            except SQLAlchemyError as e:
-                logger.error("Ошибка при работе с БД: %s", e)
-                await message.answer("⚠ Произошла ошибка при регистрации. Попробуйте позже.")
-            except Exception as e:
-                logger.error("Ошибка в обработке команды /start: %s", e)
+        # Быстрый путь: повторный /start зарегистрированного пользователя не обращается к БД
+        if await known_users.contains(user_id):
+            await message.answer(text=LEXICON_RU['/start'], reply_markup=main_kb, parse_mode='HTML')
+            return
+
+        try:
+            # Регистрация и приглашение — два запроса и один коммит
+            new_user_id = await register_user(session, user_id, username)
+            referred = False
+            if new_user_id is not None and referrer_id:
+                referred = await add_referral(session, referrer_id, new_user_id)
+            await session.commit()
+            await known_users.add(user_id)
+
+            if new_user_id is None:
+                logger.info("Пользователь уже существует: %s", username)
+            else:
+                logger.info("Пользователь успешно добавлен: %s", username)
+
+            if referred:
+                # Начисляем бонусы обоим пользователям через журнал монет
+                ledger.record(referrer_id, "silver", 500, LEDGER_REFERRAL)
+                ledger.record(user_id, "silver", 500, LEDGER_REFERRAL)
+                await leaderboard.increment(CATEGORY_REFERRALS, referrer_id)
+
+                # Уведомляем пригласившего в фоне, не задерживая ответ новому пользователю
+                outbound.submit(message.bot.send_message(
+                    referrer_id,
+                    f"🎉 Ваш друг {message.from_user.full_name} присоединился к игре!\n"
+                    f"Вы получили 500 серебряных монет! 💰"
+                ), PRIORITY_NOTIFICATION)
+
+                await message.answer(
+                    f"🎉 Вы зарегистрировались по ссылке друга!\n"
+                    f"Вы и ваш друг получили 500 серебряных монет! 💰\n"
+                    f"Проверьте свой баланс и присоединяйтесь к игре!"
+                )
+
+            # Приветствие для обычных пользователей
+            await message.answer(text=LEXICON_RU['/start'], reply_markup=main_kb, parse_mode='HTML')
+        except SQLAlchemyError as e:
+            logger.error("Ошибка при работе с БД: %s", e)
+            await message.answer("⚠ Произошла ошибка при регистрации. Попробуйте позже.")
+        except Exception as e:
+            logger.error("Ошибка в обработке команды /start: %s", e)
 
     # Регистрируем диалоги
     setup_dialogs(dp)
@@ -160,13 +187,48 @@ async def main():
     dp.include_router(game.router)
     dp.include_router(user_dialog.rating_router)
 
-    # Регистрируем middleware
-    dp.update.middleware(DatabaseMiddleware(async_session_maker))
+    # Ограничитель частоты — первым: отклонённые апдейты не доходят до сессии БД
+    dp.message.middleware(throttling)
+    dp.callback_query.middleware(throttling)
+
+    # Регистрируем middleware: сессия БД создаётся лениво и только для событий с хэндлером
+    database_middleware = DatabaseMiddleware(async_session_maker)
+    dp.message.middleware(database_middleware)
+    dp.callback_query.middleware(database_middleware)
+    dp.pre_checkout_query.middleware(database_middleware)
 
     logging.basicConfig(level=logging.DEBUG)
-    # Пропускаем накопившиеся апдейты и запускаем polling
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot, skip_updates=True)
+    # Фоновая запись журнала монет и перенос начислений в балансы
+    ledger_task = asyncio.create_task(ledger.run())
+    # Новые вопросы из других процессов попадают в пул без перезапуска
+    pool_task = asyncio.create_task(question_pool.run())
+    # Пересборка снимка рейтинга по расписанию (одним процессом под блокировкой)
+    rating_task = asyncio.create_task(rating_cache.run())
+    # Закрытие недели: архив рейтингов, призы и уведомления победителям
+    rollover_task = asyncio.create_task(rating_rollover.run(bot))
+    # Повторная проверка подписок на спонсоров в пределах бюджета запросов
+    sweeper_task = asyncio.create_task(
+        subscription_sweeper.run(bot, config.subscription_sweep.budget_per_minute)
+    )
+    # Незавершённые рассылки администратора
+    broadcast_task = asyncio.create_task(broadcaster.run(bot))
+
+    try:
+        if config.webhook.url:
+            # Вебхук: несколько реплик за балансировщиком делят входящие апдейты
+            await run_webhook(dp, bot, config.webhook)
+        else:
+            # Пропускаем накопившиеся апдейты и запускаем polling
+            await bot.delete_webhook(drop_pending_updates=True)
+            await dp.start_polling(bot, skip_updates=True)
+    finally:
+        ledger_task.cancel()
+        pool_task.cancel()
+        rating_task.cancel()
+        rollover_task.cancel()
+        sweeper_task.cancel()
+        broadcast_task.cancel()
+        await ledger.flush()  # Не теряем начисления из очереди при остановке
 
 
 if __name__ == "__main__":
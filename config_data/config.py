@@ -14,10 +14,35 @@ class DbURL:
     url: str  # URL для базы данных
 
 
+@dataclass
+class SubscriptionSweep:
+    budget_per_minute: int  # Сколько запросов к Telegram в минуту тратит повторная проверка подписок
+
+
+@dataclass
+class GameSettings:
+    single_message: bool  # Игра в одном сообщении: вопросы редактируются на месте, а не отправляются заново
+
+
+@dataclass
+class Webhook:
+    url: str  # Публичный адрес бота для Telegram; пустой — режим polling
+    path: str  # Путь вебхука на сервере
+    secret: str  # Секрет из заголовка X-Telegram-Bot-Api-Secret-Token
+    host: str  # Адрес, на котором слушает aiohttp-сервер
+    port: int  # Порт aiohttp-сервера
+    max_connections: int  # Сколько одновременных соединений Telegram открывает ко всем репликам
+    max_in_flight: int  # Сколько апдейтов одна реплика обрабатывает одновременно
+    max_queue: int  # Сколько апдейтов ждут свободного слота, прежде чем получить 503
+
+
 @dataclass
 class Config:
     tg_bot: TgBot
     database: DbURL
+    subscription_sweep: SubscriptionSweep
+    game: GameSettings
+    webhook: Webhook
 
 
 def load_config(path: str = None) -> Config:
@@ -31,6 +56,22 @@ def load_config(path: str = None) -> Config:
         ),
         database=DbURL(
             url=env.str("DATABASE_URL")
+        ),
+        subscription_sweep=SubscriptionSweep(
+            budget_per_minute=env.int("SUBSCRIPTION_SWEEP_BUDGET", 20)
+        ),
+        game=GameSettings(
+            single_message=env.bool("GAME_SINGLE_MESSAGE", True)
+        ),
+        webhook=Webhook(
+            url=env.str("WEBHOOK_URL", ""),
+            path=env.str("WEBHOOK_PATH", "/webhook"),
+            secret=env.str("WEBHOOK_SECRET", ""),
+            host=env.str("WEBAPP_HOST", "0.0.0.0"),
+            port=env.int("WEBAPP_PORT", 8080),
+            max_connections=env.int("WEBHOOK_MAX_CONNECTIONS", 40),
+            max_in_flight=env.int("WEBHOOK_MAX_IN_FLIGHT", 64),
+            max_queue=env.int("WEBHOOK_MAX_QUEUE", 256)
         )
     )
 
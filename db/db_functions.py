@@ -1,24 +1,33 @@
 import logging
+from datetime import datetime, timedelta
 
-from aiogram.enums import ChatMemberStatus
-from sqlalchemy import select
+import pytz
+
+from sqlalchemy import select, update, func, literal, bindparam
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from sqlalchemy.sql.expression import func
 
-from db.models import Question, Users, ExchangeRates, SponsorChannel
+from db.models import (
+    user_referrals, Question, Users, ExchangeRates, SponsorChannel, Game, WeeklyScore, LeagueEnum, async_session_maker
+)
+from services.leaderboard import get_week_id, get_week_range
+from services.question_deck import question_deck
+from services.sponsor_channels import sponsor_registry
+from services.question_pool import question_pool
 
 # Логирование
 logger = logging.getLogger(__name__)
 
 
-def add_question_to_db(session: Session, league: str, difficulty: str, question_text: str,
-                       correct_answer: str, answer_2: str, answer_3: str, answer_4: str):
+async def add_question_to_db(session: AsyncSession, league: str, difficulty: str, question_text: str,
+                             correct_answer: str, answer_2: str, answer_3: str, answer_4: str):
     """
     Добавляет новый вопрос в таблицу `questions`.
 
-    :param session: SQLAlchemy Session
+    :param session: Асинхронная сессия SQLAlchemy (сессия апдейта из DatabaseMiddleware)
     :param league: Лига вопроса (Bronze, Silver, Gold)
     :param difficulty: Сложность вопроса (Easy, Medium, Hard)
     :param question_text: Текст вопроса
@@ -29,7 +38,7 @@ def add_question_to_db(session: Session, league: str, difficulty: str, question_
     """
     try:
         # Проверяем, существует ли вопрос с таким текстом
-        existing_question = session.query(Question).filter_by(question_text=question_text).first()
+        existing_question = await session.scalar(select(Question).filter_by(question_text=question_text))
         if existing_question:
             logger.warning("Вопрос с таким текстом уже существует: %s", question_text)
             return "Вопрос уже существует"
@@ -47,13 +56,14 @@ def add_question_to_db(session: Session, league: str, difficulty: str, question_
 
         # Добавляем в сессию и коммитим
         session.add(new_question)
-        session.commit()
+        await session.commit()
+        question_pool.add(new_question)  # Новый вопрос сразу доступен для игр
         logger.info("Вопрос успешно добавлен: %s", question_text)
         return "Вопрос успешно добавлен"
 
     except SQLAlchemyError as e:
         # Откатываем изменения в случае ошибки
-        session.rollback()
+        await session.rollback()
         logger.error("Ошибка при добавлении вопроса: %s", e)
         return f"Ошибка: {e}"
 
@@ -91,38 +101,38 @@ def add_user_to_db(session: Session, user_id: int, username: str):
         return f"Ошибка: {e}"
 
 
-# __________ Получение вопросов из базы (в случайном порядке) _______________
-async def get_question(league: str, session: AsyncSession):
+# __________ Получение вопросов из пула (в случайном порядке) _______________
+async def get_question(league: str, session: AsyncSession, user_id: int | None = None):
     """
     Получение списка вопросов для заданной лиги.
 
+    Вопросы выбираются из пула в памяти процесса (services.question_pool),
+    сессия используется только для первичной загрузки пула. Если передан
+    user_id, вопросы берутся из персональной колоды игрока без повторов.
+
     Args:
         league (str): Лига ("Bronze", "Silver", "Gold").
         session (AsyncSession): Асинхронная сессия SQLAlchemy.
+        user_id (int, optional): Telegram ID игрока.
 
     Returns:
         list: Список вопросов.
     """
+    if not question_pool.loaded:
+        await question_pool.load(session)
+
     questions = []
     for difficulty in ["Easy", "Medium", "Hard"]:
-        result = await session.execute(
-            select(Question)
-            .where(Question.league == league, Question.difficulty == difficulty)
-            .order_by(func.random())
-            .limit(5)
-        )
-        questions.extend(result.scalars().all())
+        if user_id is not None:
+            questions.extend(await question_deck.draw(user_id, league, difficulty, 5))
+        else:
+            questions.extend(question_pool.sample(league, difficulty, 5))
 
     return [
         {
             "id": question.id,
             "text": question.question_text,
-            "answers": [
-                question.correct_answer,
-                question.answer_2,
-                question.answer_3,
-                question.answer_4,
-            ],
+            "answers": [question.correct_answer, *question.incorrect_answers],
             "correct_answer": question.correct_answer,
             "difficulty": question.difficulty,
             "score": 10 if question.difficulty == "Easy" else 20 if question.difficulty == "Medium" else 30,
@@ -131,35 +141,249 @@ async def get_question(league: str, session: AsyncSession):
     ]
 
 
-#______Обновление баланса пользователя после игры____________
-async def update_user_balance(user_id: int, amount: int, currency: str, session: AsyncSession):
+# ______________ Атомарные операции с балансом ______________
+# Колонки баланса по названию валюты
+BALANCE_COLUMNS = {
+    "rubles": Users.balance_rubles,
+    "bronze": Users.balance_bronze,
+    "silver": Users.balance_silver,
+    "gold": Users.balance_gold,
+}
+
+
+def _balance_column(currency: str):
+    column = BALANCE_COLUMNS.get(currency.lower())
+    if column is None:
+        raise ValueError(f"Неизвестная валюта: {currency}")
+    return column
+
+
+async def credit_balance(session: AsyncSession, user_id: int, currency: str, amount: float):
     """
-    Обновление баланса пользователя.
+    Начисляет сумму на баланс одним запросом
+    UPDATE ... SET balance = balance + :amount ... RETURNING.
+
+    Не коммитит: границы транзакции задаёт вызывающий код.
 
     Args:
-        user_id (int): ID пользователя.
-        amount (int): Сумма для добавления или снятия.
-        currency (str): Тип валюты ("silver" или "gold").
         session (AsyncSession): Асинхронная сессия SQLAlchemy.
+        user_id (int): Telegram ID пользователя.
+        currency (str): Валюта ("rubles", "bronze", "silver", "gold").
+        amount (float): Сумма начисления.
 
     Returns:
-        bool: True, если успешно, иначе False.
+        Новый баланс или None, если пользователь не найден.
+    """
+    column = _balance_column(currency)
+    result = await session.execute(
+        update(Users)
+        .where(Users.user_id == user_id)
+        .values({column: column + amount})
+        .returning(column)
+        .execution_options(synchronize_session=False)
+    )
+    return result.scalar_one_or_none()
+
+
+async def credit_balances(session: AsyncSession, currency: str, deltas: dict[int, float]):
     """
-    result = await session.execute(select(Users).where(Users.user_id == user_id))
-    user = result.scalars().first()
+    Начисляет суммы нескольким пользователям одним пакетным UPDATE (executemany).
 
-    if not user:
-        return False
+    Не коммитит: используется журналом монет и выплатой недельных призов
+    внутри их транзакций. Строки обновляются по возрастанию Telegram ID, а
+    вызывающий код перебирает валюты в одном порядке, поэтому параллельные
+    транзакции блокируют строки `users` одинаково и не взаимоблокируются.
 
-    if currency == "bronze":
-        user.balance_bronze += amount
-    elif currency == "silver":
-        user.balance_silver += amount
-    elif currency == "gold":
-        user.balance_gold += amount
+    Args:
+        session (AsyncSession): Асинхронная сессия SQLAlchemy.
+        currency (str): Валюта ("rubles", "bronze", "silver", "gold").
+        deltas (dict): Telegram ID пользователя -> сумма начисления.
+    """
+    if not deltas:
+        return
+    users = Users.__table__
+    column = users.c[_balance_column(currency).key]
+    await session.execute(
+        update(users)
+        .where(users.c.user_id == bindparam("b_user_id"))
+        .values({column: column + bindparam("b_delta")}),
+        [{"b_user_id": user_id, "b_delta": delta} for user_id, delta in sorted(deltas.items())]
+    )
+
+
+async def debit_balance(session: AsyncSession, user_id: int, currency: str, cost: float):
+    """
+    Условное списание: UPDATE ... SET balance = balance - :cost
+    WHERE ... AND balance >= :cost RETURNING.
 
-    await session.commit()
-    return True
+    Баланс не может уйти в минус даже при одновременных нажатиях, а проверка
+    и списание выполняются за один round-trip. Используется для оплаты входа в лигу.
+
+    Returns:
+        Новый баланс или None, если средств недостаточно (или пользователь не найден).
+    """
+    column = _balance_column(currency)
+    result = await session.execute(
+        update(Users)
+        .where(Users.user_id == user_id, column >= cost)
+        .values({column: column - cost})
+        .returning(column)
+        .execution_options(synchronize_session=False)
+    )
+    return result.scalar_one_or_none()
+
+
+async def exchange_balance(session: AsyncSession, user_id: int, from_currency: str, to_currency: str,
+                           amount: float, rate: float):
+    """
+    Обмен валют одним условным UPDATE: списание amount и начисление amount * rate.
+
+    Returns:
+        tuple: Новые балансы (from, to) или None, если средств недостаточно.
+    """
+    from_column = _balance_column(from_currency)
+    to_column = _balance_column(to_currency)
+    result = await session.execute(
+        update(Users)
+        .where(Users.user_id == user_id, from_column >= amount)
+        .values({from_column: from_column - amount, to_column: to_column + amount * rate})
+        .returning(from_column, to_column)
+        .execution_options(synchronize_session=False)
+    )
+    return result.one_or_none()
+
+
+def _insert(session: AsyncSession, table):
+    """INSERT с поддержкой ON CONFLICT для диалекта текущего подключения."""
+    if session.get_bind().dialect.name == "sqlite":
+        return sqlite_insert(table)
+    return pg_insert(table)
+
+
+async def add_weekly_score(session: AsyncSession, league: str, user_id: int, score: int, week: str | None = None):
+    """
+    Добавляет результат завершённой игры в недельные итоги одним upsert
+    (INSERT ... ON CONFLICT DO UPDATE).
+
+    Не коммитит: границы транзакции задаёт вызывающий код.
+
+    Args:
+        session (AsyncSession): Асинхронная сессия SQLAlchemy.
+        league (str): Лига игры.
+        user_id (int): Telegram ID игрока.
+        score (int): Итоговый счёт игры.
+        week (str, optional): Неделя; по умолчанию текущая.
+    """
+    stmt = _insert(session, WeeklyScore).values(
+        week=week or get_week_id(), league=LeagueEnum(league), user_id=user_id,
+        total_score=score, games_played=1,
+    )
+    await session.execute(stmt.on_conflict_do_update(
+        index_elements=[WeeklyScore.week, WeeklyScore.league, WeeklyScore.user_id],
+        set_={
+            "total_score": WeeklyScore.total_score + stmt.excluded.total_score,
+            "games_played": WeeklyScore.games_played + 1,
+        },
+    ))
+
+
+async def rebuild_weekly_scores(session: AsyncSession, week: str) -> int:
+    """
+    Пересчитывает недельные итоги из таблицы `games` (пакетное заполнение и сверка).
+
+    Существующие строки недели перезаписываются агрегатом по завершённым играм.
+    Не коммитит.
+
+    Args:
+        session (AsyncSession): Асинхронная сессия SQLAlchemy.
+        week (str): Неделя, например "2026-W42".
+
+    Returns:
+        int: Количество записанных строк.
+    """
+    start_week, end_week = get_week_range(week)
+    result = await session.execute(
+        select(Game.league, Game.user_id, func.sum(Game.score), func.count(Game.id))
+        .where(Game.created_at >= start_week, Game.created_at < end_week, Game.finished_at.isnot(None))
+        .group_by(Game.league, Game.user_id)
+    )
+    rows = [
+        {"week": week, "league": league, "user_id": user_id,
+         "total_score": total_score or 0, "games_played": games_played}
+        for league, user_id, total_score, games_played in result.all()
+    ]
+    if not rows:
+        return 0
+
+    stmt = _insert(session, WeeklyScore)
+    await session.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[WeeklyScore.week, WeeklyScore.league, WeeklyScore.user_id],
+            set_={"total_score": stmt.excluded.total_score, "games_played": stmt.excluded.games_played},
+        ),
+        rows
+    )
+    return len(rows)
+
+
+async def backfill_weekly_scores(weeks: int = 5):
+    """
+    Пакетное заполнение `weekly_scores` за последние недели (каждая неделя — своя транзакция).
+
+    Args:
+        weeks (int): Сколько недель, включая текущую, пересчитать.
+    """
+    now = datetime.now(pytz.timezone('Europe/Moscow'))
+    for offset in range(weeks):
+        week = get_week_id(now - timedelta(weeks=offset))
+        async with async_session_maker() as session:
+            rows = await rebuild_weekly_scores(session, week)
+            await session.commit()
+        logger.info("Недельные итоги %s пересчитаны: %s строк", week, rows)
+
+
+async def register_user(session: AsyncSession, user_id: int, username: str) -> int | None:
+    """
+    Регистрирует пользователя одним INSERT ... ON CONFLICT DO NOTHING RETURNING.
+    Уже зарегистрированный пользователь, помеченный неактивным (заблокировал
+    бота во время рассылки), снова становится активным.
+
+    Не коммитит: границы транзакции задаёт вызывающий код.
+
+    Returns:
+        int: Внутренний ID нового пользователя или None, если он уже зарегистрирован.
+    """
+    stmt = _insert(session, Users).values(user_id=user_id, username=username)
+    result = await session.execute(
+        stmt.on_conflict_do_nothing(index_elements=[Users.user_id]).returning(Users.id)
+    )
+    new_id = result.scalar_one_or_none()
+    if new_id is None:
+        await session.execute(
+            update(Users).where(Users.user_id == user_id, Users.is_active.is_(False)).values(is_active=True)
+        )
+    return new_id
+
+
+async def add_referral(session: AsyncSession, referrer_user_id: int, referred_id: int) -> bool:
+    """
+    Записывает приглашение одним INSERT ... SELECT: ID пригласившего берётся
+    по его Telegram ID прямо в запросе. Не коммитит.
+
+    Args:
+        session (AsyncSession): Асинхронная сессия SQLAlchemy.
+        referrer_user_id (int): Telegram ID пригласившего.
+        referred_id (int): Внутренний ID приглашённого (Users.id).
+
+    Returns:
+        bool: True, если приглашение записано (пригласивший существует и запись новая).
+    """
+    stmt = _insert(session, user_referrals).from_select(
+        ["referrer_id", "referred_id"],
+        select(Users.id, literal(referred_id)).where(Users.user_id == referrer_user_id)
+    )
+    result = await session.execute(stmt.on_conflict_do_nothing().returning(user_referrals.c.referrer_id))
+    return result.first() is not None
 
 
 # Функция получения актуальных курсов обмена монет
@@ -188,9 +412,12 @@ async def get_sponsor_channels(session: AsyncSession):
 # Проверка подписки пользователя
 async def check_user_subscription(user_id: int, bot, session: AsyncSession):
     channels = await get_sponsor_channels(session)
+    # chat_id каналов и вердикты о подписке берутся из реестра (с кешем в Redis)
+    verdicts = await sponsor_registry.check(bot, channels, user_id)
+    return all(verdicts.values())
+
+
+if __name__ == "__main__":
+    import asyncio
 
-    for channel in channels:
-        chat_member = await bot.get_chat_member(chat_id=channel.id, user_id=user_id)
-        if chat_member.status not in (ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER):
-            return False
-    return True
+    asyncio.run(backfill_weekly_scores())
@@ -0,0 +1,225 @@
+"""
+Версионные миграции схемы БД.
+
+Применённые версии хранятся в таблице `schema_migrations`; при старте бота
+(и командой `python -m db.migrations`) выполняются только новые миграции,
+каждая в своей транзакции. Миграция 1 создаёт недостающие таблицы по
+моделям, поэтому последующие миграции должны быть идемпотентными: на новой
+базе их изменения уже созданы create_all.
+
+`python -m db.migrations --check-plans` проверяет через EXPLAIN, что горячие
+запросы используют индексы.
+"""
+import asyncio
+import logging
+import sys
+
+from sqlalchemy import (
+    Column, Integer, String, DateTime, MetaData, Table, func, inspect, select, insert, update, literal_column, text
+)
+from sqlalchemy.engine import Connection
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from db.models import (
+    Base, engine, user_subscriptions, Users, Question, Game, ProposedQuestion, ExchangeRates, Transaction, WeeklyScore,
+    RatingArchive, WeeklyRollover, WeeklyPrize, CoinLedger, LeagueEnum, DifficultyEnum
+)
+
+logger = logging.getLogger(__name__)
+
+# Ключ advisory-блокировки PostgreSQL: миграции выполняет только один процесс
+MIGRATION_LOCK_ID = 720_431_001
+
+schema_migrations = Table(
+    'schema_migrations', MetaData(),
+    Column('version', Integer, primary_key=True),
+    Column('name', String(100), nullable=False),
+    Column('applied_at', DateTime(timezone=True), server_default=func.now()),
+)
+
+
+def _create_tables(conn: Connection):
+    Base.metadata.create_all(conn)
+
+
+def _create_hot_path_indexes(conn: Connection):
+    # На существующих базах create_all не добавляет индексы к уже созданным таблицам
+    for table in (Question.__table__, Game.__table__, ProposedQuestion.__table__, ExchangeRates.__table__):
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+
+def _unique_payment_id(conn: Connection):
+    table = Transaction.__table__
+    index = next(index for index in table.indexes if index.name == 'ix_transactions_payment_id')
+    existing = {ix['name']: ix for ix in inspect(conn).get_indexes(table.name)}
+    if existing.get(index.name, {}).get('unique'):
+        return
+
+    duplicates = conn.scalar(
+        select(func.count()).select_from(
+            select(table.c.payment_id).group_by(table.c.payment_id).having(func.count() > 1).subquery()
+        )
+    )
+    if duplicates:
+        raise RuntimeError(f"В transactions {duplicates} повторяющихся payment_id — устраните их перед миграцией")
+
+    if index.name in existing:
+        index.drop(conn)
+    index.create(conn)
+
+
+def _create_weekly_archive(conn: Connection):
+    Base.metadata.create_all(
+        conn, tables=[RatingArchive.__table__, WeeklyRollover.__table__, WeeklyPrize.__table__]
+    )
+
+
+def _add_columns(conn: Connection, table: Table, names: tuple[str, ...]):
+    existing = {column['name'] for column in inspect(conn).get_columns(table.name)}
+    for name in names:
+        if name not in existing:
+            column = table.c[name]
+            column_type = column.type.compile(conn.dialect)
+            conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {name} {column_type}'))
+
+
+def _subscription_tracking(conn: Connection):
+    _add_columns(conn, user_subscriptions, ('subscribed_at', 'checked_at', 'unsubscribed_at'))
+    for index in user_subscriptions.indexes:
+        index.create(conn, checkfirst=True)
+
+
+def _subscription_claims(conn: Connection):
+    _add_columns(conn, user_subscriptions, ('claimed_until',))
+
+
+def _unapplied_ledger_index(conn: Connection):
+    for index in CoinLedger.__table__.indexes:
+        index.create(conn, checkfirst=True)
+
+
+def _backfill_subscribed_at(conn: Connection):
+    # Колонка добавлена миграцией 5 без значения для старых подписок. Точное время
+    # неизвестно — берём регистрацию пользователя, чтобы старые подписки не попали
+    # в рейтинг текущей недели; у неизвестных пользователей — время миграции
+    table = user_subscriptions
+    registered_at = select(Users.created_at).where(Users.user_id == table.c.user_id).scalar_subquery()
+    conn.execute(
+        update(table)
+        .where(table.c.subscribed_at.is_(None))
+        .values(subscribed_at=func.coalesce(registered_at, func.now()))
+    )
+
+
+# (версия, название, функция). Новые миграции добавляются только в конец списка
+MIGRATIONS = [
+    (1, "create tables", _create_tables),
+    (2, "hot path indexes", _create_hot_path_indexes),
+    (3, "unique transactions.payment_id", _unique_payment_id),
+    (4, "weekly rating archive", _create_weekly_archive),
+    (5, "subscription re-verification", _subscription_tracking),
+    (6, "subscription sweep claims", _subscription_claims),
+    (7, "unapplied coin ledger index", _unapplied_ledger_index),
+    (8, "backfill user_subscriptions.subscribed_at", _backfill_subscribed_at),
+]
+
+
+async def run_migrations(db_engine: AsyncEngine = engine):
+    """Применяет все ещё не применённые миграции."""
+    async with db_engine.connect() as conn:
+        is_postgres = conn.dialect.name == "postgresql"
+        if is_postgres:
+            await conn.execute(text("SELECT pg_advisory_lock(:id)"), {"id": MIGRATION_LOCK_ID})
+            await conn.commit()
+        try:
+            async with conn.begin():
+                await conn.run_sync(schema_migrations.create, checkfirst=True)
+                applied = set(await conn.scalars(select(schema_migrations.c.version)))
+
+            for version, name, migrate in MIGRATIONS:
+                if version in applied:
+                    continue
+                async with conn.begin():
+                    await conn.run_sync(migrate)
+                    await conn.execute(insert(schema_migrations).values(version=version, name=name))
+                logger.info("Применена миграция %s: %s", version, name)
+        finally:
+            if is_postgres:
+                await conn.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": MIGRATION_LOCK_ID})
+                await conn.commit()
+
+
+def _hot_queries() -> dict:
+    """Горячие запросы бота (литеральные параметры — для EXPLAIN)."""
+    week_start, week_end = literal_column("'2026-01-05'"), literal_column("'2026-01-12'")
+    return {
+        "questions by league and difficulty": select(Question.id).where(
+            Question.league == LeagueEnum.Bronze, Question.difficulty == DifficultyEnum.Easy
+        ),
+        "weekly games of a league": select(Game.user_id, func.sum(Game.score)).where(
+            Game.league == LeagueEnum.Bronze, Game.created_at >= week_start, Game.created_at < week_end
+        ).group_by(Game.user_id),
+        "games of a user": select(Game.id).where(Game.user_id == 1),
+        "weekly proposed questions": select(
+            ProposedQuestion.created_by_user_id, func.count(ProposedQuestion.id)
+        ).where(
+            ProposedQuestion.created_at >= week_start, ProposedQuestion.created_at < week_end
+        ).group_by(ProposedQuestion.created_by_user_id),
+        "exchange rate of a pair": select(ExchangeRates.rate).where(
+            ExchangeRates.from_currency == "rubles", ExchangeRates.to_currency == "gold"
+        ),
+        "transaction by payment id": select(Transaction.id).where(Transaction.payment_id == "payment"),
+        "unapplied coin ledger entries": select(CoinLedger.id).where(CoinLedger.applied.is_(False)),
+        "unapplied coin ledger of a user": select(CoinLedger.id).where(
+            CoinLedger.user_id == 1, CoinLedger.applied.is_(False)
+        ),
+        "weekly league rating": select(WeeklyScore.user_id, WeeklyScore.total_score).where(
+            WeeklyScore.week == "2026-W02", WeeklyScore.league == LeagueEnum.Bronze
+        ),
+    }
+
+
+def _uses_index(dialect: str, plan: str) -> bool:
+    if dialect == "postgresql":
+        return "Index" in plan
+    return "USING" in plan and ("INDEX" in plan or "PRIMARY KEY" in plan)
+
+
+async def check_query_plans(db_engine: AsyncEngine = engine) -> dict[str, str]:
+    """
+    Выполняет EXPLAIN для горячих запросов и проверяет, что каждый использует индекс.
+
+    Returns:
+        dict: Название запроса -> план.
+
+    Raises:
+        AssertionError: Если какой-то запрос выполняется полным сканированием таблицы.
+    """
+    plans = {}
+    async with db_engine.connect() as conn:
+        dialect = conn.dialect.name
+        prefix = "EXPLAIN QUERY PLAN " if dialect == "sqlite" else "EXPLAIN "
+        async with conn.begin():
+            if dialect == "postgresql":
+                # На маленьких таблицах планировщик предпочитает seq scan даже при наличии индекса
+                await conn.execute(text("SET LOCAL enable_seqscan = off"))
+            for name, query in _hot_queries().items():
+                sql = str(query.compile(conn, compile_kwargs={"literal_binds": True}))
+                rows = (await conn.exec_driver_sql(prefix + sql)).all()
+                plans[name] = "\n".join(str(row[-1]) for row in rows)
+
+    missing = [name for name, plan in plans.items() if not _uses_index(dialect, plan)]
+    assert not missing, "Запросы без индекса: " + "; ".join(f"{name}: {plans[name]}" for name in missing)
+    return plans
+
+
+async def main():
+    await run_migrations()
+    if "--check-plans" in sys.argv:
+        for name, plan in (await check_query_plans()).items():
+            print(f"{name}:\n{plan}\n")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
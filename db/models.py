@@ -3,7 +3,7 @@ import os
 from enum import Enum as PyEnum
 
 from sqlalchemy import (
-    Column, Integer, String, ForeignKey, Boolean, Float, DateTime, Enum, Table, func, BigInteger
+    Column, Integer, String, ForeignKey, Boolean, Float, DateTime, Enum, Table, func, BigInteger, Index, text
 )
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
 from sqlalchemy.orm import relationship, declarative_base, sessionmaker
@@ -58,7 +58,13 @@ user_referrals = Table(
 user_subscriptions = Table(
     'user_subscriptions', Base.metadata,
     Column('user_id', BigInteger, ForeignKey('users.id'), primary_key=True),
-    Column('channel_id', BigInteger, ForeignKey('sponsor_channels.id'), primary_key=True)
+    Column('channel_id', BigInteger, ForeignKey('sponsor_channels.id'), primary_key=True),
+    Column('subscribed_at', DateTime(timezone=True), server_default=func.now()),
+    Column('checked_at', DateTime(timezone=True), nullable=True),  # Последняя повторная проверка подписки
+    Column('unsubscribed_at', DateTime(timezone=True), nullable=True),  # Когда обнаружена отписка
+    Column('claimed_until', DateTime(timezone=True), nullable=True),  # Подписку перепроверяет другой процесс
+    # Очередь повторной проверки: сначала недавние подписчики
+    Index('ix_user_subscriptions_subscribed_at', 'subscribed_at'),
 )
 
 
@@ -101,6 +107,10 @@ class BaseQuestion(Base):
 
 class Question(BaseQuestion):
     __tablename__ = 'questions'
+    __table_args__ = (
+        # Выборка вопросов по лиге и сложности
+        Index('ix_questions_league_difficulty', 'league', 'difficulty'),
+    )
 
 
 class ProposedQuestion(Base):
@@ -117,6 +127,11 @@ class ProposedQuestion(Base):
 
     user = relationship('Users', back_populates='proposed_questions')
 
+    __table_args__ = (
+        # Недельный рейтинг предложенных вопросов: диапазон по дате + группировка по автору
+        Index('ix_proposed_questions_created_at_user', 'created_at', 'created_by_user_id'),
+    )
+
 
 class ExchangeRates(Base):
     __tablename__ = "exchange_rates"
@@ -126,12 +141,16 @@ class ExchangeRates(Base):
     to_currency = Column(String, nullable=False)  # Например, "Gold"
     rate = Column(Float, nullable=False)  # Курс обмена (сколько единиц to_currency дают за 1 from_currency)
 
+    __table_args__ = (
+        Index('ix_exchange_rates_pair', 'from_currency', 'to_currency'),
+    )
+
 
 class Game(Base):
     __tablename__ = 'games'
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    user_id = Column(BigInteger, ForeignKey('users.user_id'), nullable=False)
+    user_id = Column(BigInteger, ForeignKey('users.user_id'), nullable=False, index=True)
     league = Column(Enum(LeagueEnum, name='league_enum'), nullable=False)
     score = Column(Integer, default=0)
     created_at = Column(DateTime(timezone=True), server_default=func.timezone('UTC', func.now()))
@@ -139,6 +158,57 @@ class Game(Base):
 
     user = relationship('Users', back_populates='games')
 
+    __table_args__ = (
+        # Игры лиги за неделю с группировкой по игроку
+        Index('ix_games_league_created_at_user_id', 'league', 'created_at', 'user_id'),
+    )
+
+
+class WeeklyScore(Base):
+    """Недельные итоги игрока по лиге (одна строка на игрока вместо строки на каждую игру)."""
+    __tablename__ = 'weekly_scores'
+
+    week = Column(String(8), primary_key=True)  # ISO-неделя по Москве, например "2026-W42"
+    league = Column(Enum(LeagueEnum, name='league_enum'), primary_key=True)
+    user_id = Column(BigInteger, ForeignKey('users.user_id'), primary_key=True)
+    total_score = Column(Integer, nullable=False, default=0)
+    games_played = Column(Integer, nullable=False, default=0)
+
+
+class RatingArchive(Base):
+    """Замороженные итоги недельных рейтингов (одна строка на место в рейтинге)."""
+    __tablename__ = 'rating_archive'
+
+    week = Column(String(8), primary_key=True)
+    category = Column(String(20), primary_key=True)  # Лига или категория активности
+    rank = Column(Integer, primary_key=True)
+    user_id = Column(BigInteger, nullable=False)
+    score = Column(Float, nullable=False)
+
+
+class WeeklyRollover(Base):
+    """Ход закрытия недели: архив, выплата призов, уведомления победителей."""
+    __tablename__ = 'weekly_rollovers'
+
+    week = Column(String(8), primary_key=True)
+    archived_at = Column(DateTime(timezone=True), server_default=func.now())
+    paid_at = Column(DateTime(timezone=True), nullable=True)
+    notified_at = Column(DateTime(timezone=True), nullable=True)
+
+
+class WeeklyPrize(Base):
+    """Призы недели: начисление и очередь уведомлений победителям."""
+    __tablename__ = 'weekly_prizes'
+
+    week = Column(String(8), primary_key=True)
+    league = Column(Enum(LeagueEnum, name='league_enum'), primary_key=True)
+    rank = Column(Integer, primary_key=True)
+    user_id = Column(BigInteger, ForeignKey('users.user_id'), nullable=False)
+    currency = Column(String(10), nullable=False)
+    amount = Column(Integer, nullable=False)
+    paid = Column(Boolean, nullable=False, default=False)
+    notified = Column(Boolean, nullable=False, default=False)
+
 
 class SponsorChannel(Base):
     __tablename__ = 'sponsor_channels'
@@ -164,13 +234,35 @@ class Transaction(Base):
     transaction_type = Column(String(50), nullable=False)  # Тип операции (например, "Пополнение")
     payment_provider = Column(String(50), nullable=False)  # Провайдер платежа ("Telegram Pay")
     fee = Column(Float, nullable=False)  # Комиссия платежной системы
-    payment_id = Column(String(100), nullable=False, index=True)  # Уникальный ID платежа от Telegram
+    payment_id = Column(String(100), nullable=False, unique=True, index=True)  # Уникальный ID платежа от Telegram
     invoice_payload = Column(String(255), nullable=True)  # ID счета (необязательно)
     created_at = Column(DateTime(timezone=True), server_default=func.timezone('UTC', func.now()))  # Дата создания
 
     user = relationship('Users', back_populates='transactions')
 
 
+class CoinLedger(Base):
+    """Журнал всех движений монет (только добавление записей)."""
+    __tablename__ = 'coin_ledger'
+    __table_args__ = (
+        # Неучтённые записи: перенос в балансы и read-through по пользователю
+        # без полного просмотра журнала, который только растёт. Условие записано
+        # так же, как его компилирует applied.is_(False) в запросах журнала
+        Index(
+            'ix_coin_ledger_unapplied_user_id', 'user_id',
+            postgresql_where=text('applied IS false'), sqlite_where=text('applied IS 0')
+        ),
+    )
+
+    id = Column(BigInteger().with_variant(Integer, 'sqlite'), primary_key=True, autoincrement=True)
+    user_id = Column(BigInteger, ForeignKey('users.user_id'), nullable=False, index=True)
+    currency = Column(String(10), nullable=False)  # "rubles", "silver", "gold"...
+    amount = Column(Float, nullable=False)  # Положительное — начисление, отрицательное — списание
+    reason = Column(String(50), nullable=False)  # Причина: награда за игру, вход в лигу, реферал...
+    applied = Column(Boolean, nullable=False, default=False)  # Учтено ли в Users.balance_*
+    created_at = Column(DateTime(timezone=True), server_default=func.timezone('UTC', func.now()))
+
+
 # Добавляем связь с транзакциями к пользователям
 Users.transactions = relationship('Transaction', back_populates='user')
 
@@ -5,16 +5,18 @@ from aiogram.filters import StateFilter, callback_data
 from aiogram.fsm.storage.redis import RedisStorage, Redis
 from aiogram.types import CallbackQuery
 from aiogram.fsm.context import FSMContext
+from sqlalchemy.ext.asyncio import AsyncSession
 
+from config_data.config import Config, load_config
 from db.db_functions import add_question_to_db
-from services.FSM import AddQuestionState
+from services.FSM import AddQuestionState, BroadcastState
 from lexicon.lexicon_ru import LEXICON_RU
-from keyboards.keyboards import admin_kb_league, admin_kb_select_level, add_or_cancel, admin_kb
+from keyboards.keyboards import admin_kb_league, admin_kb_select_level, add_or_cancel, admin_kb, broadcast_confirm_kb
 from services import filters as f
-from db.models import AsyncSessionLocal
+from services.broadcast import broadcaster
 
 router = Router()
-session = AsyncSessionLocal()
+config: Config = load_config()
 
 
 # --------------------Обрабатываем нажатие кнопки "добавить вопрос"------------------------------------------
@@ -86,7 +88,7 @@ async def enter_answer_var4(message: Message, state: FSMContext):
 
 #__Проверяем введенный вопрос и ответы и добавляем в базу данных__
 @router.callback_query(AddQuestionState.check_and_add_question)
-async def check_and_add_question(call: CallbackQuery, state: FSMContext):
+async def check_and_add_question(call: CallbackQuery, state: FSMContext, session: AsyncSession):
     if call.data == 'cancel':
         await call.message.answer(text="Операция отменена.")
         await state.clear()
@@ -120,7 +122,7 @@ async def check_and_add_question(call: CallbackQuery, state: FSMContext):
 
     # Запуск функции добавления в базу данных
     try:
-        add_question_to_db(
+        await add_question_to_db(
             session=session,
             league=league,
             difficulty=level,
@@ -145,5 +147,36 @@ async def check_and_add_question(call: CallbackQuery, state: FSMContext):
     await call.answer()
 
 
+# --------------------Рассылка сообщения всем пользователям------------------------------------------
+@router.callback_query(f.SendMessageCallbackData.filter())
+async def send_message(call: CallbackQuery, state: FSMContext):
+    if call.from_user.id not in config.tg_bot.admin_ids:
+        await call.answer()
+        return
+    await call.message.answer(text=LEXICON_RU['write_your_message'])
+    await call.answer()
+    await state.set_state(BroadcastState.waiting_for_text)
+
+
+#__Пишем текст рассылки и показываем его для проверки__
+@router.message(BroadcastState.waiting_for_text)
+async def enter_broadcast_text(message: Message, state: FSMContext):
+    await state.update_data(text=message.html_text)  # Запоминаем текст с форматированием
+    await message.answer(text=message.html_text)
+    await message.answer(text=LEXICON_RU['check_broadcast'], reply_markup=broadcast_confirm_kb)
+    await state.set_state(BroadcastState.confirm)
 
 
+#__Запускаем рассылку после подтверждения__
+@router.callback_query(BroadcastState.confirm)
+async def confirm_broadcast(call: CallbackQuery, state: FSMContext):
+    data = await state.get_data()
+    await state.clear()
+    await call.answer()
+    if call.data != 'broadcast' or not data.get('text'):
+        await call.message.answer(text="Операция отменена.", reply_markup=admin_kb)
+        return
+
+    await call.message.answer(text=LEXICON_RU['broadcast_started'])
+    # Рассылка идёт в фоне; прогресс обновляется в отдельном сообщении
+    await broadcaster.start(call.bot, call.message.chat.id, data['text'])
@@ -7,16 +7,17 @@ from aiogram import Router, F
 from aiogram.fsm.context import FSMContext
 from aiogram.filters import StateFilter
 from aiogram.types import CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup
-from sqlalchemy import select
-from sqlalchemy.ext.asyncio import AsyncSession
 
-from db.db_functions import update_user_balance
-from db.models import Users
 from keyboards.keyboards import main_kb
-from middleware.game_mdwr import CallbackQueryMiddleware
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from middleware.game_mdwr import CallbackQueryMiddleware, DB_COMMIT
 from services.FSM import ProcessGameState
 
-from services.game import send_next_question, SCORE_TABLE
+from services.game_state import GameSession
+from services.ledger import ledger, LEDGER_GAME_REWARD
+from services.game import (send_next_question, get_current_question, finish_game, SCORE_TABLE,
+                           HINT_INSURE, HINT_REMOVE_TWO, SINGLE_MESSAGE)
 
 logger = logging.getLogger(__name__)
 router = Router()
@@ -25,15 +26,26 @@ callback_query_middleware = CallbackQueryMiddleware()
 router.callback_query.middleware(callback_query_middleware)
 
 
-@router.callback_query(F.data.startswith("answer:"), StateFilter(ProcessGameState.waiting_for_answer))
+@router.callback_query(F.data.startswith("answer:"), StateFilter(ProcessGameState.waiting_for_answer),
+                       flags={"db": DB_COMMIT})
 async def process_answer(callback: CallbackQuery, state: FSMContext, session: AsyncSession):
-    data = await state.get_data()
-    current_question = data["current_question"]
-    correct_answer = current_question["correct_answer"]
-    answers = data["answers"]
+    """
+    Обработчик ответа на вопрос.
+
+    Возвращает callback.answer() вместо вызова: в режиме webhook ответ на
+    callback уходит в теле ответа на апдейт, без отдельного запроса к Bot API.
+    """
+    game = await GameSession.load(state)
+    data = game.data
+    current_question, answers = await get_current_question(data)
+    if current_question is None:
+        await callback.answer("Игра не найдена. Начните новую игру.", show_alert=True)
+        await game.clear()
+        return
+    correct_answer = current_question.correct_answer
 
     # ✅ Получаем индекс текущего вопроса (важно!)
-    question_index = data.get("question_index", 0)
+    question_index = data.get("cursor", 0)
 
     try:
         answer_index = int(callback.data.split(":")[2])
@@ -43,38 +55,48 @@ async def process_answer(callback: CallbackQuery, state: FSMContext, session: As
             # ✅ Присваиваем баллы за текущий вопрос
             current_score = SCORE_TABLE[question_index] if question_index < len(SCORE_TABLE) else 0
 
-            # ✅ Обновляем состояние с новым количеством баллов
-            await state.update_data(current_score=current_score, question_index=question_index + 1)
+            # ✅ Обновляем состояние с новым количеством баллов (запишется вместе со следующим вопросом)
+            data.update(score=current_score, cursor=question_index + 1)
 
-            await callback.message.edit_text(f"Правильно! Ваши баллы: {current_score}")
+            if question_index + 1 >= len(data.get("question_ids", [])):
+                # Это был последний вопрос — фиксируем результат игры
+                await finish_game(session, game, callback.from_user.id, current_score)
 
-            # Отправляем следующий вопрос
-            await send_next_question(callback.message.answer, state)
+            success_message = f"Правильно! Ваши баллы: {current_score}"
+            if SINGLE_MESSAGE:
+                # Следующий вопрос заменяет текущий в том же сообщении
+                await send_next_question(callback.message.edit_text, game, success_message=success_message)
+            else:
+                await callback.message.edit_text(success_message)
+                await send_next_question(callback.message.answer, game)
         else:
             # ✅ Проверяем страховку
-            hints_used = data.get("hints_used", {})
-            guaranteed_score = data.get("guaranteed_score", 0)
+            hints = data.get("hints", 0)
+            guaranteed_score = data.get("guaranteed", 0)
 
-            if hints_used.get("insure"):
+            if hints & HINT_INSURE:
                 final_score = guaranteed_score
                 await callback.message.edit_text(
                     text=f"Неправильно. Правильный ответ: {correct_answer}. "
                     f"Вы застраховали сумму: {final_score}!",
                     reply_markup=main_kb
                 )
-                await update_user_balance(callback.from_user.id, final_score, "silver", session)
+                ledger.record(callback.from_user.id, "silver", final_score, LEDGER_GAME_REWARD)
             else:
                 final_score = 0
                 await callback.message.edit_text(
                     text=f"Неправильно. Правильный ответ: {correct_answer}. Ваш выигрыш: {final_score}.",
                     reply_markup=main_kb)
 
-            await state.clear()  # Завершаем игру
+            await finish_game(session, game, callback.from_user.id, final_score)
+            await game.clear()  # Завершаем игру
 
     except (ValueError, IndexError) as e:
         logger.error(f"Ошибка при обработке ответа: {e}")
         await callback.message.answer("Произошла ошибка. Попробуйте снова.")
 
+    return callback.answer()
+
 
 async def wait_for_callback_query(user_id: int) -> Optional[CallbackQuery]:
     """
@@ -101,32 +123,39 @@ async def wait_for_callback_query(user_id: int) -> Optional[CallbackQuery]:
 @router.callback_query(F.data == "hint:hint_insure", StateFilter(ProcessGameState.waiting_for_answer))
 async def hint_insure(callback: CallbackQuery, state: FSMContext):
     """Обработчик кнопки 'Застраховать сумму'."""
-    data = await state.get_data()
+    game = await GameSession.load(state)
+    data = game.data
+    hints = data.get("hints", 0)
 
-    if data["hints_used"]["insure"]:
+    if hints & HINT_INSURE:
         await callback.answer("Вы уже использовали эту подсказку!", show_alert=True)
         return
 
     # Фиксируем текущий выигрыш
-    guaranteed_score = data["current_score"]
-    data["hints_used"]["insure"] = True
+    guaranteed_score = data.get("score", 0)
 
-    await state.update_data(hints_used=data["hints_used"], guaranteed_score=guaranteed_score)
-    await callback.answer(f"Сумма застрахована: {guaranteed_score} баллов!")
+    data.update(hints=hints | HINT_INSURE, guaranteed=guaranteed_score)
+    await game.flush()
+    return callback.answer(f"Сумма застрахована: {guaranteed_score} баллов!")
 
 
 @router.callback_query(F.data == "hint:hint_remove_two", StateFilter(ProcessGameState.waiting_for_answer))
 async def hint_remove_two(callback: CallbackQuery, state: FSMContext):
     """Обработчик кнопки 'Убрать два неправильных ответа'."""
-    data = await state.get_data()
+    game = await GameSession.load(state)
+    data = game.data
+    hints = data.get("hints", 0)
 
-    if data["hints_used"]["remove_two"]:
+    if hints & HINT_REMOVE_TWO:
         await callback.answer("Вы уже использовали эту подсказку!", show_alert=True)
         return
 
-    current_question = data["current_question"]
-    correct_answer = current_question["correct_answer"]
-    all_answers = data["answers"]  # Это список из 4-х ответов в текущем вопросе
+    # all_answers — список из 4-х ответов в текущем вопросе
+    current_question, all_answers = await get_current_question(data)
+    if current_question is None:
+        await callback.answer("Игра не найдена. Начните новую игру.", show_alert=True)
+        return
+    correct_answer = current_question.correct_answer
 
     # Определяем индексы всех неправильных ответов
     incorrect_indices = [i for i, ans in enumerate(all_answers) if ans != correct_answer]
@@ -139,14 +168,14 @@ async def hint_remove_two(callback: CallbackQuery, state: FSMContext):
 
     # Создаём новую клавиатуру только с оставшимися вариантами
     answer_buttons = [
-        InlineKeyboardButton(text=chr(65 + i), callback_data=f"answer:{current_question['id']}:{i}")
+        InlineKeyboardButton(text=chr(65 + i), callback_data=f"answer:{current_question.id}:{i}")
         for i in remaining_indices
     ]
     keyboard = InlineKeyboardMarkup(inline_keyboard=[answer_buttons])
 
-    # Обновляем состояние, чтобы обработчик ответов знал, какие варианты остались
-    data["hints_used"]["remove_two"] = True
-    await state.update_data(hints_used=data["hints_used"], remaining_indices=remaining_indices)
+    # Отмечаем подсказку как использованную (порядок ответов выводится из seed и не меняется)
+    data["hints"] = hints | HINT_REMOVE_TWO
+    await game.flush()
 
     # Обновляем сообщение с урезанными вариантами
     filtered_answers = [all_answers[i] for i in remaining_indices]
@@ -155,32 +184,27 @@ async def hint_remove_two(callback: CallbackQuery, state: FSMContext):
     )
 
     await callback.message.edit_text(
-        f"Вопрос: {current_question['question_text']}\n\n{formatted_answers}",
+        f"Вопрос: {current_question.question_text}\n\n{formatted_answers}",
         reply_markup=keyboard
     )
-    await callback.answer("Удалены два неверных ответа!")
+    return callback.answer("Удалены два неверных ответа!")
 
 
-@router.callback_query(F.data == "hint:hint_take_money", StateFilter(ProcessGameState.waiting_for_answer))
+@router.callback_query(F.data == "hint:hint_take_money", StateFilter(ProcessGameState.waiting_for_answer),
+                       flags={"db": DB_COMMIT})
 async def hint_take_money(callback: CallbackQuery, state: FSMContext, session: AsyncSession):
     """Обработчик кнопки 'Забрать выигрыш'."""
-    data = await state.get_data()
+    game = await GameSession.load(state)
     user_id = callback.from_user.id
-    current_score = data["current_score"]
-
-    # Обновляем баланс пользователя
-    result = await session.execute(select(Users).where(Users.user_id == user_id))
-    user = result.scalars().first()
-
-    if not user:
-        await callback.answer("Ошибка: пользователь не найден!", show_alert=True)
-        return
+    current_score = game.data.get("score", 0)
 
-    user.balance_silver += current_score
-    await session.commit()
+    # Начисляем выигрыш через журнал монет (в баланс попадёт пакетом)
+    ledger.record(user_id, "silver", current_score, LEDGER_GAME_REWARD)
+    await finish_game(session, game, user_id, current_score)
 
     await callback.message.edit_text(f"Игра завершена! Вы заработали {current_score} баллов.", reply_markup=main_kb)
-    await state.clear()
+    await game.clear()
+    return callback.answer()
 
 
 # @router.callback_query()
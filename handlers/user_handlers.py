@@ -2,29 +2,35 @@ import logging
 
 from datetime import datetime
 
+import pytz
+
 from aiogram import Router, F, Bot
 from aiogram.enums import ContentType
-from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.types import CallbackQuery, Message, InlineKeyboardMarkup, InlineKeyboardButton, PreCheckoutQuery, \
     LabeledPrice
 from aiogram_dialog import DialogManager, StartMode
-from sqlalchemy import select
+from sqlalchemy import select, update, func
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from config_data.config import PAY_TOKEN
-from db.db_functions import get_exchange_rates
-from db.models import AsyncSessionLocal, Users, ExchangeRates, ProposedQuestion, SponsorChannel, user_subscriptions, \
+from db.db_functions import get_exchange_rates, credit_balance, exchange_balance
+from db.models import Users, ExchangeRates, ProposedQuestion, SponsorChannel, user_subscriptions, \
     Transaction
 from keyboards.keyboards import (main_kb, account_kb, get_balance_keyboard, exchange_kb, earn_coins_kb,
                                  add_or_cancel, top_up_keyboard, certificate_keyboard)
 from lexicon.lexicon_ru import LEXICON_RU
+from middleware.throttling import THROTTLE_GAME, THROTTLE_RATING, THROTTLE_SUBSCRIPTION
 from services import filters as f, game
 from services.FSM import DialogStates, ExchangeStates, ProposeQuestionState
 from services.filters import StartGameCallbackData, BalanceCallbackData, ExchangeCallbackData, \
     ExchangeButtonCallbackData
 from services.game import start_game
+from services.leaderboard import leaderboard, CATEGORY_QUESTIONS, CATEGORY_SUBSCRIPTIONS
+from services.ledger import ledger, LEDGER_EXCHANGE, LEDGER_PAYMENT, LEDGER_SUBSCRIPTION
+from services.sponsor_channels import sponsor_registry
 from services.services import process_telegram_pay, process_telegram_stars, get_yookassa_receipt
 from services.user_dialog import rating_router
 
@@ -65,91 +71,52 @@ async def process_help_command(callback: CallbackQuery):
 
 
 # ______________________Хэндлеры для выбора лиги___________________________________
-@router.callback_query(StartGameCallbackData.filter())
-async def handle_start_game(call: CallbackQuery, callback_data: StartGameCallbackData, state: FSMContext):
-    # Обработчик нажатия кнопки "Бронзовая лига".
-    if callback_data.league == "Bronze":
-        league = callback_data.league
-        user_id = call.from_user.id
-
-        async with AsyncSessionLocal() as session:
-            try:
-                # Отправляем сообщение о начале игры
-                await call.message.edit_reply_markup()  # Убираем клавиатуру из сообщения
-                await call.message.answer(f"Игра в {league} лиге начинается!")
-
-                # Вызываем функцию старта игры
-                await start_game(
-                    session=session,
-                    user_id=user_id,
-                    league=league,
-                    send_message=call.message.answer,
-                    router=game.router,
-                    state=state
-                )
-
-            except Exception as e:
-                # Логируем ошибку и отправляем пользователю сообщение
-                logger.error(f"Ошибка при запуске игры: {e}")
-                await call.message.answer("Произошла ошибка при запуске игры. Попробуйте позже.")
-
-    # Обработчик нажатия кнопки "Серебряная лига".
-
-    if callback_data.league == "Silver":
-        league = callback_data.league
-        user_id = call.from_user.id
-
-        async with AsyncSessionLocal() as session:
-            try:
-                # Отправляем сообщение о начале игры
-                await call.message.edit_reply_markup()  # Убираем клавиатуру из сообщения
-                await call.message.answer(f"Игра в {league} лиге начинается!")
-
-                # Вызываем функцию старта игры
-                await start_game(
-                    session=session,
-                    user_id=user_id,
-                    league=league,
-                    send_message=call.message.answer,
-                    router=game.router,
-                    state=state
-                )
-
-            except Exception as e:
-                # Логируем ошибку и отправляем пользователю сообщение
-                logger.error(f"Ошибка при запуске игры: {e}")
-                await call.message.answer("Произошла ошибка при запуске игры. Попробуйте позже.")
-
-    # Обработчик нажатия кнопки "Золотая лига".
-
-    if callback_data.league == "Gold":
-        league = callback_data.league
-        user_id = call.from_user.id
-
-        async with AsyncSessionLocal() as session:
-            try:
-                # Отправляем сообщение о начале игры
-                await call.message.edit_reply_markup()  # Убираем клавиатуру из сообщения
-                await call.message.answer(f"Игра в {league} лиге начинается!")
-
-                # Вызываем функцию старта игры
-                await start_game(
-                    session=session,
-                    user_id=user_id,
-                    league=league,
-                    send_message=call.message.answer,
-                    router=game.router,
-                    state=state
-                )
-
-            except Exception as e:
-                # Логируем ошибку и отправляем пользователю сообщение
-                logger.error(f"Ошибка при запуске игры: {e}")
-                await call.message.answer("Произошла ошибка при запуске игры. Попробуйте позже.")
+@router.callback_query(StartGameCallbackData.filter(), flags={"throttle": THROTTLE_GAME})
+async def handle_start_game(call: CallbackQuery, callback_data: StartGameCallbackData, state: FSMContext,
+                            session: AsyncSession):
+    # Обработчик нажатия кнопок "Бронзовая лига", "Серебряная лига" и "Золотая лига".
+    if callback_data.league not in game.LEAGUE_SETTINGS:
+        return
+
+    league = callback_data.league
+    user_id = call.from_user.id
+
+    try:
+        if game.SINGLE_MESSAGE:
+            # Меню выбора лиги превращается в первый вопрос одним редактированием
+            await start_game(
+                session=session,
+                user_id=user_id,
+                league=league,
+                send_message=call.message.edit_text,
+                router=game.router,
+                state=state,
+                intro=f"Игра в {league} лиге начинается!"
+            )
+            return call.answer()
+
+        # Отправляем сообщение о начале игры
+        await call.message.edit_reply_markup()  # Убираем клавиатуру из сообщения
+        await call.message.answer(f"Игра в {league} лиге начинается!")
+
+        # Вызываем функцию старта игры (используем сессию, созданную DatabaseMiddleware)
+        await start_game(
+            session=session,
+            user_id=user_id,
+            league=league,
+            send_message=call.message.answer,
+            router=game.router,
+            state=state
+        )
+
+    except Exception as e:
+        # Логируем ошибку и отправляем пользователю сообщение
+        logger.error(f"Ошибка при запуске игры: {e}")
+        await call.message.answer("Произошла ошибка при запуске игры. Попробуйте позже.")
 
 
 # Обработчик для запуска диалога рейтинга
-@rating_router.callback_query(F.data == "user_rate")
+@rating_router.callback_query(F.data == "user_rate", flags={"throttle": THROTTLE_RATING})
 async def start_rating_dialog(callback: CallbackQuery, dialog_manager: DialogManager):
     await callback.message.delete()
     await dialog_manager.start(state=DialogStates.rating, mode=StartMode.RESET_STACK)
@@ -158,23 +125,24 @@ async def start_rating_dialog(callback: CallbackQuery, dialog_manager: DialogMan
 
 # Обработчик кнопки "Баланс"
 @router.callback_query(BalanceCallbackData.filter())
-async def show_balance(callback: CallbackQuery):
+async def show_balance(callback: CallbackQuery, session: AsyncSession):
     user_id = callback.from_user.id
 
-    async with AsyncSessionLocal() as session:
-        result = await session.execute(select(Users).where(Users.user_id == user_id))
-        user = result.scalars().first()
-
-        if user:
-            balance_text = (
-                f"💰 *Ваш баланс:*\n"
-                # f"🥉 *Бронзовые монеты:* {user.balance_bronze}\n"
-                f"🥈 *Серебряные монеты:* {user.balance_silver}\n"
-                f"🥇 *Золотые монеты:* {user.balance_gold}\n"
-                f"💵 *Рубли:* {user.balance_rubles:.2f}₽"
-            )
-        else:
-            balance_text = "❌ Ошибка: Ваш профиль не найден в базе данных."
+    result = await session.execute(select(Users).where(Users.user_id == user_id))
+    user = result.scalars().first()
+
+    if user:
+        # Баланс = учтённая часть + ещё не перенесённые начисления из журнала монет
+        pending = await ledger.pending(session, user_id)
+        balance_text = (
+            f"💰 *Ваш баланс:*\n"
+            # f"🥉 *Бронзовые монеты:* {user.balance_bronze}\n"
+            f"🥈 *Серебряные монеты:* {int(user.balance_silver + pending['silver'])}\n"
+            f"🥇 *Золотые монеты:* {int(user.balance_gold + pending['gold'])}\n"
+            f"💵 *Рубли:* {user.balance_rubles + pending['rubles']:.2f}₽"
+        )
+    else:
+        balance_text = "❌ Ошибка: Ваш профиль не найден в базе данных."
 
     await callback.message.edit_text(
         balance_text,
@@ -257,15 +225,8 @@ async def successful_certificate_payment(message: Message, session: AsyncSession
     cert_amount = data.get("cert_amount", total_amount)
 
     # Обновляем баланс пользователя
-    result = await session.execute(select(Users).filter_by(user_id=user_id))
-    user = result.scalars().first()
-
-    if user:
-        user.balance_rubles += credited_amount
-        session.add(user)
-        await session.commit()
-
-        # Записываем транзакцию
+    if await credit_balance(session, user_id, "rubles", credited_amount) is not None:
+        # Записываем транзакцию (коммитим вместе с пополнением баланса)
         transaction = Transaction(
             user_id=user_id,
             amount=total_amount,
@@ -278,7 +239,14 @@ async def successful_certificate_payment(message: Message, session: AsyncSession
             invoice_payload=invoice_payload
         )
         session.add(transaction)
-        await session.commit()
+        try:
+            await session.commit()
+        except IntegrityError:
+            # Повторная доставка того же платежа: уникальный payment_id не даёт зачислить его дважды
+            await session.rollback()
+            logger.warning("Платёж %s уже зачислен", payment_info.provider_payment_charge_id)
+            return
+        ledger.record(user_id, "rubles", credited_amount, LEDGER_PAYMENT, applied=True)
 
         # Отправляем сообщение о зачислении
         await message.answer(
@@ -431,11 +399,6 @@ async def cancel_exchange(callback: CallbackQuery, state: FSMContext):
 async def process_exchange(message: Message, state: FSMContext, session: AsyncSession):
     """Обрабатывает ввод суммы и выполняет обмен."""
     user_id = message.from_user.id
-    user = await session.scalar(select(Users).where(Users.user_id == user_id))
-
-    if not user:
-        await message.answer("⚠️ Ошибка: пользователь не найден.", reply_markup=exchange_kb)
-        return
 
     data = await state.get_data()
     from_currency = data["from_currency"]
@@ -449,12 +412,6 @@ async def process_exchange(message: Message, state: FSMContext, session: AsyncSe
         await message.answer("⚠️ Введите корректную сумму.\n Например, 0.6 (разделитель 'точка')")
         return
 
-    # Проверяем баланс пользователя
-    user_balance = getattr(user, f"balance_{from_currency.lower()}")
-    if amount > user_balance:
-        await message.answer("⚠️ Недостаточно средств для обмена.", reply_markup=exchange_kb)
-        return
-
     # Получаем актуальный курс обмена
     rate = await session.scalar(select(ExchangeRates).filter_by(from_currency=from_currency, to_currency=to_currency))
     if not rate:
@@ -464,11 +421,18 @@ async def process_exchange(message: Message, state: FSMContext, session: AsyncSe
     # Рассчитываем сумму после обмена
     exchanged_amount = amount * rate.rate
 
-    # Обновляем баланс пользователя
-    setattr(user, f"balance_{from_currency.lower()}", user_balance - amount)
-    setattr(user, f"balance_{to_currency.lower()}", getattr(user, f"balance_{to_currency.lower()}") + exchanged_amount)
+    # Проверка баланса, списание и зачисление — один условный UPDATE
+    balances = await exchange_balance(session, user_id, from_currency, to_currency, amount, rate.rate)
+    if balances is None and await ledger.settle_user(session, user_id):
+        # Учитываем свежие начисления из журнала монет и пробуем ещё раз
+        balances = await exchange_balance(session, user_id, from_currency, to_currency, amount, rate.rate)
+    if balances is None:
+        await message.answer("⚠️ Недостаточно средств для обмена.", reply_markup=exchange_kb)
+        return
 
     await session.commit()
+    ledger.record(user_id, from_currency, -amount, LEDGER_EXCHANGE, applied=True)
+    ledger.record(user_id, to_currency, exchanged_amount, LEDGER_EXCHANGE, applied=True)
 
     await message.answer(text=f"✅ Обмен успешно завершён!\n"
                               f"{amount} {from_currency} → {exchanged_amount:.2f} {to_currency}",
@@ -564,6 +528,7 @@ async def check_and_add_proposed_question(callback: CallbackQuery, state: FSMCon
     logger.info(f"Adding question: {new_question}")
     session.add(new_question)
     await session.commit()
+    await leaderboard.increment(CATEGORY_QUESTIONS, user_id)
 
     await callback.message.answer("✅ Ваш вопрос отправлен на модерацию! Спасибо за участие.",
                                   reply_markup=earn_coins_kb)
@@ -583,9 +548,10 @@ async def show_sponsor_channels(callback: CallbackQuery, session: AsyncSession):
         await callback.answer("Сейчас нет доступных спонсорских каналов.", show_alert=True)
         return
 
-    # Получаем список каналов, на которые подписан пользователь
+    # Получаем список каналов, на которые подписан пользователь (без обнаруженных отписок)
     sub_result = await session.execute(select(user_subscriptions.c.channel_id)
-                                       .where(user_subscriptions.c.user_id == user_id))
+                                       .where(user_subscriptions.c.user_id == user_id,
+                                              user_subscriptions.c.unsubscribed_at.is_(None)))
     subscribed_channels = {row[0] for row in sub_result.fetchall()}
 
     # Формируем клавиатуру с кнопками (отмечаем подписанные каналы)
@@ -611,7 +577,7 @@ async def show_sponsor_channels(callback: CallbackQuery, session: AsyncSession):
     )
 
 
-@router.callback_query(lambda c: c.data == "check_subscription")
+@router.callback_query(lambda c: c.data == "check_subscription", flags={"throttle": THROTTLE_SUBSCRIPTION})
 async def check_subscription(callback: CallbackQuery, session: AsyncSession, bot: Bot):
     user_id = callback.from_user.id
 
@@ -623,50 +589,49 @@ async def check_subscription(callback: CallbackQuery, session: AsyncSession, bot
         await callback.answer("Нет доступных спонсорских каналов.", show_alert=True)
         return
 
-    new_subscriptions = []  # Список новых подписок
-
-    for channel in sponsor_channels:
-        chat_id = channel.link.replace("https://t.me/", "").replace("/", "")
-
-        try:
-            chat_member = await bot.get_chat_member(chat_id, user_id)
-
-            if chat_member.status in ["member", "administrator", "creator"]:
-                # Проверяем, есть ли уже запись в user_subscriptions
-                existing_subscription = await session.execute(
-                    select(user_subscriptions)
-                    .where(user_subscriptions.c.user_id == user_id,
-                           user_subscriptions.c.channel_id == channel.id)
-                )
-                if not existing_subscription.first():
-                    new_subscriptions.append(channel.id)
-
-        except TelegramBadRequest:
-            continue  # Ошибка запроса — канал недоступен или бот не админ
+    # Уже засчитанные подписки пользователя — одним запросом
+    sub_result = await session.execute(select(user_subscriptions.c.channel_id, user_subscriptions.c.unsubscribed_at)
+                                       .where(user_subscriptions.c.user_id == user_id))
+    rewarded_channels = dict(sub_result.fetchall())  # ID канала -> когда обнаружена отписка
+    subscribed_channels = {channel_id for channel_id, left in rewarded_channels.items() if left is None}
+
+    # Проверяем только каналы без действующей подписки (вердикты кешируются в Redis)
+    unchecked = [channel for channel in sponsor_channels if channel.id not in subscribed_channels]
+    verdicts = await sponsor_registry.check(bot, unchecked, user_id)
+    new_subscriptions = [channel.id for channel in unchecked
+                         if verdicts[channel.id] and channel.id not in rewarded_channels]
+    # Повторная подписка после отписки восстанавливает запись, но не награду
+    returned = [channel.id for channel in unchecked if verdicts[channel.id] and channel.id in rewarded_channels]
+
+    if returned:
+        await session.execute(
+            update(user_subscriptions)
+            .where(user_subscriptions.c.user_id == user_id, user_subscriptions.c.channel_id.in_(returned))
+            .values(unsubscribed_at=None, checked_at=func.now())
+        )
+        await session.commit()
+        subscribed_channels.update(returned)
 
     if new_subscriptions:
-        # Записываем новые подписки в user_subscriptions
-        for channel_id in new_subscriptions:
-            await session.execute(user_subscriptions.insert().values(user_id=user_id, channel_id=channel_id))
-
-        # Начисляем 100 серебряных монет за каждую подписку
-        user = await session.execute(select(Users).where(Users.user_id == user_id))
-        user = user.scalars().first()
-        if user:
-            user.balance_silver += 100 * len(new_subscriptions)
-
+        # Записываем новые подписки в user_subscriptions одним многострочным INSERT
+        now = datetime.now(pytz.utc)
+        await session.execute(
+            user_subscriptions.insert(),
+            [{"user_id": user_id, "channel_id": channel_id, "subscribed_at": now}
+             for channel_id in new_subscriptions]
+        )
         await session.commit()
+        subscribed_channels.update(new_subscriptions)
+
+        # Начисляем 100 серебряных монет за каждую подписку через журнал монет
+        ledger.record(user_id, "silver", 100 * len(new_subscriptions), LEDGER_SUBSCRIPTION)
+        await leaderboard.increment(CATEGORY_SUBSCRIPTIONS, user_id, len(new_subscriptions))
         await callback.answer(f"Вы подписались на {len(new_subscriptions)} канал(а), начислено "
                               f"{100 * len(new_subscriptions)} серебряных монет!", show_alert=True)
 
     else:
         await callback.answer("Вы уже подписаны на все каналы.", show_alert=True)
 
-    # Получаем актуальный список подписок после проверки
-    sub_result = await session.execute(select(user_subscriptions.c.channel_id)
-                                       .where(user_subscriptions.c.user_id == user_id))
-    subscribed_channels = {row[0] for row in sub_result.fetchall()}
-
     # Формируем новую клавиатуру с актуальными статусами подписок
     new_keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [
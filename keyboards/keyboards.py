@@ -83,6 +83,18 @@ add_or_cancel = InlineKeyboardMarkup(
     ]
 )
 
+# _____________Клавиатура подтверждения рассылки______________
+broadcast_confirm_kb = InlineKeyboardMarkup(
+    inline_keyboard=[
+        [InlineKeyboardButton(text=LEXICON_RU['send_broadcast'],
+                              callback_data="broadcast"),
+         ],
+        [InlineKeyboardButton(text=LEXICON_RU['cancel'],
+                              callback_data="cancel"),
+         ]
+    ]
+)
+
 # --------------------- Создаем клавиатуры для user -------------------------------------------------
 # ------------ Создаем главную клавиатуру через InlineKeyboardMarkup --------------------------
 
@@ -90,6 +90,9 @@ LEXICON_RU: dict[str, str] = {
     'add': 'Добавить',
     'cancel': 'Отмена',
     'write_your_message': 'Напишите ваше сообщение',
+    'check_broadcast': 'Сообщение получат все активные пользователи. Отправить?',
+    'send_broadcast': 'Отправить',
+    'broadcast_started': 'Рассылка запущена, прогресс — в сообщении ниже',
     'write_your_question': 'Напишите текст вопроса',
     'correct_answer': 'Напишите правильный ответ',
     'answer_var2': 'Напишите второй вариант ответа',
@@ -1,6 +1,7 @@
 import asyncio
 
 from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
 from aiogram.types import CallbackQuery
 from typing import Callable, Awaitable, Dict, Any
 from aiogram.types import TelegramObject
@@ -26,7 +27,42 @@ class CallbackQueryMiddleware(BaseMiddleware):
         return await handler(event, data)
 
 
+# Политики работы с сессией, задаются флагом хэндлера: flags={"db": DB_COMMIT}
+DB_CLOSE = "close"  # только закрыть сессию (незакоммиченное откатывается)
+DB_COMMIT = "commit"  # закоммитить после успешного завершения хэндлера
+
+
+class LazySession:
+    """
+    Ленивая обёртка над AsyncSession.
+
+    Сессия создаётся только при первом обращении к ней из хэндлера, поэтому
+    апдейты, которые не работают с БД, не создают и не закрывают сессию.
+    """
+
+    def __init__(self, sessionmaker: async_sessionmaker[AsyncSession]):
+        self._sessionmaker = sessionmaker
+        self._session: AsyncSession | None = None
+
+    @property
+    def started(self) -> bool:
+        return self._session is not None
+
+    def __getattr__(self, name: str) -> Any:
+        if self._session is None:
+            self._session = self._sessionmaker()
+        return getattr(self._session, name)
+
+
 class DatabaseMiddleware(BaseMiddleware):
+    """
+    Передаёт в хэндлер `session` — ленивую сессию SQLAlchemy.
+
+    Регистрируется как inner-middleware, чтобы видеть флаги хэндлера: при
+    flags={"db": DB_COMMIT} изменения коммитятся после успешной обработки,
+    при ошибке — откатываются.
+    """
+
     def __init__(self, sessionmaker: async_sessionmaker[AsyncSession]):
         super().__init__()
         self.sessionmaker = sessionmaker
@@ -37,6 +73,18 @@ class DatabaseMiddleware(BaseMiddleware):
         event: TelegramObject,
         data: Dict[str, Any]
     ) -> Any:
-        async with self.sessionmaker() as session:
-            data["session"] = session  # Добавляем `session` в `data`
-            return await handler(event, data)
+        policy = get_flag(data, "db", default=DB_CLOSE)
+        session = LazySession(self.sessionmaker)
+        data["session"] = session  # Добавляем `session` в `data`
+        try:
+            result = await handler(event, data)
+            if session.started and policy == DB_COMMIT:
+                await session.commit()
+            return result
+        except Exception:
+            if session.started:
+                await session.rollback()
+            raise
+        finally:
+            if session.started:
+                await session.close()
@@ -0,0 +1,158 @@
+import asyncio
+import logging
+import time
+import uuid
+from typing import Callable, Awaitable, Dict, Any
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, User
+from aiogram_dialog.api.entities import DialogUpdate
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+logger = logging.getLogger(__name__)
+
+# Аренда пользователя в Redis: короткий TTL продлевается, пока идёт обработка,
+# поэтому аренда упавшего процесса освобождается через несколько секунд
+LEASE_TTL_MS = 10_000
+LEASE_RENEW_INTERVAL = 3
+# Дольше этого апдейт не ждёт аренду: он отклоняется и Telegram доставит его повторно
+LEASE_WAIT = 30
+LEASE_POLL_MIN = 0.02
+LEASE_POLL_MAX = 0.2
+
+# Снимаем и продлеваем аренду, только если она всё ещё наша
+RELEASE_LEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+RENEW_LEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+class LeaseUnavailable(Exception):
+    """Аренда пользователя не получена: апдейт не обрабатывается и должен быть доставлен повторно."""
+
+
+class _UserQueue:
+    """Последовательная очередь апдейтов одного пользователя в процессе."""
+
+    __slots__ = ("lock", "users")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()  # Ожидающие получают блокировку в порядке прихода
+        self.users = 0  # Сколько апдейтов обрабатывается или ждёт в очереди
+
+
+class UserOrderingMiddleware(BaseMiddleware):
+    """
+    Обрабатывает апдейты одного пользователя строго по очереди.
+
+    Внутри процесса апдейты направляются по user_id в последовательную
+    очередь пользователя (asyncio.Lock с порядком прихода), апдейты разных
+    пользователей выполняются параллельно. Между процессами и репликами
+    очередь пользователя защищается короткой арендой в Redis: пока один
+    процесс обрабатывает апдейт, другие ждут освобождения. Так быстрые
+    повторные нажатия не выполняются одновременно (двойное списание при
+    старте игры, двойное начисление выигрыша).
+
+    Аренда стоит двух запросов к Redis на апдейт (SET NX и снятие скриптом,
+    плюс продление раз в LEASE_RENEW_INTERVAL для долгих хэндлеров), поэтому
+    она включается вызовом setup() только при работе через вебхук, когда
+    апдейты одного пользователя могут прийти в разные реплики. В режиме
+    polling апдейты получает один процесс, и достаточно очереди в памяти.
+    Если аренду получить не удалось (Redis недоступен или её не дождались),
+    апдейт не обрабатывается: бросается LeaseUnavailable, и вебхук отвечает
+    503, чтобы Telegram доставил апдейт повторно.
+
+    Регистрируется как outer-middleware на dp.update.
+    """
+
+    def __init__(self):
+        self.redis: Redis | None = None
+        self._queues: dict[int, _UserQueue] = {}
+
+    def setup(self, redis: Redis):
+        self.redis = redis
+
+    @staticmethod
+    def _lease_key(user_id: int) -> str:
+        return f"lease:user:{user_id}"
+
+    async def _acquire_lease(self, key: str, token: str) -> bool:
+        """Ждёт аренду пользователя; False — если не дождались или Redis недоступен."""
+        deadline = time.monotonic() + LEASE_WAIT
+        delay = LEASE_POLL_MIN
+        while True:
+            try:
+                if await self.redis.set(key, token, nx=True, px=LEASE_TTL_MS):
+                    return True
+            except RedisError as e:
+                logger.error("Аренда пользователя недоступна: %s", e)
+                return False
+            if time.monotonic() >= deadline:
+                logger.warning("Не дождались аренды %s", key)
+                return False
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, LEASE_POLL_MAX)
+
+    async def _renew_lease(self, key: str, token: str):
+        while True:
+            await asyncio.sleep(LEASE_RENEW_INTERVAL)
+            try:
+                if not await self.redis.eval(RENEW_LEASE_SCRIPT, 1, key, token, LEASE_TTL_MS):
+                    return
+            except RedisError as e:
+                logger.error("Не удалось продлить аренду %s: %s", key, e)
+
+    async def _release_lease(self, key: str, token: str):
+        try:
+            await self.redis.eval(RELEASE_LEASE_SCRIPT, 1, key, token)
+        except RedisError as e:
+            logger.error("Не удалось освободить аренду %s: %s", key, e)
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        user: User | None = data.get("event_from_user")
+        # Внутренние апдейты диалогов порождаются хэндлерами, которые уже держат очередь пользователя
+        if user is None or isinstance(event, DialogUpdate):
+            return await handler(event, data)
+
+        queue = self._queues.get(user.id)
+        if queue is None:
+            queue = self._queues[user.id] = _UserQueue()
+        queue.users += 1
+        try:
+            async with queue.lock:
+                if self.redis is None:
+                    return await handler(event, data)
+
+                key, token = self._lease_key(user.id), uuid.uuid4().hex
+                if not await self._acquire_lease(key, token):
+                    # Без аренды апдейт мог бы выполниться одновременно с другой репликой
+                    # (двойное списание или начисление) — отклоняем его
+                    raise LeaseUnavailable(f"Аренда пользователя {user.id} не получена")
+                renewal = asyncio.create_task(self._renew_lease(key, token))
+                try:
+                    return await handler(event, data)
+                finally:
+                    renewal.cancel()
+                    await self._release_lease(key, token)
+        finally:
+            queue.users -= 1
+            if not queue.users:
+                del self._queues[user.id]
+
+
+# Общая очередность апдейтов пользователей
+user_ordering = UserOrderingMiddleware()
@@ -0,0 +1,158 @@
+import logging
+import math
+import time
+from typing import Callable, Awaitable, Dict, Any, NamedTuple
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import TelegramObject, CallbackQuery, Message, User
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+from services.outbound import TokenBucket, evict_idle_buckets
+
+logger = logging.getLogger(__name__)
+
+
+class ThrottleRule(NamedTuple):
+    rate: float  # Токенов в секунду
+    capacity: float  # Размер ведра (допустимый всплеск)
+
+
+# Классы хэндлеров задаются флагом: flags={"throttle": THROTTLE_GAME};
+# стоимость вызова — флагом "throttle_cost" (по умолчанию 1)
+THROTTLE_DEFAULT = "default"
+THROTTLE_GAME = "game"  # Старт игры: списание и выборка вопросов
+THROTTLE_SUBSCRIPTION = "subscription"  # Проверка подписок: запросы к Bot API по каждому каналу
+THROTTLE_RATING = "rating"  # Рейтинг: агрегаты по неделе
+
+THROTTLE_RULES = {
+    THROTTLE_DEFAULT: ThrottleRule(rate=3, capacity=10),
+    THROTTLE_GAME: ThrottleRule(rate=1 / 5, capacity=3),
+    THROTTLE_SUBSCRIPTION: ThrottleRule(rate=1 / 10, capacity=3),
+    THROTTLE_RATING: ThrottleRule(rate=1 / 2, capacity=5),
+}
+
+# Предупреждение о превышении показывается не чаще раза в 10 секунд
+WARN_INTERVAL = 10
+# Локальное ведро, к которому не обращались дольше этого времени, удаляется
+LOCAL_BUCKET_IDLE = 60
+
+# Ведро токенов в хеше: tokens и ts (мс по часам Redis, общим для всех реплик).
+# Возвращает {1, 0} при успехе или {0, мс до появления нужных токенов}
+TAKE_TOKENS_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local time = redis.call('time')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+
+local bucket = redis.call('hmget', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate / 1000)
+
+local allowed = 0
+local wait = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+else
+    wait = math.ceil((cost - tokens) * 1000 / rate)
+end
+redis.call('hset', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('pexpire', KEYS[1], math.ceil(capacity * 1000 / rate) + 1000)
+return {allowed, wait}
+"""
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Ограничивает частоту вызовов хэндлеров для каждого пользователя.
+
+    Для каждой пары (пользователь, класс хэндлера) ведётся ведро токенов в
+    Redis, которое списывается атомарным Lua-скриптом, поэтому лимит общий
+    для всех процессов и реплик. Перед обращением к Redis проверяется такое
+    же ведро в памяти процесса: если пусто уже оно, апдейт отклоняется без
+    сетевого запроса. Отклонённый апдейт не доходит до хэндлера, БД и Bot API.
+
+    Регистрируется как inner-middleware, чтобы видеть флаги хэндлера.
+    """
+
+    def __init__(self):
+        self.redis: Redis | None = None
+        self._local: dict[tuple[int, str], TokenBucket] = {}
+        self._warned: dict[int, float] = {}
+        self._last_cleanup = time.monotonic()
+
+    def setup(self, redis: Redis):
+        self.redis = redis
+
+    def _cleanup(self):
+        now = time.monotonic()
+        if now - self._last_cleanup < LOCAL_BUCKET_IDLE:
+            return
+        self._last_cleanup = now
+        self._local = evict_idle_buckets(self._local, LOCAL_BUCKET_IDLE)
+        self._warned = {user_id: at for user_id, at in self._warned.items() if now - at < WARN_INTERVAL}
+
+    async def take(self, user_id: int, route: str, cost: float = 1) -> float:
+        """
+        Списывает токены пользователя для класса хэндлеров.
+
+        Returns:
+            float: 0, если вызов разрешён, иначе сколько секунд подождать.
+        """
+        rule = THROTTLE_RULES.get(route, THROTTLE_RULES[THROTTLE_DEFAULT])
+        self._cleanup()
+        bucket = self._local.get((user_id, route))
+        if bucket is None:
+            bucket = self._local[(user_id, route)] = TokenBucket(rule.rate, rule.capacity)
+        wait = bucket.take(cost)
+        if wait or self.redis is None:
+            return wait
+
+        try:
+            allowed, wait_ms = await self.redis.eval(
+                TAKE_TOKENS_SCRIPT, 1, f"throttle:{route}:{user_id}", rule.rate, rule.capacity, cost
+            )
+        except RedisError as e:
+            logger.error("Ограничитель частоты недоступен: %s", e)
+            return 0
+        return 0 if allowed else wait_ms / 1000
+
+    def _should_warn(self, user_id: int) -> bool:
+        now = time.monotonic()
+        if now - self._warned.get(user_id, 0) < WARN_INTERVAL:
+            return False
+        self._warned[user_id] = now
+        return True
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        user: User | None = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+
+        route = get_flag(data, "throttle", default=THROTTLE_DEFAULT)
+        cost = get_flag(data, "throttle_cost", default=1)
+        wait = await self.take(user.id, route, cost)
+        if not wait:
+            return await handler(event, data)
+
+        logger.info("Пользователь %s превысил лимит %s", user.id, route)
+        text = f"⏳ Слишком часто. Попробуйте через {math.ceil(wait)} с."
+        if isinstance(event, CallbackQuery):
+            # Ответ на callback обязателен; в режиме webhook он уходит в теле ответа
+            return event.answer(text if self._should_warn(user.id) else None)
+        if isinstance(event, Message) and self._should_warn(user.id):
+            return event.answer(text)
+        return None
+
+
+# Общий ограничитель частоты запросов пользователей
+throttling = ThrottlingMiddleware()
@@ -13,6 +13,11 @@ class AddQuestionState(StatesGroup):
     check_and_add_question = State()
 
 
+class BroadcastState(StatesGroup):
+    waiting_for_text = State()  # Ожидание текста рассылки
+    confirm = State()  # Подтверждение отправки
+
+
 class ProcessGameState(StatesGroup):
     waiting_for_question = State()  # Ожидание начала вопроса
     waiting_for_answer = State()  # Ожидание ответа от пользователя
@@ -0,0 +1,250 @@
+import asyncio
+import logging
+import time
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError, TelegramForbiddenError, TelegramRetryAfter
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+from sqlalchemy import select, update, func
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from db.models import Users, async_session_maker
+from services.known_users import known_users
+from services.outbound import outbound, PRIORITY_BROADCAST, PRIORITY_NOTIFICATION
+
+logger = logging.getLogger(__name__)
+
+BROADCAST_SEQ_KEY = "broadcast:seq"
+BROADCAST_ACTIVE_KEY = "broadcast:active"
+
+# Получатели читаются страницами по ID в память; сессия закрывается до отправки,
+# поэтому транзакция не остаётся открытой, пока идёт рассылка
+PAGE_SIZE = 5000
+
+# Пакет отправляется параллельно (темп задаёт планировщик исходящих сообщений),
+# после пакета в Redis сохраняется контрольная точка. После перезапуска
+# повторно может уйти не больше одного пакета
+BATCH_SIZE = 30
+# Заблокировавшие бота помечаются неактивными пакетным UPDATE
+DEACTIVATE_BATCH = 500
+PROGRESS_INTERVAL = 5
+# Блокировка рассылки продлевается на каждой контрольной точке;
+# если процесс упал, другой подхватит рассылку после её истечения
+LOCK_TTL = 60
+
+
+class Broadcaster:
+    """
+    Массовая рассылка администратора всем активным пользователям.
+
+    Получатели выбираются из `users` страницами по возрастанию ID,
+    отправка идёт с приоритетом рассылки почти на общем лимите бота.
+    Прогресс (последний обработанный ID и счётчики) хранится в Redis,
+    поэтому после перезапуска рассылка продолжается с места остановки.
+    Пользователи, заблокировавшие бота, помечаются `is_active=False`.
+    Администратор видит прогресс и скорость в обновляемом сообщении.
+    """
+
+    def __init__(self, sessionmaker: async_sessionmaker[AsyncSession]):
+        self.sessionmaker = sessionmaker
+        self.redis: Redis | None = None
+        self._tasks: dict[int, asyncio.Task] = {}
+
+    def setup(self, redis: Redis):
+        self.redis = redis
+
+    @staticmethod
+    def key(broadcast_id: int) -> str:
+        return f"broadcast:{broadcast_id}"
+
+    async def start(self, bot: Bot, admin_chat_id: int, text: str) -> int:
+        """
+        Создаёт рассылку и запускает её в фоне.
+
+        Args:
+            bot (Bot): Экземпляр бота.
+            admin_chat_id (int): Чат администратора для сообщения о прогрессе.
+            text (str): Текст рассылки (HTML).
+
+        Returns:
+            int: ID рассылки.
+        """
+        async with self.sessionmaker() as session:
+            total = await session.scalar(select(func.count(Users.id)).where(Users.is_active.isnot(False)))
+        with outbound.priority(PRIORITY_NOTIFICATION):
+            progress = await bot.send_message(admin_chat_id, f"📨 Рассылка запускается: {total} получателей")
+
+        broadcast_id = await self.redis.incr(BROADCAST_SEQ_KEY)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(self.key(broadcast_id), mapping={
+                "text": text, "admin_chat_id": admin_chat_id, "progress_message_id": progress.message_id,
+                "total": total, "last_id": 0, "sent": 0, "failed": 0, "blocked": 0,
+            })
+            pipe.sadd(BROADCAST_ACTIVE_KEY, broadcast_id)
+            await pipe.execute()
+        self._spawn(bot, broadcast_id)
+        return broadcast_id
+
+    async def resume(self, bot: Bot):
+        """Продолжает незавершённые рассылки, которые не выполняет ни один процесс."""
+        try:
+            active = await self.redis.smembers(BROADCAST_ACTIVE_KEY)
+        except RedisError as e:
+            logger.error("Список рассылок недоступен: %s", e)
+            return
+        for broadcast_id in active:
+            self._spawn(bot, int(broadcast_id))
+
+    async def run(self, bot: Bot):
+        """Фоновая задача: подхватывает рассылки после перезапуска или падения процесса."""
+        while True:
+            await self.resume(bot)
+            await asyncio.sleep(LOCK_TTL)
+
+    def _spawn(self, bot: Bot, broadcast_id: int):
+        task = self._tasks.get(broadcast_id)
+        if task is not None and not task.done():
+            return
+        self._tasks[broadcast_id] = asyncio.create_task(self._run(bot, broadcast_id))
+
+    async def _recipients(self, after_id: int):
+        """Выдаёт (ID, Telegram ID) активных пользователей с ID больше after_id."""
+        while True:
+            async with self.sessionmaker() as session:
+                page = (await session.execute(
+                    select(Users.id, Users.user_id)
+                    .where(Users.id > after_id, Users.is_active.isnot(False))
+                    .order_by(Users.id)
+                    .limit(PAGE_SIZE)
+                )).all()
+            for row in page:
+                yield row.id, row.user_id
+            if len(page) < PAGE_SIZE:
+                return
+            after_id = page[-1].id
+
+    async def _deactivate(self, ids: list[int], user_ids: list[int]):
+        """Помечает заблокировавших бота неактивными одним UPDATE."""
+        if not ids:
+            return
+        async with self.sessionmaker() as session:
+            await session.execute(update(Users).where(Users.id.in_(ids)).values(is_active=False))
+            await session.commit()
+        # Следующий /start такого пользователя пройдёт через БД и вернёт его в рассылки
+        await known_users.discard(user_ids)
+
+    async def _send(self, bot: Bot, chat_id: int, text: str) -> str:
+        """Отправляет одно сообщение; возвращает sent, blocked или failed."""
+        try:
+            await bot.send_message(chat_id, text)
+            return "sent"
+        except TelegramForbiddenError:
+            return "blocked"
+        except TelegramRetryAfter as e:
+            # Планировщик уже исчерпал повторы — пользователь считается пропущенным
+            logger.warning("Рассылка: лимит Telegram для %s (%s с)", chat_id, e.retry_after)
+            return "failed"
+        except TelegramAPIError as e:
+            logger.debug("Рассылка: не удалось отправить %s: %s", chat_id, e)
+            return "failed"
+
+    async def _report(self, bot: Bot, state: dict, counters: dict, rate: float, finished: bool = False):
+        processed = counters["sent"] + counters["failed"] + counters["blocked"]
+        title = "✅ Рассылка завершена" if finished else "📨 Рассылка идёт"
+        text = (
+            f"{title}: {processed} из {state['total']}\n"
+            f"Доставлено: {counters['sent']}\n"
+            f"Заблокировали бота: {counters['blocked']}\n"
+            f"Ошибок: {counters['failed']}\n"
+            f"Скорость: {rate:.1f} сообщ./с"
+        )
+        try:
+            with outbound.priority(PRIORITY_NOTIFICATION):
+                await bot.edit_message_text(
+                    text, chat_id=int(state["admin_chat_id"]), message_id=int(state["progress_message_id"])
+                )
+        except TelegramAPIError as e:
+            logger.debug("Не удалось обновить прогресс рассылки: %s", e)
+
+    async def _run(self, bot: Bot, broadcast_id: int):
+        key = self.key(broadcast_id)
+        lock_key = f"{key}:lock"
+        # Рассылку выполняет только один процесс
+        try:
+            if not await self.redis.set(lock_key, 1, nx=True, ex=LOCK_TTL):
+                return
+        except RedisError as e:
+            logger.error("Блокировка рассылки недоступна: %s", e)
+            return
+
+        blocked_ids, blocked_user_ids = [], []
+        try:
+            raw = await self.redis.hgetall(key)
+            if not raw:
+                await self.redis.srem(BROADCAST_ACTIVE_KEY, broadcast_id)
+                return
+            state = {k.decode(): v.decode() for k, v in raw.items()}
+            counters = {name: int(state[name]) for name in ("sent", "failed", "blocked")}
+            text, last_id = state["text"], int(state["last_id"])
+            if last_id:
+                logger.info("Рассылка %s продолжается после ID %s", broadcast_id, last_id)
+
+            started, sent_here, last_report = time.monotonic(), 0, 0.0
+            batch = []
+
+            async def flush():
+                nonlocal sent_here, last_report
+                with outbound.priority(PRIORITY_BROADCAST):
+                    results = await asyncio.gather(*(self._send(bot, chat_id, text) for _, chat_id in batch))
+                for (row_id, chat_id), status in zip(batch, results):
+                    counters[status] += 1
+                    if status == "blocked":
+                        blocked_ids.append(row_id)
+                        blocked_user_ids.append(chat_id)
+                sent_here += len(batch)
+                if len(blocked_ids) >= DEACTIVATE_BATCH:
+                    await self._deactivate(blocked_ids, blocked_user_ids)
+                    blocked_ids.clear()
+                    blocked_user_ids.clear()
+
+                # Контрольная точка: пакет обработан целиком
+                async with self.redis.pipeline(transaction=True) as pipe:
+                    pipe.hset(key, mapping={"last_id": batch[-1][0], **counters})
+                    pipe.expire(lock_key, LOCK_TTL)
+                    await pipe.execute()
+                batch.clear()
+
+                now = time.monotonic()
+                if now - last_report >= PROGRESS_INTERVAL:
+                    last_report = now
+                    await self._report(bot, state, counters, sent_here / max(now - started, 1e-6))
+
+            async for recipient in self._recipients(last_id):
+                batch.append(recipient)
+                if len(batch) >= BATCH_SIZE:
+                    await flush()
+            if batch:
+                await flush()
+            await self._deactivate(blocked_ids, blocked_user_ids)
+
+            await self._report(bot, state, counters, sent_here / max(time.monotonic() - started, 1e-6), finished=True)
+            async with self.redis.pipeline(transaction=True) as pipe:
+                pipe.srem(BROADCAST_ACTIVE_KEY, broadcast_id)
+                pipe.delete(key, lock_key)
+                await pipe.execute()
+            logger.info("Рассылка %s завершена: %s", broadcast_id, counters)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Состояние остаётся в Redis: рассылку подхватит следующий вызов resume()
+            logger.error("Ошибка рассылки %s: %s", broadcast_id, e)
+            try:
+                await self._deactivate(blocked_ids, blocked_user_ids)
+                await self.redis.delete(lock_key)
+            except Exception as e:
+                logger.error("Не удалось сохранить состояние рассылки %s: %s", broadcast_id, e)
+
+
+# Общий механизм рассылок
+broadcaster = Broadcaster(async_session_maker)
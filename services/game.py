@@ -4,13 +4,20 @@ import logging
 from aiogram import Router
 from aiogram.fsm.context import FSMContext
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from sqlalchemy.sql.expression import func
+from sqlalchemy import update, func
 from sqlalchemy.future import select
 from sqlalchemy.exc import SQLAlchemyError
 
-from db.models import Users, Game, Question
+from config_data.config import load_config
+from db.db_functions import debit_balance, add_weekly_score
+from db.models import Users, Game
 from keyboards.keyboards import main_kb
 from services.FSM import ProcessGameState
+from services.game_state import GameSession
+from services.leaderboard import leaderboard
+from services.ledger import ledger, LEDGER_ENTRY_FEE
+from services.question_deck import question_deck
+from services.question_pool import QuestionRecord, question_pool
 
 logger = logging.getLogger(__name__)
 
@@ -23,6 +30,13 @@ LEAGUE_SETTINGS = {
     "Gold": {"cost": 50, "currency": "gold", "time_limit": 40},
 }
 
+# Режим одного сообщения: каждый ответ — один editMessageText вместо
+# редактирования старого сообщения и отправки нового вопроса
+SINGLE_MESSAGE = load_config().game.single_message
+
+# Названия валют в родительном падеже для сообщений
+CURRENCY_NAMES = {"silver": "серебряных", "gold": "золотых"}
+
 # Баллы за каждый вопрос
 SCORE_TABLE = [
     5, 10, 20, 50, 100, 200, 300, 400, 500, 1000,
@@ -30,29 +44,68 @@ SCORE_TABLE = [
 ]
 
 
-def question_to_dict(question: Question) -> dict:
+# Биты маски использованных подсказок в состоянии игры
+HINT_INSURE = 1
+HINT_REMOVE_TWO = 2
+HINT_TAKE_MONEY = 4
+
+
+def get_answers(question: QuestionRecord, seed: int, cursor: int) -> list:
     """
-    Преобразует объект Question в словарь.
+    Возвращает варианты ответов в том порядке, в котором их видит игрок.
+
+    Порядок не хранится в состоянии, а детерминированно выводится из seed игры
+    и номера вопроса, поэтому совпадает при отправке вопроса и при ответе.
 
     Args:
-        question (Question): Объект вопроса.
+        question (QuestionRecord): Запись вопроса.
+        seed (int): Seed перемешивания, выбранный при старте игры.
+        cursor (int): Номер вопроса в игре.
 
     Returns:
-        dict: Словарь с данными вопроса.
+        list: Список из 4-х ответов.
     """
-    return {
-        "id": question.id,
-        "question_text": question.question_text,
-        "correct_answer": question.correct_answer,
-        "incorrect_answers": [question.answer_2, question.answer_3, question.answer_4],
-        "score": SCORE_TABLE[0]  # Пример, добавьте логику для определения баллов
-    }
+    answers = [question.correct_answer, *question.incorrect_answers]
+    random.Random(seed * len(SCORE_TABLE) + cursor).shuffle(answers)
+    return answers
 
 
-async def start_game(session, user_id: int, league: str, send_message, router, state: FSMContext):
+async def get_current_question(data: dict) -> tuple[QuestionRecord | None, list]:
+    """
+    Находит текущий вопрос игры по компактному состоянию.
+
+    Вопрос, добавленный в другом процессе и ещё не попавший в пул,
+    подгружается из БД; игра считается потерянной, только если вопроса нет и там.
+
+    Args:
+        data (dict): Данные FSM (question_ids, cursor, seed).
+
+    Returns:
+        tuple: Запись вопроса из общего пула и варианты ответов (None, [] если вопроса нет).
+    """
+    question_ids = data.get("question_ids", [])
+    cursor = data.get("cursor", 0)
+    if cursor >= len(question_ids):
+        return None, []
+
+    question = question_pool.get(question_ids[cursor])
+    if question is None:
+        # Подгружаем разом все неизвестные вопросы игры — следующие ответы обойдутся без БД
+        await question_pool.fetch(question_ids[cursor:])
+        question = question_pool.get(question_ids[cursor])
+    if question is None:
+        return None, []
+    return question, get_answers(question, data["seed"], cursor)
+
+
+async def start_game(session, user_id: int, league: str, send_message, router, state: FSMContext,
+                     intro: str = None):
     """
     Запуск игры для пользователя.
 
+    Сессией владеет DatabaseMiddleware: функция коммитит свою транзакцию,
+    но не закрывает сессию.
+
     Args:
         session: Асинхронная сессия SQLAlchemy.
         user_id (int): ID пользователя.
@@ -60,53 +113,18 @@ async def start_game(session, user_id: int, league: str, send_message, router, s
         send_message (callable): Функция для отправки сообщений пользователю.
         router (Router): Router для обработки временных callback-хендлеров.
         state (FSMContext): Контекст состояния.
+        intro (str, optional): Текст над первым вопросом (в режиме одного сообщения).
     """
     try:
-        # Проверяем, существует ли пользователь
-        result = await session.execute(select(Users).where(Users.user_id == user_id))
-        user = result.scalars().first()
-
-        if not user:
-            await send_message("Пользователь не найден. Зарегистрируйтесь для начала игры.")
-            return
-
         # Проверяем настройки лиги
         league_config = LEAGUE_SETTINGS.get(league)
         if not league_config:
             await send_message("Неверная лига.")
             return
 
-        # Проверяем баланс пользователя
-        if league != "Bronze":
-            if league_config["currency"] == "silver" and user.balance_silver < league_config["cost"]:
-                await send_message(f"Недостаточно серебряных монет для начала игры.\n"
-                                   f"Для того чтобы играть в этой лиге вам необходимо иметь на счету"
-                                   f"{league_config['cost']} серебряных монет",
-                                   reply_markup=main_kb)
-                return
-            elif league_config["currency"] == "gold" and user.balance_gold < league_config["cost"]:
-                await send_message(f"Недостаточно золотых монет для начала игры.\n"
-                                   f"Для того чтобы играть в этой лиге вам необходимо иметь на счету"
-                                   f"{league_config['cost']} золотых монет",
-                                   reply_markup=main_kb)
-                return
-
-        # Списываем стоимость игры
-        if league != "Bronze":
-            if league_config["currency"] == "silver":
-                user.balance_silver -= league_config["cost"]
-            elif league_config["currency"] == "gold":
-                user.balance_gold -= league_config["cost"]
-            await session.commit()
-
-        # Генерируем список вопросов
-        questions = []
+        # Проверяем, хватает ли вопросов (пул в памяти, без запросов к БД)
         for difficulty in ["Easy", "Medium", "Hard"]:
-            result = await session.execute(
-                select(Question)
-                .where(Question.league == league, Question.difficulty == difficulty)
-            )
-            num_questions = len(result.scalars().all())
+            num_questions = question_pool.count(league, difficulty)
 
             if num_questions < 5:
                 await send_message(
@@ -115,37 +133,58 @@ async def start_game(session, user_id: int, league: str, send_message, router, s
                 )
                 return
 
-            result = await session.execute(
-                select(Question)
-                .where(Question.league == league, Question.difficulty == difficulty)
-                .order_by(func.random())
-                .limit(5)
-            )
-            questions += [question_to_dict(q) for q in result.scalars().all()]  # Преобразуем вопросы в словари
+        # Списываем стоимость игры условным UPDATE (проверка баланса и списание — один запрос)
+        if league_config["cost"]:
+            balance = await debit_balance(session, user_id, league_config["currency"], league_config["cost"])
+            if balance is None and await ledger.settle_user(session, user_id):
+                # Учитываем свежие начисления из журнала монет и пробуем ещё раз
+                balance = await debit_balance(session, user_id, league_config["currency"], league_config["cost"])
+            if balance is None:
+                if await session.scalar(select(Users.id).where(Users.user_id == user_id)) is None:
+                    await send_message("Пользователь не найден. Зарегистрируйтесь для начала игры.")
+                    return
+                currency_name = CURRENCY_NAMES[league_config["currency"]]
+                await send_message(f"Недостаточно {currency_name} монет для начала игры.\n"
+                                   f"Для того чтобы играть в этой лиге вам необходимо иметь на счету"
+                                   f"{league_config['cost']} {currency_name} монет",
+                                   reply_markup=main_kb)
+                return
+        elif await session.scalar(select(Users.id).where(Users.user_id == user_id)) is None:
+            await send_message("Пользователь не найден. Зарегистрируйтесь для начала игры.")
+            return
+
+        # Генерируем список вопросов из персональной колоды игрока
+        question_ids = []
+        for difficulty in ["Easy", "Medium", "Hard"]:
+            drawn = await question_deck.draw(user_id, league, difficulty, 5)
+            question_ids += [q.id for q in drawn]
 
-        if len(questions) < len(SCORE_TABLE):
+        if len(question_ids) < len(SCORE_TABLE):
+            await session.rollback()  # Возвращаем списанную стоимость игры
             await send_message("В базе недостаточно вопросов для игры.")
             return
 
-        # Создаём новую игру
+        # Создаём новую игру в той же транзакции, что и списание
         new_game = Game(user_id=user_id, league=league, score=0)
         session.add(new_game)
         await session.commit()
-
-        # Начинаем игру
-        current_score = 0
-        guaranteed_score = 0
-        hints_used = {"remove_two": False, "take_money": False, "insure": False}
-
-        # Инициализация состояния
-        await state.update_data(
-            questions=questions,
-            current_score=current_score,
-            hints_used=hints_used
-        )
-
-        # Отправляем первый вопрос
-        await send_next_question(send_message, state)
+        if league_config["cost"]:
+            ledger.record(user_id, league_config["currency"], -league_config["cost"], LEDGER_ENTRY_FEE, applied=True)
+
+        # Инициализация компактного состояния: тексты вопросов берутся из общего пула
+        game = GameSession(state, {
+            "game_id": new_game.id,
+            "league": league,
+            "question_ids": question_ids,
+            "cursor": 0,
+            "seed": random.getrandbits(32),
+            "hints": 0,
+            "score": 0,
+            "guaranteed": 0,
+        })
+
+        # Отправляем первый вопрос (состояние записывается вместе с ним)
+        await send_next_question(send_message, game, success_message=intro)
 
     except SQLAlchemyError as e:
         await session.rollback()
@@ -154,8 +193,32 @@ async def start_game(session, user_id: int, league: str, send_message, router, s
     except Exception as e:
         logger.error(f"Неожиданная ошибка для пользователя {user_id}: {e}")
         await send_message("Произошла ошибка.")
-    finally:
-        await session.close()
+
+
+async def finish_game(session, game: GameSession, user_id: int, final_score: int):
+    """
+    Фиксирует результат завершённой игры.
+
+    Записывает итоговый счёт в `games`, добавляет его в недельные итоги
+    `weekly_scores` и увеличивает недельный рейтинг лиги в Redis. Не коммитит: хэндлер объявляет флаг {"db": DB_COMMIT}.
+
+    Args:
+        session: Асинхронная сессия SQLAlchemy.
+        game (GameSession): Состояние завершаемой игры.
+        user_id (int): ID пользователя.
+        final_score (int): Итоговый выигрыш игрока.
+    """
+    game_id = game.data.get("game_id")
+    if game_id is not None:
+        await session.execute(
+            update(Game)
+            .where(Game.id == game_id)
+            .values(score=final_score, finished_at=func.now())
+            .execution_options(synchronize_session=False)
+        )
+    if game.data.get("league"):
+        await add_weekly_score(session, game.data["league"], user_id, final_score)
+        await leaderboard.increment(game.data["league"], user_id, final_score)
 
 
 def shuffle_answers(correct_answer: str, incorrect_answers: list) -> list:
@@ -191,51 +254,45 @@ def filter_answers(correct_answer: str, answers: list) -> list:
     return [correct_answer] + incorrect_answers
 
 
-async def send_next_question(send_message, state: FSMContext, success_message: str = None):
+async def send_next_question(send_message, game: GameSession, success_message: str = None):
     """
-    Отправляет следующий вопрос пользователю.
+    Отправляет следующий вопрос пользователю и записывает состояние игры.
+
+    В режиме одного сообщения send_message — это edit_text сообщения с
+    предыдущим вопросом, а success_message выводится над новым вопросом в
+    том же сообщении: на каждый ответ приходится один запрос к Bot API.
 
     Args:
-        send_message (callable): Функция для отправки сообщений.
-        state (FSMContext): Контекст состояния.
+        send_message (callable): Функция для отправки (или редактирования) сообщения.
+        game (GameSession): Состояние игры, загруженное в текущем апдейте.
         success_message (str, optional): Сообщение о правильном ответе.
     """
-    data = await state.get_data()
-    questions = data.get("questions", [])
-    question_index = data.get("question_index", 0)
+    current_question, answers = await get_current_question(game.data)
 
     # Проверяем, остались ли вопросы
-    if not questions:
-        current_score = data.get("current_score", 0)
-        await send_message(f"Игра завершена! Ваш итоговый счёт: {current_score}.")
-        await state.clear()
+    if current_question is None:
+        current_score = game.data.get("score", 0)
+        text = f"Игра завершена! Ваш итоговый счёт: {current_score}."
+        if SINGLE_MESSAGE:
+            await send_message(f"{success_message}\n\n{text}" if success_message else text, reply_markup=main_kb)
+        else:
+            await send_message(text)
+        await game.clear()
         return
 
-    # Если есть success_message, сначала отправляем его
+    header = ""
     if success_message:
-        await send_message(success_message)
-
-    # Берём следующий вопрос
-    current_question = questions.pop(0)
-    correct_answer = current_question["correct_answer"]
-    incorrect_answers = current_question["incorrect_answers"]
-    answers = [correct_answer] + incorrect_answers
-    random.shuffle(answers)  # Перемешиваем ответы
-
-    # Сохраняем данные в состоянии
-    await state.update_data(
-        questions=questions,
-        current_question=current_question,
-        answers=answers,
-        question_index=question_index,
-    )
+        if SINGLE_MESSAGE:
+            header = f"{success_message}\n\n"
+        else:
+            await send_message(success_message)
 
     # Создаём клавиатуру с вариантами ответов
     answer_buttons = [
-        InlineKeyboardButton(text="A", callback_data=f"answer:{current_question['id']}:0"),
-        InlineKeyboardButton(text="B", callback_data=f"answer:{current_question['id']}:1"),
-        InlineKeyboardButton(text="C", callback_data=f"answer:{current_question['id']}:2"),
-        InlineKeyboardButton(text="D", callback_data=f"answer:{current_question['id']}:3"),
+        InlineKeyboardButton(text="A", callback_data=f"answer:{current_question.id}:0"),
+        InlineKeyboardButton(text="B", callback_data=f"answer:{current_question.id}:1"),
+        InlineKeyboardButton(text="C", callback_data=f"answer:{current_question.id}:2"),
+        InlineKeyboardButton(text="D", callback_data=f"answer:{current_question.id}:3"),
     ]
     hint_buttons = [
         InlineKeyboardButton(text="\uD83D\uDCB8 Застраховать сумму", callback_data=f"hint:hint_insure"),
@@ -246,11 +303,11 @@ async def send_next_question(send_message, state: FSMContext, success_message: s
 
     # Отправляем вопрос пользователю
     await send_message(
-        f"Вопрос: {current_question['question_text']}\n\n"
+        f"{header}Вопрос: {current_question.question_text}\n\n"
         f"A) {answers[0]}\n"
         f"B) {answers[1]}\n"
         f"C) {answers[2]}\n"
         f"D) {answers[3]}",
         reply_markup=keyboard
     )
-    await state.set_state(ProcessGameState.waiting_for_answer)
+    await game.flush(ProcessGameState.waiting_for_answer)
@@ -0,0 +1,58 @@
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.redis import RedisStorage
+
+
+class GameSession:
+    """
+    Состояние игры в рамках одного апдейта.
+
+    Данные FSM читаются один раз, изменяются локально в `data`, а затем
+    записываются одной командой flush() или clear(). Для RedisStorage
+    данные и состояние пишутся одним pipeline (один round-trip вместо
+    отдельных update_data/set_state).
+    """
+
+    def __init__(self, state: FSMContext, data: dict):
+        self.state = state
+        self.data = data
+
+    @classmethod
+    async def load(cls, state: FSMContext) -> "GameSession":
+        """Загружает данные игры из FSM (один запрос к хранилищу)."""
+        return cls(state, await state.get_data())
+
+    async def flush(self, new_state: State | None = None):
+        """
+        Записывает изменённые данные и, если передано, новое состояние FSM.
+
+        Args:
+            new_state (State, optional): Состояние, которое нужно установить.
+        """
+        storage = self.state.storage
+        if not isinstance(storage, RedisStorage):
+            await self.state.set_data(self.data)
+            if new_state is not None:
+                await self.state.set_state(new_state)
+            return
+
+        async with storage.redis.pipeline(transaction=True) as pipe:
+            pipe.set(storage.key_builder.build(self.state.key, "data"),
+                     storage.json_dumps(self.data), ex=storage.data_ttl)
+            if new_state is not None:
+                pipe.set(storage.key_builder.build(self.state.key, "state"),
+                         new_state.state, ex=storage.state_ttl)
+            await pipe.execute()
+
+    async def clear(self):
+        """Завершает игру: удаляет данные и состояние FSM."""
+        self.data = {}
+        storage = self.state.storage
+        if not isinstance(storage, RedisStorage):
+            await self.state.clear()
+            return
+
+        await storage.redis.delete(
+            storage.key_builder.build(self.state.key, "state"),
+            storage.key_builder.build(self.state.key, "data"),
+        )
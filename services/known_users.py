@@ -0,0 +1,55 @@
+import logging
+
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+logger = logging.getLogger(__name__)
+
+KNOWN_USERS_KEY = "users:known"
+
+
+class KnownUsers:
+    """
+    Множество уже зарегистрированных пользователей в Redis.
+
+    Повторный /start зарегистрированного пользователя проверяется одной
+    командой SISMEMBER и не обращается к БД. Множество пополняется при
+    регистрации, а пользователи, зарегистрированные до его появления,
+    попадают в него при первом /start.
+    """
+
+    def __init__(self):
+        self.redis: Redis | None = None
+
+    def setup(self, redis: Redis):
+        self.redis = redis
+
+    async def contains(self, user_id: int) -> bool:
+        if self.redis is None:
+            return False
+        try:
+            return bool(await self.redis.sismember(KNOWN_USERS_KEY, user_id))
+        except RedisError as e:
+            logger.error("Множество пользователей недоступно: %s", e)
+            return False
+
+    async def add(self, user_id: int):
+        if self.redis is None:
+            return
+        try:
+            await self.redis.sadd(KNOWN_USERS_KEY, user_id)
+        except RedisError as e:
+            logger.error("Не удалось добавить пользователя в множество: %s", e)
+
+    async def discard(self, user_ids: list[int]):
+        """Убирает пользователей из множества: их следующий /start пройдёт через БД."""
+        if self.redis is None or not user_ids:
+            return
+        try:
+            await self.redis.srem(KNOWN_USERS_KEY, *user_ids)
+        except RedisError as e:
+            logger.error("Не удалось убрать пользователей из множества: %s", e)
+
+
+# Общее множество известных пользователей
+known_users = KnownUsers()
@@ -0,0 +1,226 @@
+import logging
+from array import array
+from bisect import bisect_left
+from datetime import datetime, timedelta
+
+import pytz
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+logger = logging.getLogger(__name__)
+
+# Категории рейтингов помимо лиг (лиги — значения LeagueEnum)
+CATEGORY_QUESTIONS = "questions"
+CATEGORY_SUBSCRIPTIONS = "subscriptions"
+CATEGORY_REFERRALS = "referrals"
+
+# Рейтинг прошлых недель храним ещё месяц
+LEADERBOARD_TTL = 60 * 60 * 24 * 7 * 5
+
+# Строк на странице рейтинга
+PAGE_SIZE = 10
+
+
+def get_week_id(now: datetime | None = None) -> str:
+    """ISO-неделя по московскому времени, например '2026-W42'."""
+    now = now or datetime.now(pytz.timezone('Europe/Moscow'))
+    year, week, _ = now.isocalendar()
+    return f"{year}-W{week:02d}"
+
+
+def get_week_range(week: str) -> tuple[datetime, datetime]:
+    """Границы ISO-недели по московскому времени в UTC: [понедельник 00:00, следующий понедельник)."""
+    year, number = week.split("-W")
+    start = datetime.fromisocalendar(int(year), int(number), 1)
+    start = pytz.timezone('Europe/Moscow').localize(start)
+    return start.astimezone(pytz.utc), (start + timedelta(days=7)).astimezone(pytz.utc)
+
+
+def _page_start(size: int, position: int | None, after=None, before=None, around=None) -> int | None:
+    """
+    Начало страницы рейтинга по позиции якоря (с 0).
+
+    Якорь страницы — последняя (after) или первая (before) строка уже
+    показанной страницы либо сам пользователь (around).
+    """
+    if after is not None:
+        return position + 1
+    if before is not None:
+        return max(0, position - size)
+    if around is not None:
+        return None if position is None else max(0, position - size // 2)
+    return 0
+
+
+class RatingTable:
+    """
+    Отсортированный рейтинг в компактном виде.
+
+    ID пользователей и результаты хранятся в array-колонках, а индекс
+    user_id -> позиция позволяет найти место пользователя за O(1) вместо
+    линейного прохода по списку.
+    """
+
+    def __init__(self, rows):
+        self.user_ids = array('q')
+        self.scores = array('d')
+        for user_id, value in rows:
+            self.user_ids.append(user_id)
+            self.scores.append(value or 0)
+        self.ranks = {user_id: index for index, user_id in enumerate(self.user_ids)}
+
+    @classmethod
+    def from_bytes(cls, user_ids: bytes, scores: bytes) -> "RatingTable":
+        """Восстанавливает рейтинг из колонок, сохранённых через array.tobytes()."""
+        table = cls(())
+        table.user_ids.frombytes(user_ids)
+        table.scores.frombytes(scores)
+        table.ranks = {user_id: index for index, user_id in enumerate(table.user_ids)}
+        return table
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def __iter__(self):
+        return zip(self.user_ids, self.scores)
+
+    def rank(self, user_id: int) -> int | None:
+        """Место пользователя (с 1) или None."""
+        index = self.ranks.get(user_id)
+        return None if index is None else index + 1
+
+    def position(self, score: float, user_id: int) -> int:
+        """
+        Позиция строки (результат, user_id) в рейтинге (с 0).
+
+        Если результат пользователя с тех пор изменился, позиция определяется по
+        результату: число строк с большим результатом (бинарный поиск).
+        """
+        index = self.ranks.get(user_id)
+        if index is not None and self.scores[index] == score:
+            return index
+        return bisect_left(self.scores, -score, key=lambda value: -value)
+
+    def page(self, size: int = PAGE_SIZE, after=None, before=None, around: int | None = None) -> list | None:
+        """
+        Страница рейтинга по ключу (результат, user_id), без OFFSET-сканирования.
+
+        Args:
+            size (int): Строк на странице.
+            after (tuple, optional): (результат, user_id) последней строки предыдущей страницы.
+            before (tuple, optional): (результат, user_id) первой строки следующей страницы.
+            around (int, optional): Страница вокруг пользователя.
+
+        Returns:
+            list: Список (место, user_id, результат); None, если пользователя around нет в рейтинге.
+        """
+        anchor = after or before
+        position = self.position(*anchor) if anchor else self.ranks.get(around)
+        start = _page_start(size, position, after, before, around)
+        if start is None:
+            return None
+        end = min(len(self.user_ids), start + size)
+        return [(rank + 1, self.user_ids[rank], self.scores[rank]) for rank in range(start, end)]
+
+
+class Leaderboard:
+    """
+    Недельные рейтинги в Redis sorted sets.
+
+    Рейтинг обновляется инкрементально (ZINCRBY) в момент события: завершение
+    игры, предложенный вопрос, подписка, приглашённый друг. Чтение места и
+    соседей пользователя — ZREVRANK и ZREVRANGE, без агрегатов по БД.
+    """
+
+    def __init__(self):
+        self.redis: Redis | None = None
+
+    def setup(self, redis: Redis):
+        self.redis = redis
+
+    @staticmethod
+    def key(category: str, week: str | None = None) -> str:
+        return f"rating:{week or get_week_id()}:{category}"
+
+    async def increment(self, category: str, user_id: int, amount: float = 1):
+        """
+        Увеличивает результат пользователя в рейтинге текущей недели.
+
+        Ошибки Redis не прерывают обработку апдейта — только логируются.
+        """
+        if self.redis is None or not amount:
+            return
+        key = self.key(category)
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.zincrby(key, amount, user_id)
+                pipe.expire(key, LEADERBOARD_TTL)
+                await pipe.execute()
+        except RedisError as e:
+            logger.error("Не удалось обновить рейтинг %s: %s", key, e)
+
+    async def seed(self, category: str, rows, week: str | None = None) -> bool:
+        """
+        Заполняет рейтинг недели готовыми результатами, если его ещё нет в Redis.
+
+        Args:
+            category (str): Категория рейтинга.
+            rows: Пары (user_id, результат).
+            week (str, optional): Неделя; по умолчанию текущая.
+
+        Returns:
+            bool: True, если рейтинг был заполнен.
+        """
+        key = self.key(category, week)
+        mapping = {str(user_id): float(value) for user_id, value in rows if value}
+        if not mapping or await self.redis.exists(key):
+            return False
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.zadd(key, mapping, nx=True)
+            pipe.expire(key, LEADERBOARD_TTL)
+            await pipe.execute()
+        return True
+
+    async def page(self, category: str, size: int = PAGE_SIZE, after=None, before=None,
+                   around: int | None = None) -> tuple[list | None, int]:
+        """
+        Страница рейтинга по ключу (результат, user_id) за два round-trip.
+
+        Позиция якоря находится через ZREVRANK/ZCOUNT за O(log N), затем
+        читается одна страница ZREVRANGE — без перебора предыдущих страниц.
+        Параметры те же, что у RatingTable.page.
+
+        Returns:
+            tuple: (список (место, user_id, результат) или None, если пользователя
+            around нет в рейтинге; всего строк в рейтинге).
+        """
+        key = self.key(category)
+        anchor = after or before
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.zcard(key)
+            if anchor:
+                score, user_id = anchor
+                pipe.zrevrank(key, user_id)
+                pipe.zscore(key, user_id)
+                pipe.zcount(key, f"({score}", "+inf")
+            elif around is not None:
+                pipe.zrevrank(key, around)
+            total, *lookup = await pipe.execute()
+
+        position = None
+        if anchor:
+            rank, current_score, higher = lookup
+            # Результат якоря мог измениться — тогда позиционируемся по результату
+            position = rank if rank is not None and current_score == float(anchor[0]) else higher
+        elif around is not None:
+            position = lookup[0]
+
+        start = _page_start(size, position, after, before, around)
+        if start is None:
+            return None, total
+        members = await self.redis.zrevrange(key, start, start + size - 1, withscores=True)
+        return [(start + offset + 1, int(member), score) for offset, (member, score) in enumerate(members)], total
+
+
+# Общие рейтинги процесса
+leaderboard = Leaderboard()
@@ -0,0 +1,208 @@
+import asyncio
+import logging
+from collections import defaultdict
+
+from sqlalchemy import select, update, insert, func
+from sqlalchemy.exc import IntegrityError, DataError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from db.db_functions import credit_balances, BALANCE_COLUMNS
+from db.models import CoinLedger, async_session_maker
+
+logger = logging.getLogger(__name__)
+
+# Причины движения монет
+LEDGER_GAME_REWARD = "game_reward"
+LEDGER_ENTRY_FEE = "entry_fee"
+LEDGER_REFERRAL = "referral"
+LEDGER_SUBSCRIPTION = "subscription"
+LEDGER_EXCHANGE = "exchange"
+LEDGER_PAYMENT = "payment"
+
+# Интервалы фоновых задач (секунды) и размер пакета вставки
+FLUSH_INTERVAL = 1
+MATERIALIZE_INTERVAL = 10
+BATCH_SIZE = 500
+
+
+class Ledger:
+    """
+    Журнал движений монет с отложенной записью.
+
+    Записи копятся во внутренней очереди и пишутся в `coin_ledger` пакетным
+    многострочным INSERT. Начисления (награды, рефералы, подписки) не трогают
+    строку пользователя: materialize() периодически переносит неучтённые
+    записи в Users.balance_* одним пакетом. Списания выполняются сразу
+    условным UPDATE (db_functions.debit_balance) и попадают в журнал уже
+    учтёнными (applied=True) — только для аудита.
+    """
+
+    def __init__(self, sessionmaker: async_sessionmaker[AsyncSession]):
+        self.sessionmaker = sessionmaker
+        self._queue: list[dict] = []
+        # Неучтённые суммы, ещё не записанные в БД: (user_id, currency) -> сумма
+        self._queued: dict[tuple[int, str], float] = defaultdict(float)
+        self._flush_lock = asyncio.Lock()
+
+    def record(self, user_id: int, currency: str, amount: float, reason: str, applied: bool = False):
+        """
+        Ставит запись в очередь на запись в журнал (без ожидания БД).
+
+        Args:
+            user_id (int): Telegram ID пользователя.
+            currency (str): Валюта ("rubles", "bronze", "silver", "gold").
+            amount (float): Сумма; отрицательная — списание.
+            reason (str): Причина (константы LEDGER_*).
+            applied (bool): Уже учтено в балансе (списания и прямые зачисления).
+
+        Raises:
+            ValueError: Неизвестная валюта (такая запись не могла бы попасть в баланс).
+        """
+        currency = currency.lower()
+        if currency not in BALANCE_COLUMNS:
+            raise ValueError(f"Неизвестная валюта: {currency}")
+        self._queue.append({
+            "user_id": user_id, "currency": currency, "amount": amount,
+            "reason": reason, "applied": applied,
+        })
+        if not applied:
+            self._queued[(user_id, currency)] += amount
+
+    async def _insert(self, batch: list[dict]):
+        """
+        Записывает пакет. Если пакет отклонён из-за данных (например, пользователя
+        нет в `users`), записи вставляются по одной в savepoint'ах одной
+        транзакции: испорченные отбрасываются с записью в лог, остальные
+        фиксируются. Сбой соединения пробрасывается, ничего не зафиксировав.
+        """
+        try:
+            async with self.sessionmaker() as session:
+                await session.execute(insert(CoinLedger), batch)
+                await session.commit()
+            return
+        except (IntegrityError, DataError) as e:
+            logger.warning("Пакет журнала монет отклонён, ищем испорченные записи: %s", e)
+
+        async with self.sessionmaker() as session:
+            for row in batch:
+                try:
+                    async with session.begin_nested():
+                        await session.execute(insert(CoinLedger).values(**row))
+                except (IntegrityError, DataError) as e:
+                    logger.error("Запись журнала монет отброшена: %s (%s)", row, e)
+            await session.commit()
+
+    async def flush(self):
+        """Записывает накопленные записи многострочным INSERT."""
+        async with self._flush_lock:
+            while self._queue:
+                batch, self._queue = self._queue[:BATCH_SIZE], self._queue[BATCH_SIZE:]
+                try:
+                    await self._insert(batch)
+                except Exception:
+                    # Сбой БД: возвращаем пакет в очередь, чтобы не потерять движения монет
+                    self._queue = batch + self._queue
+                    raise
+
+                for row in batch:
+                    if not row["applied"]:
+                        key = (row["user_id"], row["currency"])
+                        self._queued[key] -= row["amount"]
+                        if not self._queued[key]:
+                            del self._queued[key]
+
+    async def materialize(self, session: AsyncSession, user_id: int | None = None) -> int:
+        """
+        Переносит неучтённые записи журнала в балансы пользователей.
+
+        Записи сначала помечаются учтёнными (UPDATE ... RETURNING), поэтому
+        параллельный вызов из другого процесса не применит их повторно.
+        Не коммитит: вызывающий код коммитит вместе со своей транзакцией.
+
+        Args:
+            session (AsyncSession): Асинхронная сессия SQLAlchemy.
+            user_id (int, optional): Только для одного пользователя (read-through).
+
+        Returns:
+            int: Количество учтённых записей.
+        """
+        claim = (
+            update(CoinLedger)
+            .where(CoinLedger.applied.is_(False), CoinLedger.currency.in_(BALANCE_COLUMNS))
+            .values(applied=True)
+            .returning(CoinLedger.user_id, CoinLedger.currency, CoinLedger.amount)
+            .execution_options(synchronize_session=False)
+        )
+        if user_id is not None:
+            claim = claim.where(CoinLedger.user_id == user_id)
+        rows = (await session.execute(claim)).all()
+
+        totals: dict[str, dict[int, float]] = defaultdict(lambda: defaultdict(float))
+        for row_user_id, currency, amount in rows:
+            totals[currency][row_user_id] += amount
+
+        # Один порядок блокировок во всех транзакциях: валюты и пользователи по возрастанию
+        for currency in sorted(totals):
+            await credit_balances(session, currency, totals[currency])
+        return len(rows)
+
+    async def settle_user(self, session: AsyncSession, user_id: int) -> bool:
+        """
+        Read-through для одного пользователя: дописывает очередь и учитывает его
+        записи в балансе, чтобы условное списание видело свежие начисления.
+
+        Returns:
+            bool: True, если в балансе появились новые начисления.
+        """
+        if not any(key[0] == user_id for key in self._queued):
+            pending = await session.scalar(
+                select(func.count(CoinLedger.id))
+                .where(CoinLedger.user_id == user_id, CoinLedger.applied.is_(False))
+            )
+            if not pending:
+                return False
+        await self.flush()
+        return await self.materialize(session, user_id) > 0
+
+    async def pending(self, session: AsyncSession, user_id: int) -> dict[str, float]:
+        """
+        Неучтённые в балансе суммы пользователя по валютам (журнал + очередь процесса).
+        """
+        result = await session.execute(
+            select(CoinLedger.currency, func.sum(CoinLedger.amount))
+            .where(CoinLedger.user_id == user_id, CoinLedger.applied.is_(False))
+            .group_by(CoinLedger.currency)
+        )
+        totals = defaultdict(float, {currency: amount for currency, amount in result.all()})
+        for (queued_user_id, currency), amount in self._queued.items():
+            if queued_user_id == user_id:
+                totals[currency] += amount
+        return totals
+
+    async def run(self):
+        """Фоновая задача: периодическая запись очереди и перенос в балансы."""
+        loop = asyncio.get_running_loop()
+        next_materialize = loop.time() + MATERIALIZE_INTERVAL
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error("Ошибка записи журнала монет: %s", e)
+
+            # Перенос в балансы не зависит от записи очереди: уже записанное учитывается всегда
+            if loop.time() < next_materialize:
+                continue
+            next_materialize = loop.time() + MATERIALIZE_INTERVAL
+            try:
+                async with self.sessionmaker() as session:
+                    applied = await self.materialize(session)
+                    await session.commit()
+                if applied:
+                    logger.info("Учтено записей журнала монет: %s", applied)
+            except Exception as e:
+                logger.error("Ошибка переноса журнала монет в балансы: %s", e)
+
+
+# Общий журнал монет процесса
+ledger = Ledger(async_session_maker)
@@ -0,0 +1,225 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Awaitable
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import TelegramMethod, Response
+
+logger = logging.getLogger(__name__)
+
+# Классы приоритета исходящих сообщений (меньше — важнее)
+PRIORITY_INTERACTIVE = 0  # Ответы на действия пользователя (игра, меню)
+PRIORITY_NOTIFICATION = 1  # Уведомления (рефералы, призы)
+PRIORITY_BROADCAST = 2  # Массовые рассылки
+
+# Лимиты Telegram: ~30 сообщений в секунду на бота, ~1 в секунду в личный чат
+# (с небольшим запасом на всплеск) и 20 в минуту в группу
+GLOBAL_RATE = 30
+GLOBAL_BURST = 30
+PRIVATE_CHAT_RATE = 1
+PRIVATE_CHAT_BURST = 3
+GROUP_CHAT_RATE = 20 / 60
+GROUP_CHAT_BURST = 3
+
+MAX_RETRIES = 3
+# Ведро чата, к которому не обращались дольше этого времени, удаляется
+CHAT_BUCKET_IDLE = 60
+
+# Методы Bot API, на которые распространяются лимиты отправки
+LIMITED_PREFIXES = ("send", "copy", "forward", "edit")
+
+outbound_priority: ContextVar[int] = ContextVar("outbound_priority", default=PRIORITY_INTERACTIVE)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def level(self, now: float) -> float:
+        """Количество токенов на момент now с учётом пополнения с последнего обращения."""
+        return min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+
+    def take(self, cost: float = 1) -> float:
+        """Забирает cost токенов; возвращает 0 или сколько секунд ждать, пока их хватит."""
+        now = time.monotonic()
+        self.tokens = self.level(now)
+        self.updated = now
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0
+        return (cost - self.tokens) / self.rate
+
+    def block(self, seconds: float):
+        """Опустошает ведро на заданное время (после ответа 429)."""
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+        self.updated = time.monotonic()
+
+
+def evict_idle_buckets(buckets: dict, idle: float) -> dict:
+    """
+    Убирает вёдра, к которым не обращались дольше idle секунд и которые уже
+    успели наполниться: новое ведро для того же ключа будет таким же.
+
+    Returns:
+        dict: Оставшиеся вёдра.
+    """
+    now = time.monotonic()
+    return {
+        key: bucket for key, bucket in buckets.items()
+        if now - bucket.updated < idle or bucket.level(now) < bucket.capacity
+    }
+
+
+class OutboundDispatcher(BaseRequestMiddleware):
+    """
+    Планировщик исходящих запросов бота (request middleware сессии).
+
+    Все отправки проходят через ведро токенов своего чата и общее ведро бота.
+    Когда общего лимита не хватает, запросы ждут в очереди с приоритетами:
+    ответы в игре и меню обслуживаются раньше уведомлений и рассылок.
+    Ответ 429 (retry_after) блокирует ведро чата, приостанавливает фоновые
+    отправки и повторяет запрос после паузы.
+    """
+
+    def __init__(self):
+        self.global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_BURST)
+        self._chats: dict[int | str, TokenBucket] = {}
+        self._waiters: list = []
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._scheduler: asyncio.Task | None = None
+        # Фоновые отправки приостановлены до этого момента (после 429)
+        self._paused_until = 0.0
+        self._tasks: set[asyncio.Task] = set()
+        self._last_cleanup = time.monotonic()
+
+    @contextmanager
+    def priority(self, priority: int):
+        """Задаёт приоритет для отправок внутри блока."""
+        token = outbound_priority.set(priority)
+        try:
+            yield
+        finally:
+            outbound_priority.reset(token)
+
+    def submit(self, call: Awaitable, priority: int = PRIORITY_NOTIFICATION) -> asyncio.Task:
+        """
+        Отправка "выстрелил и забыл": запрос выполняется в фоне с заданным
+        приоритетом, ошибки только логируются.
+
+        Args:
+            call: Корутина запроса, например bot.send_message(chat_id, text).
+            priority (int): Класс приоритета (PRIORITY_*).
+        """
+        async def run():
+            outbound_priority.set(priority)
+            try:
+                await call
+            except Exception as e:
+                logger.error("Фоновая отправка не удалась: %s", e)
+
+        task = asyncio.create_task(run())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def _chat_bucket(self, chat_id: int | str) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            bucket = TokenBucket(GROUP_CHAT_RATE, GROUP_CHAT_BURST) if is_group \
+                else TokenBucket(PRIVATE_CHAT_RATE, PRIVATE_CHAT_BURST)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    def _cleanup(self):
+        now = time.monotonic()
+        if now - self._last_cleanup < CHAT_BUCKET_IDLE:
+            return
+        self._last_cleanup = now
+        self._chats = evict_idle_buckets(self._chats, CHAT_BUCKET_IDLE)
+
+    async def _wait_chat(self, chat_id: int | str):
+        bucket = self._chat_bucket(chat_id)
+        while (delay := bucket.take()) > 0:
+            await asyncio.sleep(delay)
+
+    async def _wait_global(self, priority: int):
+        paused = priority > PRIORITY_INTERACTIVE and time.monotonic() < self._paused_until
+        if not self._waiters and not paused and self.global_bucket.take() == 0:
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        self._wakeup.set()
+        if self._scheduler is None or self._scheduler.done():
+            self._scheduler = asyncio.create_task(self._schedule())
+        await future
+
+    async def _schedule(self):
+        """Выдаёт токены общего ведра ожидающим в порядке приоритета."""
+        while self._waiters:
+            priority, _, future = self._waiters[0]
+            if future.cancelled():
+                heapq.heappop(self._waiters)
+                continue
+
+            delay = 0.0
+            if priority > PRIORITY_INTERACTIVE:
+                delay = self._paused_until - time.monotonic()
+            if delay <= 0:
+                delay = self.global_bucket.take()
+            if delay <= 0:
+                heapq.heappop(self._waiters)
+                future.set_result(None)
+                continue
+
+            # Ждём токен, но просыпаемся раньше, если пришёл более важный запрос
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType,
+        bot: Bot,
+        method: TelegramMethod,
+    ) -> Response:
+        api_method = getattr(method, "__api_method__", "")
+        if not api_method.startswith(LIMITED_PREFIXES):
+            return await make_request(bot, method)
+
+        chat_id = getattr(method, "chat_id", None)
+        priority = outbound_priority.get()
+        self._cleanup()
+        for attempt in range(MAX_RETRIES + 1):
+            if chat_id is not None:
+                await self._wait_chat(chat_id)
+            await self._wait_global(priority)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt == MAX_RETRIES:
+                    raise
+                logger.warning("Лимит Telegram (%s, чат %s): пауза %s с", api_method, chat_id, e.retry_after)
+                # Фоновые отправки уступают интерактивным на время паузы
+                self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+                if chat_id is not None:
+                    self._chat_bucket(chat_id).block(e.retry_after)  # Следующая попытка дождётся ведра чата
+                else:
+                    await asyncio.sleep(e.retry_after)
+
+
+# Общий планировщик исходящих сообщений бота
+outbound = OutboundDispatcher()
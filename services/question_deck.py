@@ -0,0 +1,109 @@
+import logging
+import random
+
+from redis.asyncio import Redis
+
+from services.question_pool import QuestionPool, QuestionRecord, question_pool
+
+logger = logging.getLogger(__name__)
+
+# Колода живёт месяц с момента последней игры
+DECK_TTL = 60 * 60 * 24 * 30
+
+
+class QuestionDeck:
+    """
+    Персональные колоды вопросов без повторов.
+
+    Для каждого игрока и пары (лига, сложность) в Redis хранится перемешанный
+    список ID вопросов. Вопросы берутся с головы списка (LPOP), а когда колода
+    заканчивается — она перемешивается заново. Рядом хранится наибольший ID
+    вопроса на момент сборки колоды: если админ добавил вопросы, они
+    подмешиваются в остаток колоды.
+
+    Пул процесса может отставать от БД (вопрос добавлен в другом процессе),
+    поэтому неизвестные пулу ID сначала ищутся в БД и только отсутствующие
+    там считаются удалёнными, а отметка наибольшего ID никогда не уменьшается.
+    """
+
+    def __init__(self, pool: QuestionPool):
+        self.pool = pool
+        self.redis: Redis | None = None
+
+    def setup(self, redis: Redis):
+        self.redis = redis
+
+    @staticmethod
+    def _key(user_id: int, league: str, difficulty: str) -> str:
+        return f"deck:{user_id}:{league}:{difficulty}"
+
+    async def draw(self, user_id: int, league: str, difficulty: str, k: int) -> list[QuestionRecord]:
+        """
+        Выдаёт игроку k вопросов, которых он ещё не видел в текущем проходе колоды.
+
+        Args:
+            user_id (int): Telegram ID игрока.
+            league (str): Лига ("Bronze", "Silver", "Gold").
+            difficulty (str): Сложность ("Easy", "Medium", "Hard").
+            k (int): Количество вопросов.
+
+        Returns:
+            list: Записи вопросов; пустой список, если вопросов в пуле меньше k.
+        """
+        if self.redis is None:
+            return self.pool.sample(league, difficulty, k)
+
+        if len(self.pool.ids(league, difficulty)) < k:
+            return []
+
+        key = self._key(user_id, league, difficulty)
+        watermark_key = f"{key}:max"
+
+        # Основной путь — один round-trip
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.get(watermark_key)
+            pipe.lpop(key, k)
+            pipe.expire(key, DECK_TTL)
+            pipe.expire(watermark_key, DECK_TTL)
+            watermark, popped, *_ = await pipe.execute()
+
+        watermark = int(watermark) if watermark is not None else None
+        if watermark is not None and watermark > self.pool.max_id(league, difficulty):
+            # Колоду собирал процесс с более свежим пулом — догружаем новые вопросы
+            await self.pool.refresh()
+
+        popped = [int(i) for i in popped or []]
+        await self.pool.fetch(popped)
+        # Пропускаем только вопросы, которых нет и в БД
+        drawn = [i for i in popped if self.pool.get(i) is not None]
+        ids = self.pool.ids(league, difficulty)
+        max_id = max(self.pool.max_id(league, difficulty), watermark or 0)
+
+        if len(drawn) < k:
+            # Колода закончилась — собираем новую, исключая уже выданные вопросы
+            deck = [i for i in ids if i not in drawn]
+            random.shuffle(deck)
+            need = k - len(drawn)
+            drawn += deck[:need]
+            await self._store(key, watermark_key, deck[need:], max_id)
+        elif watermark is not None and watermark < max_id:
+            # Админ добавил вопросы — подмешиваем их в остаток колоды
+            rest = [int(i) for i in await self.redis.lrange(key, 0, -1)]
+            rest += [i for i in ids if i > watermark]
+            random.shuffle(rest)
+            await self._store(key, watermark_key, rest, max_id)
+
+        return [self.pool.get(i) for i in drawn]
+
+    async def _store(self, key: str, watermark_key: str, deck: list[int], max_id: int):
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.delete(key)
+            if deck:
+                pipe.rpush(key, *deck)
+                pipe.expire(key, DECK_TTL)
+            pipe.set(watermark_key, max_id, ex=DECK_TTL)
+            await pipe.execute()
+
+
+# Общие колоды вопросов процесса
+question_deck = QuestionDeck(question_pool)
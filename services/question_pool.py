@@ -0,0 +1,154 @@
+import asyncio
+import logging
+import random
+from typing import NamedTuple
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from db.models import Question, async_session_maker
+
+logger = logging.getLogger(__name__)
+
+# Как часто процесс догружает вопросы, добавленные в других процессах
+REFRESH_INTERVAL = 30
+
+
+class QuestionRecord(NamedTuple):
+    """Компактная запись вопроса, хранимая в памяти процесса."""
+    id: int
+    league: str
+    difficulty: str
+    question_text: str
+    correct_answer: str
+    incorrect_answers: tuple[str, str, str]
+
+
+def _enum_value(value) -> str:
+    # Колонки league/difficulty возвращают Enum, а вопросы из админки приходят строками
+    return getattr(value, "value", value)
+
+
+class QuestionPool:
+    """
+    Индекс вопросов в памяти процесса.
+
+    Для каждой пары (лига, сложность) хранит список ID вопросов, а сами вопросы —
+    в словаре компактных записей. Выборка вопросов для игры выполняется за O(k)
+    без обращения к базе данных.
+
+    Вопрос, добавленный админом, сразу попадает в пул его процесса; остальные
+    процессы догружают новые вопросы (ID больше известного) раз в
+    REFRESH_INTERVAL секунд, а неизвестный ID подгружают из БД по запросу.
+    """
+
+    def __init__(self, sessionmaker: async_sessionmaker[AsyncSession]):
+        self.sessionmaker = sessionmaker
+        self._ids: dict[tuple[str, str], list[int]] = {}
+        self._records: dict[int, QuestionRecord] = {}
+        self._max_ids: dict[tuple[str, str], int] = {}
+        self._max_id = 0
+        self.loaded = False
+
+    async def load(self, session: AsyncSession):
+        """
+        Загружает все вопросы из базы данных. Вызывается при старте бота.
+
+        Args:
+            session (AsyncSession): Асинхронная сессия SQLAlchemy.
+        """
+        result = await session.execute(select(Question))
+        self._ids.clear()
+        self._records.clear()
+        self._max_ids.clear()
+        self._max_id = 0
+        for question in result.scalars().all():
+            self.add(question)
+        self.loaded = True
+        logger.info("Пул вопросов загружен: %s вопросов", len(self._records))
+
+    def add(self, question: Question) -> QuestionRecord:
+        """Добавляет (или обновляет) вопрос в пуле."""
+        record = QuestionRecord(
+            id=question.id,
+            league=_enum_value(question.league),
+            difficulty=_enum_value(question.difficulty),
+            question_text=question.question_text,
+            correct_answer=question.correct_answer,
+            incorrect_answers=(question.answer_2, question.answer_3, question.answer_4),
+        )
+        bucket = (record.league, record.difficulty)
+        previous = self._records.get(record.id)
+        if previous is not None and (previous.league, previous.difficulty) != bucket:
+            # Вопрос перенесён в другую лигу или сложность — убираем его из прежней группы
+            self._ids[(previous.league, previous.difficulty)].remove(record.id)
+            previous = None
+        if previous is None:
+            self._ids.setdefault(bucket, []).append(record.id)
+            self._max_ids[bucket] = max(self._max_ids.get(bucket, 0), record.id)
+            self._max_id = max(self._max_id, record.id)
+        self._records[record.id] = record
+        return record
+
+    async def refresh(self) -> int:
+        """
+        Догружает вопросы, добавленные после последней загрузки (в том числе другими процессами).
+
+        Returns:
+            int: Количество догруженных вопросов.
+        """
+        async with self.sessionmaker() as session:
+            result = await session.execute(select(Question).where(Question.id > self._max_id).order_by(Question.id))
+            added = [self.add(question) for question in result.scalars().all()]
+        if added:
+            logger.info("В пул догружено вопросов: %s", len(added))
+        return len(added)
+
+    async def fetch(self, question_ids: list[int]):
+        """Загружает из БД вопросы, которых ещё нет в пуле процесса."""
+        missing = [question_id for question_id in question_ids if question_id not in self._records]
+        if not missing:
+            return
+        async with self.sessionmaker() as session:
+            result = await session.execute(select(Question).where(Question.id.in_(missing)))
+            for question in result.scalars().all():
+                self.add(question)
+
+    async def run(self):
+        """Фоновая задача: периодически догружает новые вопросы."""
+        while True:
+            await asyncio.sleep(REFRESH_INTERVAL)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error("Ошибка обновления пула вопросов: %s", e)
+
+    def get(self, question_id: int) -> QuestionRecord | None:
+        return self._records.get(question_id)
+
+    def ids(self, league: str, difficulty: str) -> list[int]:
+        """Список ID вопросов для лиги и сложности (не изменять снаружи)."""
+        return self._ids.get((league, difficulty), [])
+
+    def max_id(self, league: str, difficulty: str) -> int:
+        """Наибольший ID вопроса в группе — по нему колоды игроков узнают о новых вопросах."""
+        return self._max_ids.get((league, difficulty), 0)
+
+    def count(self, league: str, difficulty: str) -> int:
+        return len(self.ids(league, difficulty))
+
+    def sample(self, league: str, difficulty: str, k: int) -> list[QuestionRecord]:
+        """
+        Случайная выборка k вопросов без повторов.
+
+        Returns:
+            list: Список записей; пустой, если вопросов меньше k.
+        """
+        ids = self.ids(league, difficulty)
+        if len(ids) < k:
+            return []
+        return [self._records[question_id] for question_id in random.sample(ids, k)]
+
+
+# Общий пул вопросов процесса
+question_pool = QuestionPool(async_session_maker)
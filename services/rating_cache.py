@@ -0,0 +1,186 @@
+import asyncio
+import logging
+import time
+import uuid
+from typing import Awaitable, Callable
+
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+from sqlalchemy.exc import SQLAlchemyError
+
+from services.leaderboard import RatingTable, get_week_id
+
+logger = logging.getLogger(__name__)
+
+# Снимок хранится отдельно для каждой недели: rating:snapshot:<неделя>
+SNAPSHOT_KEY = "rating:snapshot"
+LOCK_KEY = "rating:snapshot:lock"
+
+# Снимок пересобирается по расписанию раз в 5 минут; если фоновая пересборка
+# не работает, читатель запускает её сам, когда снимок старше STALE_AFTER.
+# Локальная копия процесса живёт 30 секунд
+REFRESH_INTERVAL = 300
+STALE_AFTER = 3 * REFRESH_INTERVAL
+SNAPSHOT_TTL = 24 * 3600
+LOCAL_TTL = 30
+LOCK_TTL_MS = 120_000
+WAIT_STEP = 0.5
+
+# Снимаем блокировку, только если она всё ещё наша
+RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class RatingCache:
+    """
+    Общий для всех процессов снимок рейтингов текущей недели в Redis.
+
+    Снимок собирает один процесс, захвативший блокировку в Redis, — по
+    расписанию (run) или если снимка текущей недели ещё нет. Читатели
+    получают последний снимок даже если он устарел (stale-while-revalidate),
+    а одновременные запросы внутри процесса ждут одну и ту же загрузку
+    (single-flight), поэтому истечение кеша не порождает волну одинаковых
+    GROUP BY. Снимок привязан к неделе, поэтому после смены недели итоги
+    прошлой не выдаются за текущие. Если Redis недоступен, снимок
+    собирается прямо из БД и живёт в памяти процесса LOCAL_TTL секунд.
+    """
+
+    def __init__(self, loader: Callable[[str], Awaitable[dict[str, RatingTable]]]):
+        self.loader = loader
+        self.redis: Redis | None = None
+        self._local: dict[str, RatingTable] | None = None
+        self._local_week: str | None = None
+        self._local_at = 0.0
+        self._inflight: asyncio.Task | None = None
+        self._revalidating: asyncio.Task | None = None
+
+    def setup(self, redis: Redis):
+        self.redis = redis
+
+    @staticmethod
+    def key(week: str) -> str:
+        return f"{SNAPSHOT_KEY}:{week}"
+
+    async def get(self) -> dict[str, RatingTable]:
+        """Возвращает снимок рейтингов текущей недели: категория -> RatingTable."""
+        week = get_week_id()
+        is_current = self._local is not None and self._local_week == week
+        if is_current and time.monotonic() - self._local_at < LOCAL_TTL:
+            return self._local
+
+        if self._inflight is None:
+            self._inflight = asyncio.create_task(self._fetch(week))
+            self._inflight.add_done_callback(self._clear_inflight)
+        try:
+            return await asyncio.shield(self._inflight)
+        except (SQLAlchemyError, OSError) as e:
+            if not is_current:
+                raise
+            logger.error("Не удалось обновить снимок рейтинга, отдаём прежний: %s", e)
+            return self._local
+
+    def _clear_inflight(self, _task):
+        self._inflight = None
+
+    async def _fetch(self, week: str) -> dict[str, RatingTable]:
+        data = None
+        if self.redis is not None:
+            try:
+                data, built_at = await self._read(week)
+                if data is None:
+                    data = await self.refresh(week, wait=True)
+                elif time.time() - built_at > STALE_AFTER:
+                    self._revalidate(week)
+            except (RedisError, OSError) as e:
+                logger.error("Снимок рейтинга в Redis недоступен, собираем из БД: %s", e)
+                data = None
+        if data is None:
+            data = await self.loader(week)
+        self._local, self._local_week, self._local_at = data, week, time.monotonic()
+        return data
+
+    def _revalidate(self, week: str):
+        # Запасная пересборка в фоне: текущий запрос получает устаревший снимок без ожидания
+        if self._revalidating is None or self._revalidating.done():
+            self._revalidating = asyncio.create_task(self._refresh_in_background(week))
+
+    async def _refresh_in_background(self, week: str):
+        try:
+            if await self.refresh(week) is not None:
+                logger.info("Снимок рейтинга пересобран")
+        except Exception as e:
+            logger.error("Ошибка пересборки снимка рейтинга: %s", e)
+
+    async def refresh(self, week: str, wait: bool = False) -> dict[str, RatingTable] | None:
+        """
+        Пересобирает снимок недели, если удалось захватить блокировку.
+
+        Args:
+            week (str): Неделя снимка.
+            wait (bool): Если снимок собирает другой процесс — дождаться его.
+
+        Returns:
+            dict: Новый снимок; None, если его собирает другой процесс и wait=False.
+        """
+        token = uuid.uuid4().hex
+        if await self.redis.set(LOCK_KEY, token, nx=True, px=LOCK_TTL_MS):
+            try:
+                data = await self.loader(week)
+                await self._write(week, data)
+                return data
+            finally:
+                await self.redis.eval(RELEASE_LOCK_SCRIPT, 1, LOCK_KEY, token)
+
+        if not wait:
+            return None
+
+        # Другой процесс уже собирает снимок — ждём его появления
+        for _ in range(int(LOCK_TTL_MS / 1000 / WAIT_STEP)):
+            await asyncio.sleep(WAIT_STEP)
+            data, _ = await self._read(week)
+            if data is not None:
+                return data
+        return await self.loader(week)
+
+    async def _read(self, week: str) -> tuple[dict[str, RatingTable] | None, float]:
+        raw = await self.redis.hgetall(self.key(week))
+        if not raw:
+            return None, 0.0
+        built_at = float(raw.pop(b"built_at", 0))
+        data = {}
+        for field, value in raw.items():
+            category, column = field.decode().rsplit(":", 1)
+            if column == "ids":
+                data[category] = RatingTable.from_bytes(value, raw[f"{category}:scores".encode()])
+        return data, built_at
+
+    async def _write(self, week: str, data: dict[str, RatingTable]):
+        mapping = {"built_at": time.time()}
+        for category, table in data.items():
+            mapping[f"{category}:ids"] = table.user_ids.tobytes()
+            mapping[f"{category}:scores"] = table.scores.tobytes()
+        # Пишем во временный ключ и атомарно подменяем снимок
+        key = self.key(week)
+        tmp_key = f"{key}:tmp:{uuid.uuid4().hex}"
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(tmp_key, mapping=mapping)
+            pipe.expire(tmp_key, SNAPSHOT_TTL)
+            pipe.rename(tmp_key, key)
+            await pipe.execute()
+
+    async def run(self):
+        """Фоновая задача: пересборка снимка по расписанию одним из процессов."""
+        while True:
+            try:
+                week = get_week_id()
+                _, built_at = await self._read(week)
+                if time.time() - built_at >= REFRESH_INTERVAL:
+                    if await self.refresh(week) is not None:
+                        logger.info("Снимок рейтинга пересобран")
+            except Exception as e:
+                logger.error("Ошибка пересборки снимка рейтинга: %s", e)
+            await asyncio.sleep(REFRESH_INTERVAL / 5)
@@ -0,0 +1,278 @@
+import asyncio
+import logging
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import pytz
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError, TelegramForbiddenError
+from sqlalchemy import select, update, insert, and_, or_, exists
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from db.db_functions import credit_balances
+from db.models import (
+    WeeklyScore, RatingArchive, WeeklyRollover, WeeklyPrize, CoinLedger, LeagueEnum, async_session_maker
+)
+from services.game import CURRENCY_NAMES
+from services.outbound import outbound, PRIORITY_NOTIFICATION
+from services.leaderboard import leaderboard, get_week_id, CATEGORY_QUESTIONS, CATEGORY_SUBSCRIPTIONS, \
+    CATEGORY_REFERRALS
+
+logger = logging.getLogger(__name__)
+
+LEDGER_WEEKLY_PRIZE = "weekly_prize"
+
+# Призы за места в лиге: валюта и суммы за 1-е, 2-е, 3-е место
+WEEKLY_PRIZES = {
+    LeagueEnum.Bronze.value: ("silver", (300, 200, 100)),
+    LeagueEnum.Silver.value: ("silver", (1000, 500, 250)),
+    LeagueEnum.Gold.value: ("gold", (300, 150, 75)),
+}
+
+# Рейтинги активности замораживаются из Redis (агрегаты лиг — из weekly_scores)
+ACTIVITY_CATEGORIES = (CATEGORY_QUESTIONS, CATEGORY_SUBSCRIPTIONS, CATEGORY_REFERRALS)
+
+CHECK_INTERVAL = 60
+
+
+def get_previous_week_id(now: datetime | None = None) -> str:
+    """Неделя, закончившаяся последней (по московскому времени)."""
+    now = now or datetime.now(pytz.timezone('Europe/Moscow'))
+    return get_week_id(now - timedelta(weeks=1))
+
+
+class RatingRollover:
+    """
+    Закрытие недели: архив рейтингов, выплата призов и уведомления победителей.
+
+    Каждый шаг — отдельная транзакция с отметкой в `weekly_rollovers`, поэтому
+    после сбоя задача продолжает с незавершённого шага, а повторный запуск
+    ничего не дублирует. Итоги лиг берутся из `weekly_scores` (таблица `games`
+    не пересчитывается), итоги активности — из sorted sets прошлой недели.
+    """
+
+    def __init__(self, sessionmaker: async_sessionmaker[AsyncSession]):
+        self.sessionmaker = sessionmaker
+
+    async def archive(self, week: str) -> bool:
+        """
+        Замораживает рейтинги недели в `rating_archive` и фиксирует призы.
+
+        Returns:
+            bool: True, если архив создан этим вызовом.
+        """
+        async with self.sessionmaker() as session:
+            if await session.get(WeeklyRollover, week) is not None:
+                return False
+
+            rows, prizes = [], []
+            for league in LeagueEnum:
+                result = await session.execute(
+                    select(WeeklyScore.user_id, WeeklyScore.total_score)
+                    .where(WeeklyScore.week == week, WeeklyScore.league == league)
+                    .order_by(WeeklyScore.total_score.desc(), WeeklyScore.user_id)
+                )
+                standings = result.all()
+                rows += [
+                    {"week": week, "category": league.value, "rank": rank, "user_id": user_id, "score": score}
+                    for rank, (user_id, score) in enumerate(standings, start=1)
+                ]
+                currency, amounts = WEEKLY_PRIZES[league.value]
+                prizes += [
+                    {"week": week, "league": league, "rank": rank, "user_id": user_id,
+                     "currency": currency, "amount": amount}
+                    for rank, ((user_id, score), amount) in enumerate(zip(standings, amounts), start=1)
+                    if score > 0
+                ]
+
+            if leaderboard.redis is not None:
+                for category in ACTIVITY_CATEGORIES:
+                    members = await leaderboard.redis.zrevrange(leaderboard.key(category, week), 0, -1, withscores=True)
+                    rows += [
+                        {"week": week, "category": category, "rank": rank, "user_id": int(member), "score": score}
+                        for rank, (member, score) in enumerate(members, start=1)
+                    ]
+
+            # Строка недели вставляется первой: параллельный процесс упрётся в первичный ключ
+            session.add(WeeklyRollover(week=week))
+            try:
+                await session.flush()
+                if rows:
+                    await session.execute(insert(RatingArchive), rows)
+                if prizes:
+                    await session.execute(insert(WeeklyPrize), prizes)
+                await session.commit()
+            except IntegrityError:
+                await session.rollback()
+                return False
+
+        logger.info("Рейтинги недели %s заархивированы: %s строк, %s призов", week, len(rows), len(prizes))
+        return True
+
+    async def pay(self, week: str) -> int:
+        """
+        Начисляет призы недели пакетным UPDATE по валютам.
+
+        Призы сначала помечаются выплаченными (UPDATE ... RETURNING) в той же
+        транзакции, что и начисление, поэтому выплата не повторится.
+
+        Returns:
+            int: Количество выплаченных призов.
+        """
+        async with self.sessionmaker() as session:
+            claimed = (await session.execute(
+                update(WeeklyPrize)
+                .where(WeeklyPrize.week == week, WeeklyPrize.paid.is_(False))
+                .values(paid=True)
+                .returning(WeeklyPrize.user_id, WeeklyPrize.currency, WeeklyPrize.amount)
+                .execution_options(synchronize_session=False)
+            )).all()
+
+            totals: dict[str, dict[int, int]] = defaultdict(lambda: defaultdict(int))
+            for user_id, currency, amount in claimed:
+                totals[currency][user_id] += amount
+
+            # Один порядок блокировок во всех транзакциях: валюты и пользователи по возрастанию
+            for currency in sorted(totals):
+                await credit_balances(session, currency, totals[currency])
+            if claimed:
+                # Запись в журнал монет — только для аудита, баланс уже начислен
+                await session.execute(insert(CoinLedger), [
+                    {"user_id": user_id, "currency": currency, "amount": amount,
+                     "reason": LEDGER_WEEKLY_PRIZE, "applied": True}
+                    for user_id, currency, amount in claimed
+                ])
+
+            await session.execute(
+                update(WeeklyRollover).where(WeeklyRollover.week == week).values(paid_at=datetime.now(pytz.utc))
+            )
+            await session.commit()
+
+        if claimed:
+            logger.info("Призы недели %s выплачены: %s", week, len(claimed))
+        return len(claimed)
+
+    async def notify(self, bot: Bot, week: str) -> int:
+        """
+        Отправляет победителям недели ещё не отправленные уведомления.
+
+        Перед отправкой приз забирается отметкой notified (UPDATE ... RETURNING
+        в отдельной транзакции), поэтому несколько реплик не отправят одно
+        уведомление дважды. Если отправить не удалось, отметка снимается и
+        уведомление повторится при следующем запуске; после падения процесса
+        между отметкой и отправкой уведомление теряется, но не дублируется.
+
+        Returns:
+            int: Количество отправленных уведомлений.
+        """
+        async with self.sessionmaker() as session:
+            candidates = (await session.execute(
+                select(WeeklyPrize.league, WeeklyPrize.rank)
+                .where(WeeklyPrize.week == week, WeeklyPrize.paid.is_(True), WeeklyPrize.notified.is_(False))
+                .order_by(WeeklyPrize.league, WeeklyPrize.rank)
+            )).all()
+
+            sent = 0
+            for league, rank in candidates:
+                is_prize = and_(WeeklyPrize.week == week, WeeklyPrize.league == league, WeeklyPrize.rank == rank)
+                prize = (await session.execute(
+                    update(WeeklyPrize)
+                    .where(is_prize, WeeklyPrize.notified.is_(False))
+                    .values(notified=True)
+                    .returning(WeeklyPrize.user_id, WeeklyPrize.rank, WeeklyPrize.currency, WeeklyPrize.amount)
+                    .execution_options(synchronize_session=False)
+                )).first()
+                await session.commit()
+                if prize is None:
+                    continue  # Уведомление уже отправляет другая реплика
+
+                try:
+                    # Темп отправки задаёт планировщик исходящих сообщений
+                    with outbound.priority(PRIORITY_NOTIFICATION):
+                        await bot.send_message(
+                            prize.user_id,
+                            f"🏆 Итоги недели: вы заняли {prize.rank} место в лиге {league.value}!\n"
+                            f"🎁 Приз: {prize.amount} {CURRENCY_NAMES.get(prize.currency, prize.currency)} монет "
+                            f"уже на вашем балансе."
+                        )
+                    sent += 1
+                except TelegramForbiddenError:
+                    pass  # Пользователь заблокировал бота — уведомление не повторяем
+                except TelegramAPIError as e:
+                    logger.error("Не удалось уведомить %s о призе: %s", prize.user_id, e)
+                    await session.execute(update(WeeklyPrize).where(is_prize).values(notified=False))
+                    await session.commit()
+
+            pending = await session.scalar(
+                select(WeeklyPrize.rank)
+                .where(WeeklyPrize.week == week, WeeklyPrize.notified.is_(False))
+                .limit(1)
+            )
+            if pending is None:
+                await session.execute(
+                    update(WeeklyRollover)
+                    .where(WeeklyRollover.week == week)
+                    .values(notified_at=datetime.now(pytz.utc))
+                )
+                await session.commit()
+        return sent
+
+    async def rollover(self, bot: Bot, week: str):
+        """Выполняет незавершённые шаги закрытия недели."""
+        await self.archive(week)
+        async with self.sessionmaker() as session:
+            state = await session.get(WeeklyRollover, week)
+        if state is None:
+            return
+        if state.paid_at is None:
+            await self.pay(week)
+        if state.notified_at is None:
+            await self.notify(bot, week)
+
+    async def pending_weeks(self) -> list[str]:
+        """
+        Закончившиеся недели, закрытие которых не выполнено или не завершено.
+
+        Кроме прошлой недели сюда попадают все более ранние недели с
+        результатами в `weekly_scores`, но без закрытия, — например, если бот
+        был остановлен на несколько недель.
+
+        Returns:
+            list: ID недель от старых к новым.
+        """
+        current = get_week_id()
+        async with self.sessionmaker() as session:
+            skipped = await session.scalars(
+                select(WeeklyScore.week).distinct()
+                .where(
+                    WeeklyScore.week < current,
+                    ~exists().where(WeeklyRollover.week == WeeklyScore.week)
+                )
+            )
+            weeks = set(skipped)
+            unfinished = await session.scalars(
+                select(WeeklyRollover.week)
+                .where(or_(WeeklyRollover.paid_at.is_(None), WeeklyRollover.notified_at.is_(None)))
+            )
+            weeks.update(unfinished)
+        weeks.add(get_previous_week_id())
+        # ID вида "2026-W05" упорядочены по времени и как строки
+        return sorted(weeks)
+
+    async def run(self, bot: Bot):
+        """Фоновая задача: закрывает прошедшие недели после понедельника 00:00 по Москве."""
+        while True:
+            try:
+                for week in await self.pending_weeks():
+                    try:
+                        await self.rollover(bot, week)
+                    except Exception as e:
+                        logger.error("Ошибка закрытия недели %s: %s", week, e)
+            except Exception as e:
+                logger.error("Ошибка закрытия недели: %s", e)
+            await asyncio.sleep(CHECK_INTERVAL)
+
+
+# Общая задача закрытия недели
+rating_rollover = RatingRollover(async_session_maker)
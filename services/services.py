@@ -1,56 +1,52 @@
 import base64
+import logging
 import uuid
 
 import aiohttp
 from aiogram.types import Message, LabeledPrice
 from aiogram_dialog import DialogManager
-from datetime import datetime, timedelta
-import pytz
 from sqlalchemy import func, select, and_
-from aiocache import cached
+from sqlalchemy.orm import aliased
+from redis.exceptions import RedisError
 
 from config_data.config import PAY_TOKEN, SHOP_ID, SECRET_KEY
 from db.models import (
-    Users, Game, ProposedQuestion, async_session_maker,
+    Users, WeeklyScore, ProposedQuestion, async_session_maker,
     user_referrals, user_subscriptions, LeagueEnum
 )
+from services.leaderboard import leaderboard, get_week_id, get_week_range, RatingTable, CATEGORY_QUESTIONS, CATEGORY_SUBSCRIPTIONS, CATEGORY_REFERRALS
+from services.rating_cache import RatingCache
 
+logger = logging.getLogger(__name__)
 
-# Функция для получения временного диапазона недели
-def get_current_week_range():
-    tz = pytz.timezone('Europe/Moscow')
-    now = datetime.now(tz)
 
-    # Находим начало недели (понедельник 00:00)
-    start = (now - timedelta(days=now.weekday())).replace(hour=0, minute=0, second=0, microsecond=0)
-    # Находим конец недели (воскресенье 23:59)
-    end = start + timedelta(days=6, hours=23, minutes=59)
+async def _load_rating_data(week: str | None = None) -> dict[str, RatingTable]:
+    """
+    Считает недельные рейтинги агрегатами по БД: категория -> RatingTable.
 
-    return start.astimezone(pytz.utc), end.astimezone(pytz.utc)
+    Агрегаты совпадают с тем, что накапливают инкременты рейтинга в Redis:
+    события (предложенный вопрос, новая подписка, приглашение) считаются по
+    их собственному времени в пределах ISO-недели.
 
-
-# Кеширование рейтинга на 5 минут
-@cached(ttl=300)
-async def get_cached_rating_data():
-    start_week, end_week = get_current_week_range()
+    Args:
+        week (str, optional): Неделя; по умолчанию текущая.
+    """
+    week = week or get_week_id()
+    start_week, end_week = get_week_range(week)
 
     async with async_session_maker() as session:
-        # Рейтинг по лигам (бронза, серебро, золото)
-        league_ratings = {}
+        # Рейтинг по лигам (бронза, серебро, золото) — из недельных итогов, одна строка на игрока
+        ratings_by_category = {}
         for league in LeagueEnum:
             ratings = await session.execute(
-                select(
-                    Game.user_id,
-                    func.sum(Game.score).label('total_score')
-                )
+                select(WeeklyScore.user_id, WeeklyScore.total_score)
                 .where(and_(
-                    Game.league == league,
-                    Game.created_at.between(start_week, end_week)
+                    WeeklyScore.week == week,
+                    WeeklyScore.league == league
                 ))
-                .group_by(Game.user_id)
-                .order_by(func.sum(Game.score).desc())
+                .order_by(WeeklyScore.total_score.desc())
             )
-            league_ratings[league] = ratings.all()
+            ratings_by_category[league.value] = RatingTable(ratings.all())
 
         # Рейтинг по предложенным вопросам
         question_ratings = await session.execute(
@@ -59,119 +55,165 @@ async def get_cached_rating_data():
                 func.count(ProposedQuestion.id).label('total_questions')
             )
             .where(and_(
-                ProposedQuestion.created_at.between(start_week, end_week)
+                ProposedQuestion.created_at >= start_week,
+                ProposedQuestion.created_at < end_week
             ))
             .group_by(ProposedQuestion.created_by_user_id)
             .order_by(func.count(ProposedQuestion.id).desc())
         )
-        question_ratings = question_ratings.all()
+        ratings_by_category[CATEGORY_QUESTIONS] = RatingTable(question_ratings.all())
 
-        # Рейтинг по подпискам на каналы спонсоров
+        # Рейтинг по подпискам на каналы спонсоров — по времени самой подписки
+        # (отписка не уменьшает рейтинг, как и в Redis)
         subscription_ratings = await session.execute(
             select(
-                Users.user_id,
-                func.count(user_subscriptions.c.user_id).label('total_subscriptions')
+                user_subscriptions.c.user_id,
+                func.count(user_subscriptions.c.channel_id).label('total_subscriptions')
             )
-            .join(user_subscriptions, user_subscriptions.c.user_id == Users.user_id)
             .where(and_(
-                Users.created_at.between(start_week, end_week)
+                user_subscriptions.c.subscribed_at >= start_week,
+                user_subscriptions.c.subscribed_at < end_week
             ))
-            .group_by(Users.user_id)
-            .order_by(func.count(user_subscriptions.c.user_id).desc())
+            .group_by(user_subscriptions.c.user_id)
+            .order_by(func.count(user_subscriptions.c.channel_id).desc())
         )
-        subscription_ratings = subscription_ratings.all()
+        ratings_by_category[CATEGORY_SUBSCRIPTIONS] = RatingTable(subscription_ratings.all())
 
-        # Рейтинг по приглашенным друзьям
+        # Рейтинг по приглашенным друзьям (по Telegram ID пригласившего). Приглашение
+        # записывается при регистрации друга, поэтому его время — created_at друга
+        referrer, referred = aliased(Users), aliased(Users)
         referral_ratings = await session.execute(
             select(
-                user_referrals.c.referrer_id,
+                referrer.user_id,
                 func.count(user_referrals.c.referred_id).label('total_referrals')
             )
-            .group_by(user_referrals.c.referrer_id)
+            .join(referrer, referrer.id == user_referrals.c.referrer_id)
+            .join(referred, referred.id == user_referrals.c.referred_id)
+            .where(and_(
+                referred.created_at >= start_week,
+                referred.created_at < end_week
+            ))
+            .group_by(referrer.user_id)
             .order_by(func.count(user_referrals.c.referred_id).desc())
         )
-        referral_ratings = referral_ratings.all()
+        ratings_by_category[CATEGORY_REFERRALS] = RatingTable(referral_ratings.all())
 
-    return {
-        "league_ratings": league_ratings,
-        "question_ratings": question_ratings,
-        "subscription_ratings": subscription_ratings,
-        "referral_ratings": referral_ratings,
+    return ratings_by_category
+
+
+# Общий для всех процессов снимок рейтинга в Redis (пересборка раз в 5 минут)
+rating_cache = RatingCache(_load_rating_data)
+
+
+async def get_cached_rating_data() -> dict[str, RatingTable]:
+    """Снимок недельных рейтингов: категория -> RatingTable."""
+    return await rating_cache.get()
+
+
+# Категории недельного рейтинга: три лиги и активность пользователей
+RATING_CATEGORIES = [league.value for league in LeagueEnum] + [
+    CATEGORY_QUESTIONS, CATEGORY_SUBSCRIPTIONS, CATEGORY_REFERRALS
+]
+
+
+async def backfill_leaderboards():
+    """Заполняет рейтинги текущей недели в Redis из БД, если их там нет (например, после очистки Redis)."""
+    if leaderboard.redis is None:
+        return
+    # Агрегаты считаются заново: снимок мог остаться от прошлой недели или устареть
+    week = get_week_id()
+    try:
+        rows = await _load_rating_data(week)
+        for category, ratings in rows.items():
+            if await leaderboard.seed(category, ratings, week):
+                logger.info("Рейтинг %s восстановлен из БД", category)
+    except RedisError as e:
+        logger.error("Не удалось восстановить рейтинги: %s", e)
+
+
+# Вкладки рейтинга: категория -> (название, единица результата)
+RATING_TABS = {
+    LeagueEnum.Bronze.value: ("🥉 Бронза", "баллов"),
+    LeagueEnum.Silver.value: ("🥈 Серебро", "баллов"),
+    LeagueEnum.Gold.value: ("🥇 Золото", "баллов"),
+    CATEGORY_QUESTIONS: ("❓ Вопросы", "вопросов"),
+    CATEGORY_SUBSCRIPTIONS: ("📢 Подписки", "подписок"),
+    CATEGORY_REFERRALS: ("👥 Друзья", "друзей"),
+}
+
+
+async def get_rating_page_rows(category: str, user_id: int, cursor: dict) -> tuple[list | None, int]:
+    """
+    Одна страница рейтинга категории.
+
+    Основной источник — sorted sets в Redis; при недоступности Redis
+    используется общий снимок рейтинга.
+
+    Args:
+        category (str): Категория рейтинга.
+        user_id (int): Telegram ID пользователя (для страницы "вокруг меня").
+        cursor (dict): Ключ страницы: {"after": [результат, user_id]},
+            {"before": [...]}, {"around": True} или {} для первой страницы.
+
+    Returns:
+        tuple: (список (место, user_id, результат) или None, если пользователя
+        нет в рейтинге; всего строк в рейтинге).
+    """
+    kwargs = {
+        "after": cursor.get("after"),
+        "before": cursor.get("before"),
+        "around": user_id if cursor.get("around") else None,
     }
+    if leaderboard.redis is not None:
+        try:
+            return await leaderboard.page(category, **kwargs)
+        except RedisError as e:
+            logger.error("Рейтинг из Redis недоступен: %s", e)
 
+    table = (await get_cached_rating_data())[category]
+    return table.page(**kwargs), len(table)
 
-# Функция для получения данных о рейтинге
-async def get_rating_data(dialog_manager: DialogManager, **kwargs):
+
+# Функция для получения данных о рейтинге (одна страница выбранной вкладки)
+async def get_rating_page(dialog_manager: DialogManager, **kwargs):
     user = dialog_manager.event.from_user
-    cached_data = await get_cached_rating_data()
-
-    league_ratings = cached_data["league_ratings"]
-    question_ratings = cached_data["question_ratings"]
-    subscription_ratings = cached_data["subscription_ratings"]
-    referral_ratings = cached_data["referral_ratings"]
-
-    # Находим место пользователя в каждом рейтинге
-    user_league_ranks = {}
-    for league, ratings in league_ratings.items():
-        user_league_ranks[league] = next((i for i, (uid, _) in enumerate(ratings, 1) if uid == user.id), None)
-
-    user_question_rank = next((i for i, (uid, _) in enumerate(question_ratings, 1) if uid == user.id), None)
-    user_subscription_rank = next((i for i, (uid, _) in enumerate(subscription_ratings, 1) if uid == user.id), None)
-    user_referral_rank = next((i for i, (uid, _) in enumerate(referral_ratings, 1) if uid == user.id), None)
-
-    # Получаем данные для пагинации (5 строк до и 5 строк после пользователя)
-    def get_paginated_ratings(ratings, user_rank):
-        if user_rank is None:
-            return []
-        start_index = max(0, user_rank - 6)
-        end_index = min(len(ratings), user_rank + 5)
-        return ratings[start_index:end_index]
+    dialog_data = dialog_manager.dialog_data
+    category = dialog_data.setdefault("category", LeagueEnum.Bronze.value)
+    title, label = RATING_TABS[category]
+
+    cursor = dialog_data.get("cursor", {})
+    rows, total = await get_rating_page_rows(category, user.id, cursor)
+    notice = ""
+    if rows is None:
+        notice = "Вы пока не попали в этот рейтинг — вот лидеры недели.\n\n"
+        cursor = {}
+        rows, total = await get_rating_page_rows(category, user.id, cursor)
+    elif not rows and cursor:
+        # Страница опустела (рейтинг изменился) — возвращаемся к началу
+        cursor = {}
+        rows, total = await get_rating_page_rows(category, user.id, cursor)
+    dialog_data["cursor"] = cursor
+
+    # Границы страницы — ключи для соседних страниц
+    dialog_data["first"] = [rows[0][2], rows[0][1]] if rows else None
+    dialog_data["last"] = [rows[-1][2], rows[-1][1]] if rows else None
 
     # Форматируем данные для отображения
-    def format_rating(ratings, user_id, label, is_league=False):
-        result = []
-        for rank, (uid, value) in enumerate(ratings, start=1):
-            if uid == user_id:
-                result.append(f"🏅 {rank}. Вы: {value} {label}")
-            else:
-                if rank == 1:
-                    result.append(f"🥇 {rank}. Пользователь {uid}: {value} {label}")
-                elif rank == 2:
-                    result.append(f"🥈 {rank}. Пользователь {uid}: {value} {label}")
-                elif rank == 3:
-                    result.append(f"🥉 {rank}. Пользователь {uid}: {value} {label}")
-                else:
-                    result.append(f"📊 {rank}. Пользователь {uid}: {value} {label}")
-        return "\n".join(result)
-
-    # Формируем текст для каждой лиги
-    league_rating_texts = []
-    for league, ratings in league_ratings.items():
-        user_rank = user_league_ranks[league]
-        paginated_ratings = get_paginated_ratings(ratings, user_rank)
-        league_rating_texts.append(
-            f"📊 Рейтинг в лиге {league.value}:\n"
-            f"{format_rating(paginated_ratings, user.id, 'баллов')}"
-        )
-
-    question_rating_text = format_rating(
-        get_paginated_ratings(question_ratings, user_question_rank),
-        user.id, "вопросов"
-    )
-    subscription_rating_text = format_rating(
-        get_paginated_ratings(subscription_ratings, user_subscription_rank),
-        user.id, "подписок"
-    )
-    referral_rating_text = format_rating(
-        get_paginated_ratings(referral_ratings, user_referral_rank),
-        user.id, "друзей"
-    )
+    medals = {1: "🥇", 2: "🥈", 3: "🥉"}
+    lines = []
+    for rank, uid, value in rows:
+        value = int(value)
+        if uid == user.id:
+            lines.append(f"🏅 {rank}. Вы: {value} {label}")
+        else:
+            lines.append(f"{medals.get(rank, '📊')} {rank}. Пользователь {uid}: {value} {label}")
 
     return {
-        "league_ratings": "\n\n".join(league_rating_texts),
-        "question_rating": question_rating_text,
-        "subscription_rating": subscription_rating_text,
-        "referral_rating": referral_rating_text,
+        "tabs": [(key, name if key != category else f"• {name} •") for key, (name, _) in RATING_TABS.items()],
+        "title": title,
+        "rating": notice + ("\n".join(lines) or "Пока никто не набрал очков."),
+        "has_prev": bool(rows) and rows[0][0] > 1,
+        "has_next": bool(rows) and rows[-1][0] < total,
     }
 
 
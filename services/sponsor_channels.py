@@ -0,0 +1,179 @@
+import asyncio
+import logging
+import time
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+from db.models import SponsorChannel
+
+logger = logging.getLogger(__name__)
+
+CHAT_IDS_KEY = "sponsor:chat_ids"
+
+# Вердикт "подписан" живёт 10 минут, "не подписан" — 20 секунд: пользователь,
+# только что подписавшийся на канал, быстро увидит изменения
+MEMBER_TTL = 600
+NON_MEMBER_TTL = 20
+
+# Сколько запросов get_chat_member выполняется одновременно
+CHECK_CONCURRENCY = 5
+
+# Через сколько секунд повторять попытку определить недоступный канал
+UNRESOLVED_RETRY = 300
+
+MEMBER_STATUSES = ("member", "administrator", "creator")
+
+
+def parse_channel_link(link: str) -> str | None:
+    """
+    Приводит ссылку на канал к виду, который принимает Bot API.
+
+    Returns:
+        str: "@username" или числовой ID; None для приватных ссылок-приглашений.
+    """
+    name = link.strip()
+    for prefix in ("https://", "http://", "t.me/", "telegram.me/"):
+        if name.startswith(prefix):
+            name = name[len(prefix):]
+    name = name.strip("/").split("/")[0].split("?")[0]
+    if not name or name.startswith("+") or name == "joinchat":
+        return None
+    if name.lstrip("-").isdigit():
+        return name
+    return "@" + name.lstrip("@")
+
+
+class SponsorRegistry:
+    """
+    Реестр спонсорских каналов.
+
+    Числовой chat_id каждого канала определяется по ссылке один раз
+    (get_chat) и хранится в памяти процесса и в Redis. Вердикты о подписке
+    пользователя кешируются в Redis на короткое время, включая отрицательные,
+    поэтому повторные нажатия "Проверить подписку" не обращаются к Telegram.
+    """
+
+    def __init__(self):
+        self.redis: Redis | None = None
+        self._chat_ids: dict[int, int] = {}
+        # Каналы, которые не удалось определить: ID канала -> время следующей попытки
+        self._unresolved: dict[int, float] = {}
+
+    def setup(self, redis: Redis):
+        self.redis = redis
+
+    @staticmethod
+    def _member_key(chat_id: int, user_id: int) -> str:
+        return f"sponsor:member:{chat_id}:{user_id}"
+
+    async def chat_id(self, bot: Bot, channel: SponsorChannel) -> int | None:
+        """Числовой ID чата канала или None, если канал не удалось определить."""
+        chat_id = self._chat_ids.get(channel.id)
+        if chat_id is not None:
+            return chat_id
+        if self._unresolved.get(channel.id, 0) > time.monotonic():
+            return None
+
+        if self.redis is not None:
+            try:
+                cached = await self.redis.hget(CHAT_IDS_KEY, channel.id)
+                if cached is not None:
+                    self._chat_ids[channel.id] = int(cached)
+                    return int(cached)
+            except RedisError as e:
+                logger.error("Реестр каналов в Redis недоступен: %s", e)
+
+        target = parse_channel_link(channel.link)
+        if target is None:
+            logger.warning("Не удаётся определить чат канала %s по ссылке %s", channel.name, channel.link)
+            self._unresolved[channel.id] = time.monotonic() + UNRESOLVED_RETRY
+            return None
+        try:
+            chat = await bot.get_chat(target)
+        except TelegramAPIError as e:
+            logger.error("Канал %s недоступен: %s", channel.link, e)
+            self._unresolved[channel.id] = time.monotonic() + UNRESOLVED_RETRY
+            return None
+
+        self._chat_ids[channel.id] = chat.id
+        if self.redis is not None:
+            try:
+                await self.redis.hset(CHAT_IDS_KEY, channel.id, chat.id)
+            except RedisError as e:
+                logger.error("Не удалось сохранить chat_id канала: %s", e)
+        return chat.id
+
+    async def check(self, bot: Bot, channels: list[SponsorChannel], user_id: int) -> dict[int, bool]:
+        """
+        Проверяет подписку пользователя на каналы.
+
+        Сначала читаются кешированные вердикты (один MGET), затем для остальных
+        каналов выполняется get_chat_member с ограничением параллельности.
+
+        Returns:
+            dict: ID канала в БД -> подписан ли пользователь.
+        """
+        chat_ids = await asyncio.gather(*(self.chat_id(bot, channel) for channel in channels))
+        verdicts = {channel.id: False for channel, chat_id in zip(channels, chat_ids) if chat_id is None}
+        pending = [(channel, chat_id) for channel, chat_id in zip(channels, chat_ids) if chat_id is not None]
+        if not pending:
+            return verdicts
+
+        cached = [None] * len(pending)
+        if self.redis is not None:
+            try:
+                cached = await self.redis.mget([self._member_key(chat_id, user_id) for _, chat_id in pending])
+            except RedisError as e:
+                logger.error("Кеш подписок недоступен: %s", e)
+
+        semaphore = asyncio.Semaphore(CHECK_CONCURRENCY)
+
+        async def is_member(chat_id: int) -> bool:
+            async with semaphore:
+                try:
+                    return await self.fetch_verdict(bot, chat_id, user_id)
+                except TelegramBadRequest:
+                    return False  # Ошибка запроса — канал недоступен или бот не админ
+
+        misses = [(channel, chat_id) for (channel, chat_id), value in zip(pending, cached) if value is None]
+        fresh = await asyncio.gather(*(is_member(chat_id) for _, chat_id in misses))
+
+        for (channel, _), value in zip(pending, cached):
+            if value is not None:
+                verdicts[channel.id] = value == b"1"
+        for (channel, _), verdict in zip(misses, fresh):
+            verdicts[channel.id] = verdict
+
+        if misses and self.redis is not None:
+            try:
+                async with self.redis.pipeline(transaction=False) as pipe:
+                    for (_, chat_id), verdict in zip(misses, fresh):
+                        pipe.set(self._member_key(chat_id, user_id), int(verdict),
+                                 ex=MEMBER_TTL if verdict else NON_MEMBER_TTL)
+                    await pipe.execute()
+            except RedisError as e:
+                logger.error("Не удалось сохранить вердикты подписки: %s", e)
+        return verdicts
+
+    @staticmethod
+    async def fetch_verdict(bot: Bot, chat_id: int, user_id: int) -> bool:
+        """Запрашивает у Telegram, подписан ли пользователь на чат (без кеша)."""
+        chat_member = await bot.get_chat_member(chat_id, user_id)
+        return chat_member.status in MEMBER_STATUSES
+
+    async def store_verdict(self, chat_id: int, user_id: int, verdict: bool):
+        """Кеширует вердикт, полученный вне check() (например, при повторной проверке подписок)."""
+        if self.redis is None:
+            return
+        try:
+            await self.redis.set(self._member_key(chat_id, user_id), int(verdict),
+                                 ex=MEMBER_TTL if verdict else NON_MEMBER_TTL)
+        except RedisError as e:
+            logger.error("Не удалось сохранить вердикт подписки: %s", e)
+
+
+# Общий реестр спонсорских каналов процесса
+sponsor_registry = SponsorRegistry()
@@ -0,0 +1,190 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+import pytz
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter, TelegramAPIError
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+from sqlalchemy import select, update, or_, and_, bindparam
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from db.models import SponsorChannel, user_subscriptions, async_session_maker
+from services.sponsor_channels import sponsor_registry
+
+logger = logging.getLogger(__name__)
+
+# Подписчики последней недели перепроверяются раз в сутки, остальные — раз в неделю
+RECENT_PERIOD = timedelta(days=7)
+RECENT_RECHECK = timedelta(days=1)
+RECHECK = timedelta(days=7)
+
+BATCH_SIZE = 50
+IDLE_INTERVAL = 300
+# На это время пакет закрепляется за процессом; должно с запасом превышать проверку пакета
+CLAIM_TTL = timedelta(minutes=30)
+
+# Условие на одну подписку для пакетных UPDATE (executemany)
+MATCH_SUBSCRIPTION = and_(
+    user_subscriptions.c.user_id == bindparam("b_user_id"),
+    user_subscriptions.c.channel_id == bindparam("b_channel_id"),
+)
+
+
+class SubscriptionSweeper:
+    """
+    Фоновая повторная проверка подписок на спонсорские каналы.
+
+    Проверяет сохранённые подписки пакетами, начиная с недавних подписчиков,
+    и отмечает обнаруженные отписки в `user_subscriptions.unsubscribed_at`.
+    Пакет закрепляется за процессом отметкой `claimed_until`, поэтому реплики
+    проверяют разные подписки.
+    Запросы к Telegram расходуются из бюджета на минуту, общего для всех
+    процессов (счётчик в Redis): проверка идёт равномерно и намного ниже
+    лимитов бота, а при RetryAfter уступает место интерактивным запросам.
+    """
+
+    def __init__(self, sessionmaker: async_sessionmaker[AsyncSession]):
+        self.sessionmaker = sessionmaker
+        self.redis: Redis | None = None
+
+    def setup(self, redis: Redis):
+        self.redis = redis
+
+    async def _take_budget(self, budget_per_minute: int) -> bool:
+        """Берёт один запрос из бюджета текущей минуты (общего для процессов)."""
+        if self.redis is None:
+            return True
+        key = f"sweep:budget:{int(datetime.now(pytz.utc).timestamp() // 60)}"
+        try:
+            async with self.redis.pipeline(transaction=True) as pipe:
+                pipe.incr(key)
+                pipe.expire(key, 120)
+                used, _ = await pipe.execute()
+        except RedisError as e:
+            logger.error("Бюджет проверки подписок недоступен: %s", e)
+            return False
+        return used <= budget_per_minute
+
+    async def _claim_due(self, session: AsyncSession, limit: int) -> list:
+        """
+        Закрепляет за процессом подписки, которые пора перепроверить, — сначала самые свежие.
+
+        Строки выбираются с FOR UPDATE SKIP LOCKED и в той же транзакции
+        получают `claimed_until`, поэтому параллельные процессы выбирают
+        другие подписки. Если процесс упал, подписки вернутся в очередь
+        после истечения CLAIM_TTL.
+        """
+        now = datetime.now(pytz.utc)
+        table = user_subscriptions
+        result = await session.execute(
+            select(table.c.user_id, table.c.channel_id)
+            .where(
+                table.c.unsubscribed_at.is_(None),
+                or_(table.c.claimed_until.is_(None), table.c.claimed_until < now),
+                or_(
+                    table.c.checked_at.is_(None),
+                    and_(table.c.subscribed_at >= now - RECENT_PERIOD, table.c.checked_at < now - RECENT_RECHECK),
+                    table.c.checked_at < now - RECHECK,
+                ),
+            )
+            .order_by(table.c.subscribed_at.desc().nulls_last())
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        )
+        due = result.all()
+        if due:
+            await session.execute(
+                update(table).where(MATCH_SUBSCRIPTION).values(claimed_until=now + CLAIM_TTL),
+                [{"b_user_id": user_id, "b_channel_id": channel_id} for user_id, channel_id in due]
+            )
+        await session.commit()
+        return due
+
+    async def sweep(self, bot: Bot, budget_per_minute: int) -> int:
+        """
+        Перепроверяет один пакет подписок в пределах бюджета.
+
+        Returns:
+            int: Количество проверенных подписок.
+        """
+        # Сессия не держится открытой, пока идут запросы к Telegram
+        async with self.sessionmaker() as session:
+            due = await self._claim_due(session, BATCH_SIZE)
+            if not due:
+                return 0
+            channels = {
+                channel.id: channel
+                for channel in (await session.execute(select(SponsorChannel))).scalars().all()
+            }
+
+        delay = 60 / budget_per_minute
+        checked, unsubscribed = [], []
+        for user_id, channel_id in due:
+            channel = channels.get(channel_id)
+            chat_id = await sponsor_registry.chat_id(bot, channel) if channel else None
+            if chat_id is None:
+                # Канал удалён или недоступен — откладываем до следующего круга проверки
+                checked.append({"b_user_id": user_id, "b_channel_id": channel_id})
+                continue
+            while not await self._take_budget(budget_per_minute):
+                await asyncio.sleep(delay)
+            try:
+                verdict = await sponsor_registry.fetch_verdict(bot, chat_id, user_id)
+            except TelegramRetryAfter as e:
+                # Лимит бота исчерпан — пропускаем вперёд интерактивные запросы
+                logger.warning("Проверка подписок приостановлена на %s с", e.retry_after * 2)
+                await asyncio.sleep(e.retry_after * 2)
+                break
+            except TelegramAPIError as e:
+                # Пользователь или канал недоступен — проверим на следующем круге
+                if not isinstance(e, TelegramBadRequest):
+                    logger.error("Ошибка проверки подписки %s на %s: %s", user_id, channel_id, e)
+                checked.append({"b_user_id": user_id, "b_channel_id": channel_id})
+                continue
+            await sponsor_registry.store_verdict(chat_id, user_id, verdict)
+            (checked if verdict else unsubscribed).append({"b_user_id": user_id, "b_channel_id": channel_id})
+            await asyncio.sleep(delay)
+
+        now = datetime.now(pytz.utc)
+        table = user_subscriptions
+        processed = {(row["b_user_id"], row["b_channel_id"]) for row in checked + unsubscribed}
+        # Не проверенные из-за паузы подписки сразу возвращаются в очередь
+        released = [
+            {"b_user_id": user_id, "b_channel_id": channel_id}
+            for user_id, channel_id in due if (user_id, channel_id) not in processed
+        ]
+        async with self.sessionmaker() as session:
+            if checked:
+                await session.execute(
+                    update(table).where(MATCH_SUBSCRIPTION).values(checked_at=now, claimed_until=None), checked
+                )
+            if unsubscribed:
+                await session.execute(
+                    update(table).where(MATCH_SUBSCRIPTION).values(checked_at=now, unsubscribed_at=now, claimed_until=None),
+                    unsubscribed
+                )
+            if released:
+                await session.execute(update(table).where(MATCH_SUBSCRIPTION).values(claimed_until=None), released)
+            await session.commit()
+
+        if unsubscribed:
+            logger.info("Обнаружено отписок от спонсорских каналов: %s", len(unsubscribed))
+        return len(checked) + len(unsubscribed)
+
+    async def run(self, bot: Bot, budget_per_minute: int):
+        """Фоновая задача: непрерывная перепроверка; при пустой очереди — пауза."""
+        if budget_per_minute <= 0:
+            return
+        while True:
+            try:
+                if not await self.sweep(bot, budget_per_minute):
+                    await asyncio.sleep(IDLE_INTERVAL)
+            except Exception as e:
+                logger.error("Ошибка повторной проверки подписок: %s", e)
+                await asyncio.sleep(IDLE_INTERVAL)
+
+
+# Общая задача повторной проверки подписок
+subscription_sweeper = SubscriptionSweeper(async_session_maker)
@@ -1,12 +1,12 @@
 from aiogram import Router, F
 from aiogram.types import CallbackQuery
 from aiogram_dialog import Window, Dialog, DialogManager, StartMode
-from aiogram_dialog.widgets.kbd import ScrollingGroup, Button
+from aiogram_dialog.widgets.kbd import Button, Group, Row, Select
 from aiogram_dialog.widgets.text import Format, Const
 
 from keyboards.keyboards import account_kb
 from services.FSM import DialogStates
-from services.services import get_rating_data
+from services.services import get_rating_page
 
 rating_router = Router()
 
@@ -17,23 +17,57 @@ async def go_back(callback: CallbackQuery, button: Button, dialog_manager: Dialo
     await dialog_manager.done()  # Закрываем диалог
     await callback.message.answer(text="Вы вошли в свой аккаунт", reply_markup=account_kb)
 
+
+# Переключение вкладки рейтинга — с первой страницы
+async def select_tab(callback: CallbackQuery, widget: Select, dialog_manager: DialogManager, category: str):
+    dialog_manager.dialog_data["category"] = category
+    dialog_manager.dialog_data["cursor"] = {}
+
+
+# Следующая/предыдущая страница — по ключу (результат, user_id) крайней строки текущей
+async def next_page(callback: CallbackQuery, button: Button, dialog_manager: DialogManager):
+    dialog_manager.dialog_data["cursor"] = {"after": dialog_manager.dialog_data["last"]}
+
+
+async def prev_page(callback: CallbackQuery, button: Button, dialog_manager: DialogManager):
+    dialog_manager.dialog_data["cursor"] = {"before": dialog_manager.dialog_data["first"]}
+
+
+async def top_page(callback: CallbackQuery, button: Button, dialog_manager: DialogManager):
+    dialog_manager.dialog_data["cursor"] = {}
+
+
+async def around_me(callback: CallbackQuery, button: Button, dialog_manager: DialogManager):
+    dialog_manager.dialog_data["cursor"] = {"around": True}
+
+
 # Окно диалога
 rating_window = Window(
     Format(
-        "🏆 Недельный рейтинг:\n\n"
-        "{league_ratings}\n\n"
-        "❓ Рейтинг по предложенным вопросам:\n{question_rating}\n\n"
-        "📢 Рейтинг по подпискам на каналы:\n{subscription_rating}\n\n"
-        "👥 Рейтинг по приглашенным друзьям:\n{referral_rating}"
+        "🏆 Недельный рейтинг — {title}:\n\n"
+        "{rating}"
     ),
-    ScrollingGroup(
-        Button(Const("Назад"), id="back", on_click=go_back),
-        id="scroll",
-        width=1,
-        height=10,
+    Group(
+        Select(
+            Format("{item[1]}"),
+            id="tab",
+            item_id_getter=lambda item: item[0],
+            items="tabs",
+            on_click=select_tab,
+        ),
+        width=3,
     ),
+    Row(
+        Button(Const("⬅️"), id="prev", on_click=prev_page, when="has_prev"),
+        Button(Const("➡️"), id="next", on_click=next_page, when="has_next"),
+    ),
+    Row(
+        Button(Const("🔝 Топ"), id="top", on_click=top_page),
+        Button(Const("📍 Вокруг меня"), id="around", on_click=around_me),
+    ),
+    Button(Const("Назад"), id="back", on_click=go_back),
     state=DialogStates.rating,
-    getter=get_rating_data,
+    getter=get_rating_page,
 )
 
 # Создание диалога
@@ -41,4 +75,3 @@ rating_dialog = Dialog(rating_window)
 
 # ✅ Регистрируем диалог в роутере
 rating_router.include_routers(rating_dialog)
-
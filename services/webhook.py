@@ -0,0 +1,112 @@
+import asyncio
+import logging
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+from config_data.config import Webhook
+from middleware.ordering import LeaseUnavailable
+
+logger = logging.getLogger(__name__)
+
+# Сколько секунд апдейт может ждать свободного слота, прежде чем получить 503
+QUEUE_TIMEOUT = 5
+HEALTH_PATH = "/healthz"
+
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    """
+    Обработчик вебхука с ограниченной очередью апдейтов.
+
+    Одновременно обрабатывается не больше max_in_flight апдейтов, ещё не
+    больше max_queue ждут свободного слота. При переполнении Telegram
+    получает 503 и доставит апдейт повторно (возможно, другой реплике).
+    Апдейт обрабатывается до ответа на запрос, поэтому метод, который вернул
+    хэндлер (например, callback.answer()), уходит в теле ответа без
+    отдельного запроса к Bot API.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, secret_token: str, max_in_flight: int, max_queue: int,
+                 **data):
+        super().__init__(dispatcher, bot, handle_in_background=False, secret_token=secret_token, **data)
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._max_queue = max_queue
+        self._waiting = 0
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if not self.verify_secret(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), self.bot):
+            return web.Response(body="Unauthorized", status=401)
+
+        if self._slots.locked() and self._waiting >= self._max_queue:
+            return web.Response(status=503, headers={"Retry-After": "1"})
+        self._waiting += 1
+        try:
+            await asyncio.wait_for(self._slots.acquire(), QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("Очередь апдейтов переполнена, апдейт отклонён")
+            return web.Response(status=503, headers={"Retry-After": "1"})
+        finally:
+            self._waiting -= 1
+
+        try:
+            return await self._handle_request(self.bot, request)
+        except LeaseUnavailable as e:
+            # Апдейт не обработан: Telegram доставит его повторно
+            logger.warning("%s, апдейт отклонён", e)
+            return web.Response(status=503, headers={"Retry-After": "1"})
+        finally:
+            self._slots.release()
+
+    __call__ = handle
+
+
+async def _health(request: web.Request) -> web.Response:
+    return web.Response(text="ok")
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot, settings: Webhook, **data):
+    """
+    Принимает апдейты через вебхук вместо polling.
+
+    Каждая реплика бота поднимает свой aiohttp-сервер за балансировщиком;
+    состояние FSM и остальные общие данные хранятся в Redis. Вебхук
+    регистрируется при старте (повторная регистрация другой репликой
+    безопасна) и не удаляется при остановке, чтобы не прервать приём
+    апдейтов остальными репликами.
+
+    Args:
+        dp (Dispatcher): Диспетчер бота.
+        bot (Bot): Экземпляр бота.
+        settings (Webhook): Настройки вебхука из конфига.
+        **data: Дополнительные данные для хэндлеров.
+    """
+    if not settings.secret:
+        raise ValueError("Для режима вебхука нужно задать WEBHOOK_SECRET")
+
+    app = web.Application()
+    app.router.add_get(HEALTH_PATH, _health)
+    BoundedRequestHandler(
+        dp, bot,
+        secret_token=settings.secret,
+        max_in_flight=settings.max_in_flight,
+        max_queue=settings.max_queue,
+        **data
+    ).register(app, path=settings.path)
+    setup_application(app, dp, bot=bot, **data)
+
+    await bot.set_webhook(
+        url=settings.url.rstrip("/") + settings.path,
+        secret_token=settings.secret,
+        allowed_updates=dp.resolve_used_update_types(),
+        max_connections=settings.max_connections,
+    )
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, settings.host, settings.port).start()
+        logger.info("Вебхук принимает апдейты на %s:%s%s", settings.host, settings.port, settings.path)
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()